@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+"""Client-side cache in front of a Redis-backed RE.md.
+
+``CachedRedisJSONDict`` is a drop-in ``RedisJSONDict`` that keeps every value
+it has read or written in a local dict:
+
+* writes go to Redis first and then to the cache (write-through);
+* reads are served from the cache while it is known to be fresh;
+* freshness comes from Redis keyspace notifications. On each one, a
+  listener thread reads the key back and drops it from the cache unless the
+  cached value is still the one in Redis (the echo of our own write is
+  therefore harmless). Until the listener is subscribed, and again whenever
+  it loses its connection, reads go straight to Redis;
+* with a prefix the listener follows ``__keyspace@<db>__:<prefix>*``.
+  Without one (RE.md at the beamline uses prefix="") it subscribes to the
+  channel of each key it caches, never to every key of a shared server;
+* ``stats()`` reports hits, misses and a sampled staleness check (every
+  ``verify_every``-th hit is compared against Redis).
+
+The server has to publish keyspace events for strings and generic commands
+(``notify-keyspace-events`` containing ``K$g`` or ``KA``). Pass
+``configure_notifications=True`` to have the client enable that itself. If
+they are off, or can not be checked, nothing is cached (unless ``max_age``
+is given).
+
+Used for ``RE.md`` in startup/00-startup.py and startup/970-load.py. Run it
+as a script to check a server, or fakeredis, by hand::
+
+    python scripts/cached_redis_dict.py --host localhost
+    python scripts/cached_redis_dict.py --fake
+"""
+import argparse
+import collections
+import collections.abc
+import copy
+import logging
+import sys
+import threading
+import time
+
+import orjson
+from redis_json_dict import ObservableMapping, ObservableSequence, RedisJSONDict
+
+logger = logging.getLogger(__name__)
+
+_ABSENT = object()
+_POLL_INTERVAL = 0.2  # s; how soon the listener notices close() and new keys
+_INVALIDATING_EVENTS = {"set", "del", "expired", "evicted", "rename_from", "rename_to",
+                        "move_from", "move_to", "restore", "copy_to"}
+
+
+# The two helpers below do what redis_json_dict's private _json_encoder_default
+# and observe do, on its public classes only, so a release of it that renames
+# its internals does not break RE.md at startup.
+
+def _json_encoder_default(content):
+    if isinstance(content, ObservableMapping):
+        return dict(content)
+    if isinstance(content, ObservableSequence):
+        return list(content)
+    raise TypeError
+
+
+def observe(value, on_changed):
+    "If value is a collection, return a recursively observable copy."
+    if isinstance(value, collections.abc.Mapping):
+        return ObservableMapping({k: observe(v, on_changed) for k, v in value.items()},
+                                 on_changed)
+    if isinstance(value, collections.abc.Sequence) and not isinstance(value, str):
+        return ObservableSequence([observe(item, on_changed) for item in value], on_changed)
+    return value
+
+
+def _dumps(value):
+    return orjson.dumps(value, default=_json_encoder_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class CachedRedisJSONDict(RedisJSONDict):
+    """
+    RedisJSONDict with a local write-through cache invalidated by Redis
+    keyspace notifications.
+
+    Parameters
+    ----------
+    redis_client : redis.Redis
+    prefix : str
+    max_age : float, optional
+        Refetch entries older than this many seconds even without a
+        notification. None (default) trusts the notifications.
+    verify_every : int, optional
+        Compare every n-th cache hit against Redis to measure staleness.
+        0 turns the check off.
+    configure_notifications : bool, optional
+        Turn on keyspace notifications on the server if they are off.
+    retry_interval : float, optional
+        Seconds between attempts to resubscribe after losing the connection.
+    """
+
+    def __init__(self, redis_client, prefix, *, max_age=None, verify_every=200,
+                 configure_notifications=False, retry_interval=5):
+        super().__init__(redis_client, prefix)
+        self.max_age = max_age
+        self.verify_every = verify_every
+        self.retry_interval = retry_interval
+        self._lock = threading.RLock()
+        self._cache = {}  # key -> (decoded value or _ABSENT, time cached)
+        self._keys = None  # every key, once listed
+        self._generation = collections.Counter()
+        self._counts = collections.Counter()
+        self._max_stale_age = 0.
+        self._listening = False
+        self._closed = False
+        self._pubsub = None
+        db = redis_client.connection_pool.connection_kwargs.get("db", 0)
+        self._channel_prefix = f"__keyspace@{db}__:"
+        # without a prefix, subscribe key by key (_wanted) rather than to everything
+        self._pattern = f"{self._channel_prefix}{prefix}*" if prefix else None
+        self._wanted = set()
+        self._subscribed = set()
+        if self._notifications_enabled(configure_notifications):
+            self._thread = threading.Thread(target=self._listen, daemon=True,
+                                            name="redis-md-invalidation")
+            self._thread.start()
+        else:
+            self._thread = None
+
+    @classmethod
+    def wrap(cls, md, **kwargs):
+        "Cache an existing RedisJSONDict (same client and prefix)."
+        return cls(md._redis_client, md._prefix, **kwargs)
+
+    # -- notifications -----------------------------------------------------
+
+    def _notifications_enabled(self, configure):
+        try:
+            flags = self._redis_client.config_get("notify-keyspace-events").get(
+                "notify-keyspace-events", "")
+        except Exception as err:
+            # e.g. CONFIG is disabled on a managed server; without knowing
+            # that notifications arrive, the cache can not be trusted
+            logger.warning("Can not read notify-keyspace-events (%s); RE.md reads will not be cached",
+                           err)
+            return False
+        if isinstance(flags, bytes):
+            flags = flags.decode()
+        if "K" in flags and ("A" in flags or ("$" in flags and "g" in flags)):
+            return True
+        if configure:
+            new_flags = "".join(sorted(set(flags) | set("K$g")))
+            self._redis_client.config_set("notify-keyspace-events", new_flags)
+            return True
+        print("Redis keyspace notifications are off; RE.md reads will not be cached"
+              + ("" if self.max_age is None else f" for more than {self.max_age} s"))
+        return False
+
+    def _listen(self):
+        while not self._closed:
+            self._pubsub = self._redis_client.pubsub()
+            try:
+                if self._pattern is not None:
+                    self._pubsub.psubscribe(self._pattern)
+                else:
+                    # each key is trusted once its own subscription is confirmed
+                    self._listening = True
+                while not self._closed:
+                    self._subscribe_wanted()
+                    message = self._pubsub.get_message(timeout=_POLL_INTERVAL)
+                    if message is not None:
+                        self._on_message(message)
+            except Exception as err:
+                if self._closed:
+                    break
+                self._listening = False
+                self.invalidate()
+                logger.warning("Lost Redis keyspace notifications (%s); retrying in %s s",
+                               err, self.retry_interval)
+                time.sleep(self.retry_interval)
+            finally:
+                self._listening = False
+                with self._lock:
+                    self._subscribed.clear()
+                try:
+                    self._pubsub.close()
+                except Exception:
+                    pass
+
+    def _subscribe_wanted(self):
+        if self._pattern is not None:
+            return
+        with self._lock:
+            new = self._wanted - self._subscribed
+        if new:
+            self._pubsub.subscribe(*(f"{self._channel_prefix}{key}" for key in new))
+
+    def _want(self, key):
+        if self._pattern is None and self._thread is not None:
+            self._wanted.add(key)
+
+    def _on_message(self, message):
+        if message["type"] == "psubscribe":
+            # Anything may have changed while we were not listening.
+            self.invalidate()
+            self._listening = True
+        elif message["type"] == "subscribe":
+            key = self._key(message["channel"])
+            with self._lock:
+                self._subscribed.add(key)
+                self._drop(key)
+        elif message["type"] in ("pmessage", "message"):
+            self._on_notification(message)
+
+    def _key(self, channel):
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        return channel[len(self._channel_prefix) + len(self._prefix):]
+
+    def _on_notification(self, message):
+        event = message["data"]
+        if isinstance(event, bytes):
+            event = event.decode()
+        if event not in _INVALIDATING_EVENTS:
+            return
+        key = self._key(message["channel"])
+        with self._lock:
+            entry = self._cache.get(key)
+            generation = self._generation[key]
+            if entry is None and self._keys is None:
+                # nothing to compare; this also keeps an in-flight _fetch
+                # from caching the value from before the event
+                self._drop(key)
+                return
+        # Compare values rather than counting our own writes: the echo of a
+        # write we made leaves the cache as it is, anything else drops the key.
+        raw = self._redis_client.get(f"{self._prefix}{key}")
+        current = _ABSENT if raw is None else orjson.loads(raw)
+        with self._lock:
+            if self._generation[key] != generation:
+                # written or dropped here meanwhile; that is newer than this event
+                return
+            if entry is None or current != entry[0]:
+                self._drop(key)
+            if self._keys is not None:
+                if current is _ABSENT:
+                    self._keys.discard(key)
+                else:
+                    self._keys.add(key)
+
+    def _drop(self, key):
+        self._generation[key] += 1
+        if self._cache.pop(key, None) is not None:
+            self._counts["invalidations"] += 1
+
+    def invalidate(self, key=None):
+        "Forget one key, or everything."
+        with self._lock:
+            if key is None:
+                for k in list(self._cache):
+                    self._drop(k)
+                self._keys = None
+            else:
+                self._drop(key)
+
+    def close(self):
+        "Stop the listener thread; reads then go straight to Redis."
+        self._closed = True
+        self._listening = False
+        if self._thread is not None:
+            self._thread.join(2 * _POLL_INTERVAL)
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+
+    # -- reads -------------------------------------------------------------
+
+    def _trusted(self, key):
+        "Whether a change of *key* would reach us as a notification."
+        return self._listening and (self._pattern is not None or key in self._subscribed)
+
+    def _fresh(self, key, entry, now):
+        if entry is None:
+            return False
+        if self._trusted(key):
+            return self.max_age is None or now - entry[1] < self.max_age
+        return self.max_age is not None and now - entry[1] < self.max_age
+
+    def _fetch(self, key):
+        with self._lock:
+            generation = self._generation[key]
+            self._want(key)
+        raw = self._redis_client.get(f"{self._prefix}{key}")
+        value = _ABSENT if raw is None else orjson.loads(raw)
+        with self._lock:
+            # a notification that arrived during the GET wins
+            if self._generation[key] == generation and (self._listening or self.max_age):
+                self._cache[key] = (value, time.monotonic())
+        return value
+
+    def _verify(self, key, entry, now):
+        raw = self._redis_client.get(f"{self._prefix}{key}")
+        current = _ABSENT if raw is None else orjson.loads(raw)
+        self._counts["verified"] += 1
+        if current != entry[0]:
+            self._counts["stale"] += 1
+            self._max_stale_age = max(self._max_stale_age, now - entry[1])
+            self.invalidate(key)
+            return current
+        return entry[0]
+
+    def _observed(self, key, value):
+        if value is _ABSENT:
+            raise KeyError(key)
+        if isinstance(value, (dict, list)):
+            # same contract as RedisJSONDict: mutating the result writes it back
+            def sync():
+                self[key] = observed
+
+            observed = observe(copy.deepcopy(value), sync)
+            return observed
+        return value
+
+    def __getitem__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            fresh = self._fresh(key, entry, now)
+            if fresh:
+                self._counts["hits"] += 1
+                verify = self.verify_every and self._counts["hits"] % self.verify_every == 0
+        if not fresh:
+            self._counts["misses"] += 1
+            return self._observed(key, self._fetch(key))
+        if verify:
+            return self._observed(key, self._verify(key, entry, now))
+        return self._observed(key, entry[0])
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._keys) if self._keys is not None and self._listening else None
+        if keys is None:
+            keys = list(super().__iter__())
+            with self._lock:
+                # without a prefix new keys are not notified, so always list
+                if self._listening and self._pattern is not None:
+                    self._keys = set(keys)
+        yield from keys
+
+    # -- writes (Redis first, then the cache) --------------------------------
+
+    def _cache_write(self, key, raw):
+        self._want(key)
+        self._generation[key] += 1
+        self._counts["writes"] += 1
+        if self._listening or self.max_age:
+            self._cache[key] = (orjson.loads(raw), time.monotonic())
+        if self._keys is not None:
+            self._keys.add(key)
+
+    def __setitem__(self, key, value):
+        raw = _dumps(value)
+        with self._lock:
+            self._redis_client.set(f"{self._prefix}{key}", raw)
+            self._cache_write(key, raw)
+
+    def update(self, d):
+        raws = {key: _dumps(value) for key, value in d.items()}
+        with self._lock:
+            pipe = self._redis_client.pipeline()
+            for key, raw in raws.items():
+                pipe.set(f"{self._prefix}{key}", raw)
+            pipe.execute()
+            for key, raw in raws.items():
+                self._cache_write(key, raw)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._redis_client.delete(f"{self._prefix}{key}")
+            self._want(key)
+            self._generation[key] += 1
+            self._cache[key] = (_ABSENT, time.monotonic())
+            if self._keys is not None:
+                self._keys.discard(key)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self)
+            if keys:
+                self._redis_client.delete(*(f"{self._prefix}{key}" for key in keys))
+            self.invalidate()
+
+    # -- metrics -----------------------------------------------------------
+
+    def stats(self):
+        "Cache counters: hit rate, and staleness found by the sampled check."
+        with self._lock:
+            counts = dict(self._counts)
+            reads = counts.get("hits", 0) + counts.get("misses", 0)
+            verified = counts.get("verified", 0)
+            return {
+                "listening": self._listening,
+                "cached_keys": len(self._cache),
+                "hits": counts.get("hits", 0),
+                "misses": counts.get("misses", 0),
+                "hit_rate": counts.get("hits", 0) / reads if reads else 0.,
+                "writes": counts.get("writes", 0),
+                "invalidations": counts.get("invalidations", 0),
+                "verified": verified,
+                "stale": counts.get("stale", 0),
+                "stale_rate": counts.get("stale", 0) / verified if verified else 0.,
+                "max_stale_age": self._max_stale_age,
+            }
+
+
+def _wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(.01)
+    return True
+
+
+def check(client, n=2000):
+    "Exercise the cache against one server and print latency and stats."
+    prefix = f"cached-redis-dict-check-{time.time_ns()}:"
+    md = CachedRedisJSONDict(client, prefix, configure_notifications=True, verify_every=50)
+    plain = RedisJSONDict(client, prefix)
+    other = RedisJSONDict(client, prefix)  # stands in for another session
+    try:
+        if not _wait_until(lambda: md._listening):
+            print("listener did not subscribe; are keyspace notifications supported?")
+            return 1
+        md.update({"cycle": "2026-3", "data_session": "pass-000000", "nested": {"a": [1, 2]}})
+
+        for label, d in (("RedisJSONDict", plain), ("CachedRedisJSONDict", md)):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                d.get("data_session")
+            print(f"{label:>20}: {1e6 * (time.perf_counter() - t0) / n:8.1f} us per read")
+
+        other["data_session"] = "pass-111111"
+        assert _wait_until(lambda: md["data_session"] == "pass-111111"), "missed an external write"
+        md["nested"]["a"].append(3)
+        assert plain["nested"] == {"a": [1, 2, 3]}, "nested write-back"
+        del other["cycle"]
+        assert _wait_until(lambda: "cycle" not in md), "missed an external delete"
+        print("consistency checks passed")
+        print(md.stats())
+    finally:
+        md.close()
+        keys = list(client.scan_iter(match=f"{prefix}*"))
+        if keys:
+            client.delete(*keys)
+    return 0
+
+
+def fake_redis():
+    """
+    fakeredis client for tests and simulators. fakeredis always publishes
+    keyspace events but has no CONFIG GET, so report them as on.
+    """
+    import fakeredis
+
+    class FakeRedis(fakeredis.FakeRedis):
+        def config_get(self, pattern="*", *args, **kwargs):
+            return {"notify-keyspace-events": "KA"}
+
+    return FakeRedis()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--fake", action="store_true", help="use fakeredis instead of a server")
+    args = parser.parse_args(argv)
+    if args.fake:
+        client = fake_redis()
+    else:
+        import redis
+        client = redis.Redis(args.host, args.port)
+    return check(client)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
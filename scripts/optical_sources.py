@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Light sources and shutters of the UV-Vis setup as one tracked state.
+
+The plans used to switch ``LED``, ``UV_shutter``, ``deuterium`` and
+``halogen`` (startup/28-Lights_shutter.py) with unconditional puts, each
+followed by a fixed ``bps.sleep(2)`` or ``bps.sleep(5)``. ``OpticalSources``
+replaces that pattern:
+
+* it keeps the state of every source from its monitor, and ``mv`` only puts
+  the sources whose state would change. A call that changes nothing costs
+  nothing;
+* the puts complete as soon as the IOC accepts them, before the lamp or
+  shutter has responded. So a spectrum is taken before the move, and after
+  it single spectra are taken until their dark-subtracted intensity has
+  departed from that baseline. A transition that does not change the
+  intensity seen by the spectrometer waits its learned settle time instead;
+* from then on the transition is complete when the summed dark-subtracted
+  intensity of two spectra in a row agrees within ``tolerance`` (or within
+  the noise, for weak signals), or after ``max_settle`` more seconds;
+* the time each transition took (e.g. ``UV_shutter:High``) is kept, and the
+  last ``history`` of them are written to *path*. The longest of them is the
+  settle time of the transition; without a spectrometer, or with
+  ``measure=False``, it is simply waited. If none was measured yet,
+  ``default_settle`` is used.
+
+In the session (startup/28-Lights_shutter.py)::
+
+    RE(optical_sources.mv(LED, 'Low', UV_shutter, 'High'))
+    optical_sources.state()
+    optical_sources.profiles()    # {transition: (count, median s, max s)}
+
+Print the learned profiles of a saved file with::
+
+    python scripts/optical_sources.py ~/.cache/xpd/optical_settle.json
+"""
+import argparse
+import json
+import os
+import statistics
+import time as ttime
+
+import bluesky.plan_stubs as bps
+import numpy as np
+
+
+class OpticalSources:
+    """
+    Parameters
+    ----------
+    sources : list of ophyd signals
+        e.g. [LED, UV_shutter, deuterium, halogen], with 'Low' / 'High' states.
+    detector : QEPro, optional
+        Spectrometer used to detect a settled transition, unless mv() is
+        given another. It needs trigger(), sample, dark, collect_mode and
+        num_spectra.
+    path : str, optional
+        JSON file of the measured settle times.
+    tolerance : float, optional
+        Relative change of the summed dark-subtracted intensity that counts
+        as a departure from the baseline, and between two spectra as stable.
+    max_settle, default_settle : float, optional
+        Seconds. max_settle caps the wait for stability once the intensity
+        has departed from the baseline (or the settle time has passed).
+    history : int, optional
+        Number of measured settle times kept per transition.
+    """
+
+    def __init__(self, sources, *, detector=None,
+                 path=os.path.expanduser("~/.cache/xpd/optical_settle.json"),
+                 tolerance=0.01, max_settle=10, default_settle=2, history=20):
+        self.sources = list(sources)
+        self.detector = detector
+        self.path = path
+        self.tolerance = tolerance
+        self.max_settle = max_settle
+        self.default_settle = default_settle
+        self.history = history
+        self._state = {}
+        self._settle = {}
+        for sig in self.sources:
+            sig.subscribe(self._update, run=True)
+        self.load()
+
+    def _update(self, *, value, obj, **kwargs):
+        self._state[obj.name] = value
+
+    def state(self):
+        "{source name: state} as last reported by the monitors."
+        return dict(self._state)
+
+    def mv(self, *args, settle=True, measure=True, detector=None):
+        """
+        Plan: move the sources like bps.mv(LED, 'Low', UV_shutter, 'High', ...),
+        skipping those already there, then wait for the transition to settle
+        (unless settle=False, e.g. when switching everything off at the end).
+        *detector* overrides the spectrometer given at construction, e.g. the
+        det2 of xray_uvvis_plan. Returns the seconds waited.
+        """
+        changes = [(sig, value) for sig, value in zip(args[0::2], args[1::2])
+                   if self._state.get(sig.name) != value]
+        if not changes:
+            return 0.
+        moves = [item for change in changes for item in change]
+        if not settle:
+            yield from bps.mv(*moves)
+            return 0.
+        transitions = [f"{sig.name}:{value}" for sig, value in changes]
+        settle_time = max(self.settle_time(t) for t in transitions)
+        det = self.detector if detector is None else detector
+        if measure and det is not None:
+            elapsed = yield from self._wait_stable(det, moves, settle_time)
+            for transition in transitions:
+                self._record(transition, elapsed)
+            self.save()
+        else:
+            yield from bps.mv(*moves)
+            elapsed = settle_time
+            yield from bps.sleep(elapsed)
+        return elapsed
+
+    def settle_time(self, transition):
+        "The longest kept settle time of *transition* ('UV_shutter:High'), or default_settle."
+        times = self._settle.get(transition)
+        return max(times) if times else self.default_settle
+
+    def _wait_stable(self, det, moves, settle_time):
+        settings = {det.collect_mode: 'Single', det.num_spectra: 1}
+        restore = {sig: sig.get() for sig in settings}
+        for sig, value in settings.items():
+            yield from bps.abs_set(sig, value, wait=True)
+        baseline, noise = yield from self._intensity(det)
+        yield from bps.mv(*moves)
+        t0 = ttime.monotonic()
+        checking = None  # elapsed s when the stability check started
+        previous = None
+        while True:
+            total, noise = yield from self._intensity(det, noise)
+            elapsed = ttime.monotonic() - t0
+            if checking is None:
+                # the hardware has responded once the intensity moved away
+                # from the baseline; if it does not, give it the settle time
+                if self._differ(total, baseline, noise) or elapsed >= settle_time:
+                    checking = elapsed
+            elif not self._differ(total, previous, noise):
+                break
+            elif elapsed - checking > self.max_settle:
+                print(f"Light sources not stable after {elapsed:.1f} s, going on.")
+                break
+            previous = total
+        for sig, value in restore.items():
+            yield from bps.abs_set(sig, value, wait=True)
+        return elapsed
+
+    def _differ(self, a, b, noise):
+        return abs(a - b) > max(self.tolerance * abs(b), 5 * noise)
+
+    def _intensity(self, det, noise=0.):
+        """
+        Plan: take one spectrum and return its summed intensity above the
+        dark, and the larger of *noise* and this spectrum's noise on that sum
+        (from the pixel-to-pixel scatter, so weak signals do not count as
+        changing).
+        """
+        yield from bps.trigger(det, wait=True)
+        spectrum = np.asarray(det.sample.get(), dtype=float)
+        dark = np.asarray(det.dark.get(), dtype=float)
+        if dark.shape == spectrum.shape:
+            spectrum = spectrum - dark
+        sigma = 1.4826 * np.median(np.abs(np.diff(spectrum))) / np.sqrt(2)
+        return float(np.sum(spectrum)), max(noise, float(sigma * np.sqrt(spectrum.size)))
+
+    def _record(self, transition, elapsed):
+        times = self._settle.setdefault(transition, [])
+        times.append(round(elapsed, 3))
+        del times[:-self.history]
+
+    def profiles(self):
+        return summarize(self._settle)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self._settle, f, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self._settle = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            print(f"Ignoring unreadable settle profiles {self.path}: {err}")
+
+
+def summarize(settle):
+    "{transition: (count, median s, max s)}"
+    return {transition: (len(times), statistics.median(times), max(times))
+            for transition, times in sorted(settle.items()) if times}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', nargs='?', default=os.path.expanduser("~/.cache/xpd/optical_settle.json"))
+    args = parser.parse_args(argv)
+
+    with open(args.path) as f:
+        settle = json.load(f)
+    print(f"{'transition':<24s} {'count':>6s} {'median s':>9s} {'max s':>7s}")
+    for transition, (n, median, longest) in summarize(settle).items():
+        print(f"{transition:<24s} {n:6d} {median:9.2f} {longest:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
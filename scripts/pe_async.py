@@ -0,0 +1,295 @@
+"""ophyd-async PerkinElmer detector for multi-frame acquisition.
+
+The ophyd 1 PE devices in startup/80-areadetector.py (pe1c, pe2c, ...) are
+triggered one set at a time from Python: ``ContinuousAcquisitionTrigger``
+arms the TIFF plugin, waits for ``num_captured`` and fires ``write_file``
+from a CA callback. ``PerkinElmerAsync`` is a ``StandardDetector`` instead:
+``prepare`` sets up N frames (internally timed or one per external trigger),
+``kickoff`` starts the driver and the file writer once and ``complete`` /
+``collect`` report the frames as they are written, as StreamResource /
+StreamDatum documents, without a Python round trip per frame. Several
+detectors can be prepared and kicked off together; see
+``pe_multi_frame_count``.
+
+Instances are made in startup/80-areadetector.py (pe1a, pe2a). Run
+simulators/14-pe-async-sim.py, or ``python scripts/pe_async.py``, to try it
+against ophyd-async's mock signal backend.
+"""
+import asyncio
+import datetime
+import uuid
+from pathlib import PurePosixPath, PureWindowsPath
+from typing import Annotated as A
+
+import bluesky.plan_stubs as bps
+import bluesky.preprocessors as bpp
+from bluesky.utils import short_uid
+from ophyd_async.core import (
+    DEFAULT_TIMEOUT,
+    DetectorTrigger,
+    PathInfo,
+    PathProvider,
+    SignalRW,
+    SubsetEnum,
+    TriggerInfo,
+)
+from ophyd_async.epics import adcore
+from ophyd_async.epics.core import PvSuffix
+from ophyd_async.plan_stubs import ensure_connected
+
+# The panel reads out while it integrates the next frame; this is only the
+# margin asked of an external trigger source between frames.
+PE_DEADTIME = 0.002
+
+
+class PerkinElmerTriggerMode(SubsetEnum):
+    "The TriggerMode choices of ADPerkinElmer used here."
+    INTERNAL = "Internal"
+    EXTERNAL = "External"
+
+
+class PerkinElmerDriverIO(adcore.ADBaseIO):
+    "cam1: records of ADPerkinElmer used here (PerkinElmer.template)."
+
+    trigger_mode: A[SignalRW[PerkinElmerTriggerMode], PvSuffix.rbv("TriggerMode")]
+
+
+class PerkinElmerController(adcore.ADBaseController[PerkinElmerDriverIO]):
+    "Arms the PE driver for a fixed number of frames."
+
+    def get_deadtime(self, exposure):
+        return PE_DEADTIME
+
+    async def prepare(self, trigger_info: TriggerInfo) -> None:
+        if trigger_info.trigger == DetectorTrigger.INTERNAL:
+            trigger_mode = PerkinElmerTriggerMode.INTERNAL
+        elif trigger_info.trigger == DetectorTrigger.EDGE_TRIGGER:
+            trigger_mode = PerkinElmerTriggerMode.EXTERNAL
+        else:
+            raise ValueError(f"PerkinElmer can not be triggered by {trigger_info.trigger}")
+        self.frame_timeout = DEFAULT_TIMEOUT + (
+            trigger_info.livetime or await self.driver.acquire_time.get_value())
+        await self.set_exposure_time_and_acquire_period_if_supplied(trigger_info.livetime)
+        # 0 frames means acquire until disarmed
+        if trigger_info.total_number_of_exposures == 0:
+            image_mode = adcore.ADImageMode.CONTINUOUS
+        else:
+            image_mode = adcore.ADImageMode.MULTIPLE
+        await asyncio.gather(
+            self.driver.trigger_mode.set(trigger_mode),
+            self.driver.num_images.set(trigger_info.total_number_of_exposures),
+            self.driver.image_mode.set(image_mode),
+        )
+
+
+class XPDPathProvider(PathProvider):
+    """
+    Same directories as XPDTIFFPlugin.update_paths: the IOC writes to J:\\
+    on its Windows host and the files are read back from /nsls2/data/xpd-new.
+    ``get_md`` returns the current RE.md, read when a run is prepared.
+    """
+
+    def __init__(self, get_md, *, write_root="J:\\", read_root="/nsls2/data/xpd-new/"):
+        self.get_md = get_md
+        self.write_root = write_root
+        self.read_root = read_root
+
+    def __call__(self, device_name=None):
+        md = self.get_md()
+        leaf = datetime.datetime.now().strftime(
+            f"proposals/{md['cycle']}/{md['data_session']}/assets/{device_name}/%Y/%m/%d")
+        return PathInfo(
+            directory_path=PureWindowsPath(self.write_root, *leaf.split("/")),
+            directory_uri=f"file://localhost{PurePosixPath(self.read_root, leaf)}/",
+            filename=str(uuid.uuid4()),
+            create_dir_depth=-3,  # the %Y/%m/%d part
+        )
+
+
+class PerkinElmerAsync(adcore.AreaDetector[PerkinElmerController]):
+    """
+    PerkinElmer panel as an ophyd-async StandardDetector.
+
+    Writes TIFFs through TIFF1: by default, like pe1c/pe2c; pass
+    ``writer_cls=adcore.ADHDFWriter`` to write through HDF1: instead.
+    """
+
+    def __init__(self, prefix, path_provider, *, drv_suffix="cam1:",
+                 writer_cls=adcore.ADTIFFWriter, fileio_suffix=None, name="",
+                 config_sigs=(), plugins=None):
+        driver = PerkinElmerDriverIO(prefix + drv_suffix)
+        controller = PerkinElmerController(driver)
+        writer = writer_cls.with_io(
+            prefix,
+            path_provider,
+            dataset_source=driver,
+            fileio_suffix=fileio_suffix,
+            plugins=plugins,
+        )
+        super().__init__(
+            controller=controller,
+            writer=writer,
+            plugins=plugins,
+            name=name,
+            config_sigs=config_sigs,
+        )
+
+
+def pe_multi_frame_count(dets, num_frames, exposure, *, frames_per_event=1,
+                         trigger=DetectorTrigger.INTERNAL, flush_period=0.5,
+                         stream_name="primary", md=None):
+    """
+    Take *num_frames* frames on every detector in *dets* in one arm.
+
+    Detectors not connected yet are connected first (those on the mock
+    backend are left as they are). All detectors are prepared and kicked off
+    together; the frames are collected every *flush_period* seconds while
+    they are written.
+
+    Parameters
+    ----------
+    dets : list of PerkinElmerAsync
+    num_frames : int
+        Frames per detector.
+    exposure : float
+        Seconds per frame.
+    frames_per_event : int, optional
+        Frames grouped into one event (shape (frames_per_event, y, x)).
+    trigger : DetectorTrigger, optional
+        INTERNAL (default) for frames timed by the panel, EDGE_TRIGGER for
+        one frame per external trigger pulse.
+    flush_period : float, optional
+    stream_name : str, optional
+    md : dict, optional
+
+    Example
+    -------
+    RE(pe_multi_frame_count([pe1a, pe2a], 100, 0.2))
+    """
+    if num_frames % frames_per_event:
+        raise ValueError("num_frames must be a multiple of frames_per_event")
+    trigger_info = TriggerInfo(
+        number_of_events=num_frames // frames_per_event,
+        exposures_per_event=frames_per_event,
+        livetime=exposure,
+        deadtime=PE_DEADTIME,
+        trigger=trigger,
+    )
+    _md = {
+        "detectors": [det.name for det in dets],
+        "plan_name": "pe_multi_frame_count",
+        "plan_args": {"dets": [repr(det) for det in dets], "num_frames": num_frames,
+                      "exposure": exposure, "frames_per_event": frames_per_event,
+                      "trigger": str(trigger)},
+        "num_points": num_frames // frames_per_event,
+        "sp_time_per_frame": exposure,
+        "sp_num_frames": num_frames,
+    }
+    _md.update(md or {})
+
+    @bpp.stage_decorator(dets)
+    @bpp.run_decorator(md=_md)
+    def inner():
+        group = short_uid("prepare")
+        for det in dets:
+            yield from bps.prepare(det, trigger_info, group=group)
+        yield from bps.wait(group=group)
+        yield from bps.declare_stream(*dets, name=stream_name, collect=True)
+        yield from bps.kickoff_all(*dets, wait=True)
+        yield from bps.collect_while_completing(dets, dets, flush_period=flush_period,
+                                                stream_name=stream_name)
+
+    # a no-op for those already connected
+    real = [det for det in dets if getattr(det, "_mock", None) is None]
+    if real:
+        yield from ensure_connected(*real)
+    return (yield from inner())
+
+
+def sim_perkin_elmer(name, prefix="SIM:PE:", frame_shape=(2048, 2048), *, path_provider=None):
+    """
+    A PerkinElmerAsync on the mock signal backend, with callbacks that stand
+    in for the IOC: acquiring produces num_images frames at acquire_period and
+    the file plugin counts them while capturing. It must be connected with
+    ``mock=True`` (e.g. ``init_devices(mock=True)``) before ``sim_ioc`` is
+    called on it.
+    """
+    from pathlib import PurePosixPath as _Path
+    from ophyd_async.core import StaticFilenameProvider, StaticPathProvider
+
+    if path_provider is None:
+        path_provider = StaticPathProvider(StaticFilenameProvider(f"{name}_sim"), _Path("/tmp/pe_sim"))
+    det = PerkinElmerAsync(prefix, path_provider, name=name)
+    det._sim_frame_shape = frame_shape
+    return det
+
+
+def sim_ioc(det):
+    "Make the mock signals of *det* behave like a PE IOC with a file plugin."
+    from ophyd_async.testing import callback_on_mock_put, set_mock_value
+
+    driver, fileio = det.driver, det.fileio
+    y, x = det._sim_frame_shape
+    set_mock_value(driver.array_size_y, y)
+    set_mock_value(driver.array_size_x, x)
+    set_mock_value(driver.data_type, adcore.ADBaseDataType.UINT16)
+    set_mock_value(driver.detector_state, adcore.ADState.IDLE)
+    set_mock_value(driver.acquire_period, 0.01)
+    set_mock_value(fileio.file_path_exists, True)
+
+    async def acquire():
+        await asyncio.sleep(0)  # let the put of acquire=1 land first
+        num = await driver.num_images.get_value()
+        period = max(await driver.acquire_period.get_value(), 1e-3)
+        set_mock_value(driver.detector_state, adcore.ADState.ACQUIRE)
+        n = 0
+        while (num == 0 or n < num) and await driver.acquire.get_value():
+            await asyncio.sleep(period)
+            n += 1
+            if await fileio.capture.get_value():
+                set_mock_value(fileio.num_captured, await fileio.num_captured.get_value() + 1)
+        set_mock_value(driver.acquire, False)
+        set_mock_value(driver.detector_state, adcore.ADState.IDLE)
+
+    def on_acquire(value, wait):
+        if value:
+            asyncio.ensure_future(acquire())
+
+    def on_capture(value, wait):
+        if value:
+            set_mock_value(fileio.num_captured, 0)
+
+    callback_on_mock_put(driver.acquire, on_acquire)
+    callback_on_mock_put(fileio.capture, on_capture)
+    return det
+
+
+def main():
+    "Take 50 frames on two simulated panels at once and print the documents."
+    import collections
+
+    from bluesky import RunEngine
+    from ophyd_async.core import init_devices
+
+    RE = RunEngine()
+    docs = collections.Counter()
+    frames = collections.Counter()
+
+    def count(name, doc):
+        docs[name] += 1
+        if name == "stream_datum":
+            frames[doc["stream_resource"]] += doc["indices"]["stop"] - doc["indices"]["start"]
+
+    RE.subscribe(count)
+    with init_devices(mock=True):
+        sim_pe1 = sim_perkin_elmer("sim_pe1")
+        sim_pe2 = sim_perkin_elmer("sim_pe2")
+    for det in (sim_pe1, sim_pe2):
+        sim_ioc(det)
+    RE(pe_multi_frame_count([sim_pe1, sim_pe2], 50, 0.01))
+    print(dict(docs))
+    print("frames per stream resource:", list(frames.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Batch peak fitting of PL spectra on a process pool.
+
+Used by ``_fitting_in_kafka`` in startup/31-data_analysis.py when it gets a
+whole stream. The models and the worker live in an importable module (not in
+the IPython startup files) so the pool workers can unpickle them.
+
+Each fit gets a wall-clock budget instead of the open-ended ``maxfev=1e6``
+fallback: the model is wrapped so that ``curve_fit`` is interrupted once the
+budget is spent, and that spectrum is reported as timed out.
+
+Rows are split into contiguous chunks, one per worker, and fitted in order
+within a chunk so each fit can start from the previous spectrum's result.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+
+def _1gauss(x, A, x0, sigma):
+    return A * np.exp(-(x - x0) ** 2 / (2 * sigma ** 2))
+
+
+def _1Lorentz(x, A, x0, sigma):
+    return A*sigma**2/((x-x0)**2+sigma**2)
+
+
+def _2gauss(x, A1, x1, s1, A2, x2, s2):
+    return _1gauss(x, A1, x1, s1) + _1gauss(x, A2, x2, s2)
+
+
+def _2Lorentz(x, A1, x1, s1, A2, x2, s2):
+    return _1Lorentz(x, A1, x1, s1) + _1Lorentz(x, A2, x2, s2)
+
+
+MODELS = {f.__name__: f for f in (_1gauss, _1Lorentz, _2gauss, _2Lorentz)}
+
+
+class FitTimeout(RuntimeError):
+    pass
+
+
+def _fit(f, x, y, p0, bounds, maxfev, deadline):
+
+    def budgeted(x, *p):
+        if time.monotonic() > deadline:
+            raise FitTimeout
+        return f(x, *p)
+
+    return curve_fit(budgeted, x, y, p0=p0, bounds=bounds, maxfev=maxfev)
+
+
+def _warm_guess(previous, bounds):
+    lo, hi = bounds
+    return np.clip(previous, lo, hi)
+
+
+def fit_rows(x, rows, *, time_budget=5.0, maxfev=10000, warm_start=True):
+    """
+    Fit a sequence of spectra in order.
+
+    Parameters
+    ----------
+    x : 1-D array
+        Shared x axis.
+    rows : list of (index, y, attempts)
+        ``attempts`` is a list of (model_name, p0, bounds, (i0, i1)) tried in
+        order until one converges; the fit is done on ``x[i0:i1], y[i0:i1]``.
+    time_budget : float
+        Seconds allowed for all attempts of one spectrum.
+    maxfev : int
+        Passed to curve_fit for every attempt.
+    warm_start : bool
+        Try the last converged parameters of the same model before p0.
+
+    Returns
+    -------
+    list of dict with keys index, model, popt, pcov, window, status
+    ('ok', 'failed' or 'timeout') and elapsed.
+    """
+    x = np.asarray(x)
+    last = {}
+    results = []
+    for index, y, attempts in rows:
+        y = np.asarray(y)
+        t0 = time.monotonic()
+        deadline = t0 + time_budget
+        result = {'index': index, 'model': None, 'popt': None, 'pcov': None,
+                  'window': None, 'status': 'failed'}
+
+        for name, p0, bounds, (i0, i1) in attempts:
+            guesses = [p0]
+            if warm_start and name in last:
+                guesses.insert(0, _warm_guess(last[name], bounds))
+            for guess in guesses:
+                try:
+                    popt, pcov = _fit(MODELS[name], x[i0:i1], y[i0:i1], guess,
+                                      bounds, maxfev, deadline)
+                except FitTimeout:
+                    result['status'] = 'timeout'
+                    break
+                except (RuntimeError, ValueError):
+                    continue
+                last[name] = popt
+                result.update(model=name, popt=popt, pcov=pcov, window=(i0, i1), status='ok')
+                break
+            if result['status'] != 'failed':
+                break
+
+        result['elapsed'] = time.monotonic() - t0
+        results.append(result)
+    return results
+
+
+class PLFitPool:
+    """
+    Run ``fit_rows`` over many spectra on a process pool.
+
+    The pool is started on first use and kept for later calls; ``close()``
+    shuts it down. Batches smaller than ``min_rows_for_pool`` are fitted in
+    this process, where starting workers would cost more than it saves.
+    """
+
+    def __init__(self, max_workers=None, *, time_budget=5.0, maxfev=10000,
+                 warm_start=True, min_rows_for_pool=8):
+        self.max_workers = max_workers or max(1, min(8, (os.cpu_count() or 2) - 1))
+        self.time_budget = time_budget
+        self.maxfev = maxfev
+        self.warm_start = warm_start
+        self.min_rows_for_pool = min_rows_for_pool
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            # not fork: the session is threaded (RunEngine, monitors, Tiled
+            # writer) and a forked child could inherit a held lock
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def fit(self, x, rows):
+        "Fit every row; returns the fit_rows results in the order of ``rows``."
+        kwargs = dict(time_budget=self.time_budget, maxfev=self.maxfev,
+                      warm_start=self.warm_start)
+        rows = list(rows)
+        if self.max_workers == 1 or len(rows) < self.min_rows_for_pool:
+            return fit_rows(x, rows, **kwargs)
+
+        n = min(self.max_workers, len(rows))
+        chunks = [rows[i * len(rows) // n:(i + 1) * len(rows) // n] for i in range(n)]
+        futures = [self._pool().submit(fit_rows, x, chunk, **kwargs) for chunk in chunks]
+
+        results = []
+        for chunk, future in zip(chunks, futures):
+            # every fit polices its own budget; this only guards a wedged worker
+            try:
+                results.extend(future.result(timeout=self.time_budget * len(chunk) + 30))
+            except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError):
+                results.extend({'index': index, 'model': None, 'popt': None, 'pcov': None,
+                                'window': None, 'status': 'timeout', 'elapsed': None}
+                               for index, _, _ in chunk)
+                # the worker can not be interrupted; start fresh next time
+                self.close()
+        return results
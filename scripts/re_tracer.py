@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""Per-message timing of a RunEngine, for finding where a slow plan spends
+its time (CA puts, detector waits, document insertion, sleeps, ...).
+
+``RETracer.install(RE)`` chains onto ``RE.msg_hook`` and times, on one clock:
+
+* every Msg the RunEngine executes (its command coroutine, wrapped through
+  ``RE.register_command``), and the time the plan itself spends between two
+  Msgs, recorded as the command ``(plan)``;
+* every status returned by set/trigger/kickoff/complete, from the Msg until
+  the status finishes;
+* every document callback (``RE.subscribe``, including the Tiled inserter),
+  per callback and document name.
+
+Every span is tagged with the ``plan_name`` of the open run (``(no run)``
+outside of one) and the name of the Msg's device. ``summary`` aggregates
+them per plan, device or command; ``save`` writes a Chrome trace (open in
+chrome://tracing or https://ui.perfetto.dev) and ``save_collapsed`` the
+``plan;command;device`` stacks for flamegraph.pl / speedscope. In the
+session (startup/970-load.py)::
+
+    re_tracer.install(RE)
+    RE(xray_uvvis_plan(...))
+    re_tracer.print_summary('device')
+    re_tracer.save('uvvis.trace.json')
+    re_tracer.uninstall()
+
+A saved trace can be summarised or collapsed later::
+
+    python scripts/re_tracer.py summary uvvis.trace.json --by command
+    python scripts/re_tracer.py collapse uvvis.trace.json > uvvis.folded
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time as ttime
+
+# Msgs whose return value is a status object worth following
+STATUS_COMMANDS = ('set', 'trigger', 'kickoff', 'complete', 'prepare')
+
+# lane is the Chrome trace thread; parent is the 'command device' of the Msg
+# a callback ran in (the emitting Msg), '' otherwise
+Span = collections.namedtuple('Span', 'lane kind name device plan t0 t1 parent')
+
+NO_RUN = '(no run)'
+PLAN_GAP = '(plan)'
+
+
+def _device_name(obj):
+    if obj is None:
+        return ''
+    return getattr(obj, 'name', None) or type(obj).__name__
+
+
+def _callback_name(func):
+    "A readable name for what sits in a CallbackRegistry (usually a proxy)."
+    klass = getattr(func, 'klass', None)
+    func = getattr(func, 'func', func)
+    name = getattr(func, '__qualname__', None)
+    if name is None:  # a callable object, e.g. BestEffortCallback()
+        return type(func).__name__
+    if klass is not None and '.' not in name:
+        return f'{klass.__name__}.{name}'
+    return name
+
+
+class RETracer:
+    """
+    Records a ``Span`` for every Msg, status and document callback of the
+    RunEngine(s) it is installed on. Times are ``time.perf_counter`` seconds;
+    ``epoch`` maps them to unix time for the trace.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._installed = {}
+        self._runs = []  # [(run_start uid, plan_name)] of the open runs
+        self._last_end = None  # end of the previous Msg, start of plan time
+        self._current = ''  # the Msg being executed, parent of callbacks
+        self.epoch = ttime.time() - ttime.perf_counter()
+
+    # ---- recording
+
+    @property
+    def plan(self):
+        return self._runs[-1][1] if self._runs else NO_RUN
+
+    def _add(self, *args, parent=''):
+        span = Span(*args, parent)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def _msg_hook(self, msg):
+        now = ttime.perf_counter()
+        if self._last_end is not None:
+            self._add('RunEngine', 'plan', PLAN_GAP, '', self.plan, self._last_end, now)
+        self._last_end = None
+
+    def _state_hook(self, new_state, old_state):
+        if new_state == 'idle':  # no plan time across RE calls
+            self._last_end = None
+
+    def _wrap_command(self, command, coro):
+        tracer = self
+
+        async def traced(msg):
+            plan = tracer.plan
+            device = _device_name(msg.obj)
+            tracer._current = f'{command} {device}'.rstrip()
+            t0 = ttime.perf_counter()
+            try:
+                ret = await coro(msg)
+            finally:
+                t1 = tracer._last_end = ttime.perf_counter()
+                tracer._current = ''
+                if command == 'open_run':
+                    plan = tracer.plan
+                tracer._add('RunEngine', 'msg', command, device, plan, t0, t1)
+            if command in STATUS_COMMANDS and hasattr(ret, 'add_callback'):
+                def done(status=None):
+                    tracer._add(f'status {device}', 'status', command, device, plan,
+                                t0, ttime.perf_counter())
+
+                ret.add_callback(done)
+            return ret
+
+        traced.__wrapped__ = coro
+        return traced
+
+    def _track_runs(self, name, doc):
+        if name == 'start':
+            self._runs.append((doc['uid'], doc.get('plan_name', '?')))
+        elif name == 'stop':
+            self._runs = [run for run in self._runs if run[0] != doc['run_start']]
+
+    def _wrap_process(self, registry):
+        # CallbackRegistry.process, timing each callback on its own
+        tracer = self
+        real_process = registry.process
+
+        def process(sig, *args, **kwargs):
+            if registry.allowed_sigs is not None and sig not in registry.allowed_sigs:
+                return real_process(sig, *args, **kwargs)
+            name, doc = args
+            if name == 'start':
+                tracer._track_runs(name, doc)
+            plan = tracer.plan
+            exceptions = []
+            for cid, func in list(registry.callbacks.get(sig, {}).items()):  # noqa: B007
+                t0 = ttime.perf_counter()
+                try:
+                    func(*args, **kwargs)
+                except ReferenceError:
+                    registry._remove_proxy(func)
+                except Exception as e:
+                    if registry.ignore_exceptions:
+                        exceptions.append((e, sys.exc_info()[2]))
+                    else:
+                        raise
+                finally:
+                    tracer._add('callbacks', 'callback', f'{name} {_callback_name(func)}',
+                                '', plan, t0, ttime.perf_counter(), parent=tracer._current)
+            if name == 'stop':
+                tracer._track_runs(name, doc)
+            return exceptions
+
+        process.__wrapped__ = real_process
+        return process
+
+    def install(self, RE):
+        "Start tracing *RE*; the RE's own msg_hook, if any, keeps being called."
+        if id(RE) in self._installed:
+            return
+        prev_hooks = RE.msg_hook, RE.state_hook
+        msg_hook, state_hook = (
+            _chain(new, prev) for new, prev in zip((self._msg_hook, self._state_hook), prev_hooks))
+        commands = dict(RE._command_registry)
+        for command, coro in commands.items():
+            RE.register_command(command, self._wrap_command(command, coro))
+        registry = RE.dispatcher.cb_registry
+        registry.process = self._wrap_process(registry)
+        RE.msg_hook, RE.state_hook = msg_hook, state_hook
+        self._installed[id(RE)] = (RE, prev_hooks, commands)
+
+    def uninstall(self, RE=None):
+        "Stop tracing *RE* (every RE when None); the spans are kept."
+        for key, (_RE, prev_hooks, commands) in list(self._installed.items()):
+            if RE is not None and _RE is not RE:
+                continue
+            for command, coro in commands.items():
+                _RE.register_command(command, coro)
+            del _RE.dispatcher.cb_registry.process
+            _RE.msg_hook, _RE.state_hook = prev_hooks
+            del self._installed[key]
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+        self._last_end = None
+
+    # ---- reports
+
+    def summary(self, by='command'):
+        return summarize(self.spans, by)
+
+    def print_summary(self, by='command', top=30):
+        print_summary(self.spans, by, top)
+
+    def chrome_trace(self):
+        return chrome_trace(self.spans, self.epoch)
+
+    def save(self, path):
+        "Write the spans as a Chrome trace (JSON)."
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def save_collapsed(self, path):
+        "Write the spans as collapsed stacks for flamegraph.pl / speedscope."
+        with open(path, 'w') as f:
+            f.writelines(line + '\n' for line in collapsed(self.spans))
+
+
+def _chain(hook, prev):
+    "*hook*, then the hook it replaces (if any)."
+    if prev is None:
+        return hook
+
+    def chained(*args):
+        hook(*args)
+        prev(*args)
+    return chained
+
+
+def _key(span, by):
+    if by == 'plan':
+        return span.plan
+    if by == 'device':
+        return span.device or f'({span.kind})'
+    if by == 'command':
+        return span.name if span.kind != 'status' else f'{span.name} (status)'
+    raise ValueError(f"by must be 'plan', 'device' or 'command', not {by!r}")
+
+
+def summarize(spans, by='command'):
+    """
+    {key: (count, total s, max s)} per plan, device or command, largest total
+    first. Status and callback spans overlap the Msgs that wait for them, so
+    totals across kinds do not add up to the wall time.
+    """
+    stats = {}
+    for span in spans:
+        key = (_key(span, by), span.kind)
+        n, total, longest = stats.get(key, (0, 0., 0.))
+        dt = span.t1 - span.t0
+        stats[key] = (n + 1, total + dt, max(longest, dt))
+    return dict(sorted(stats.items(), key=lambda kv: -kv[1][1]))
+
+
+def print_summary(spans, by='command', top=30):
+    rows = list(summarize(spans, by).items())
+    print(f"{by:<40s} {'kind':<9s} {'count':>7s} {'total s':>10s} {'mean ms':>9s} {'max ms':>9s}")
+    for (key, kind), (n, total, longest) in rows[:top]:
+        print(f'{key[:40]:<40s} {kind:<9s} {n:7d} {total:10.3f} '
+              f'{1e3 * total / n:9.2f} {1e3 * longest:9.2f}')
+    if len(rows) > top:
+        print(f'... {len(rows) - top} more')
+
+
+def chrome_trace(spans, epoch=0.):
+    "Chrome trace event format: one complete ('X') event per span."
+    lanes = {}
+    events = []
+    for span in spans:
+        tid = lanes.setdefault(span.lane, len(lanes))
+        events.append({
+            'name': span.name, 'cat': span.kind, 'ph': 'X', 'pid': 0, 'tid': tid,
+            'ts': 1e6 * (span.t0 + epoch), 'dur': 1e6 * (span.t1 - span.t0),
+            'args': {'plan': span.plan, 'device': span.device, 'parent': span.parent},
+        })
+    events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid,
+                   'args': {'name': lane}} for lane, tid in lanes.items())
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def spans_from_chrome_trace(trace):
+    lanes = {e['tid']: e['args']['name'] for e in trace['traceEvents'] if e['ph'] == 'M'}
+    return [Span(lanes.get(e['tid'], ''), e['cat'], e['name'], e['args']['device'],
+                 e['args']['plan'], 1e-6 * e['ts'], 1e-6 * (e['ts'] + e['dur']),
+                 e['args'].get('parent', ''))
+            for e in trace['traceEvents'] if e['ph'] == 'X']
+
+
+def collapsed(spans):
+    """
+    ``plan;command;device <microseconds>`` lines. The Msgs and the plan time
+    between them tile the wall time of the plans; callbacks are stacked under
+    the Msg that emitted their document and taken out of its own time.
+    Status spans overlap the Msgs that wait for them and are left out.
+    """
+    def frames(*names):
+        return ';'.join(n.replace(';', ',').replace(' ', '_') for n in names if n)
+
+    totals = collections.Counter()
+    for span in spans:
+        dt = span.t1 - span.t0
+        if span.kind == 'callback':
+            parent = (span.plan, *span.parent.split(' ', 1))
+            totals[frames(*parent, *span.name.split(' ', 1))] += dt
+            totals[frames(*parent)] -= dt
+        elif span.kind != 'status':
+            totals[frames(span.plan, span.name, span.device)] += dt
+    return [f'{stack} {round(1e6 * dt)}' for stack, dt in totals.most_common()
+            if round(1e6 * dt) > 0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('summary', help='aggregate a saved Chrome trace')
+    p.add_argument('trace')
+    p.add_argument('--by', choices=('plan', 'device', 'command'), default='command')
+    p.add_argument('--top', type=int, default=30)
+    p = sub.add_parser('collapse', help='collapsed stacks of a saved Chrome trace')
+    p.add_argument('trace')
+    args = parser.parse_args(argv)
+
+    with open(os.path.expanduser(args.trace)) as f:
+        spans = spans_from_chrome_trace(json.load(f))
+    if args.cmd == 'summary':
+        print_summary(spans, args.by, args.top)
+    else:
+        for line in collapsed(spans):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
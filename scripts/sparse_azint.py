@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+"""Azimuthal integration as one sparse matrix-vector product.
+
+The pixel-to-bin assignment of a detector geometry (a pyFAI .poni file or
+the ``calibration_md`` dict xpdAcq puts in the start document) only changes
+when the calibration, the mask or the binning does. ``SparseIntegrator``
+builds it once as a CSR matrix whose rows are already weighted by the
+solid angle / polarization normalization, so integrating a frame is
+``matrix @ frame.ravel()``. The matrices are kept on disk under
+``DEFAULT_CACHE_DIR``, keyed by a hash of everything that went into them,
+and in memory for the session.
+
+``LiveIntegrator`` is a RunEngine callback: it fills the image of each
+event from its datum (AD_TIFF / AD_HDF5) as soon as the event is emitted
+and integrates it, so the 1-D pattern is there without waiting for the
+data to be re-read through databroker. The reading and integrating happen
+on a worker thread, so they neither hold up nor (on errors, which are
+logged) abort the scan::
+
+    li = LiveIntegrator('config_base/xrd.poni', npt=3000)
+    RE.subscribe(li)
+    xrun(0, 0)
+    li.join()
+    q, iq = li.last
+
+Binning is per pixel centre (no pixel splitting), with the same
+normalization as pyFAI's integrate1d (sum of counts over sum of solid angle
+times polarization). The geometry comes from pyFAI when it is installed
+(it is with xpdan) and from the same formulas in numpy otherwise.
+
+    python scripts/sparse_azint.py bench --shape 2048 2048 --npt 3000
+"""
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "XPD_AZINT_CACHE", os.path.expanduser("~/.cache/xpd/azint"))
+
+_GEOMETRY_KEYS = ("dist", "poni1", "poni2", "rot1", "rot2", "rot3",
+                  "pixel1", "pixel2", "wavelength")
+
+_memory_cache = collections.OrderedDict()
+_MEMORY_CACHE_SIZE = 8
+
+
+def read_poni(path):
+    "The geometry of a pyFAI .poni file (version 1 or 2) as a dict."
+    geometry = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#") or ":" not in line:
+                continue
+            key, value = (part.strip() for part in line.split(":", 1))
+            key = key.lower()
+            if key == "distance":
+                geometry["dist"] = float(value)
+            elif key in ("poni1", "poni2", "rot1", "rot2", "rot3", "wavelength"):
+                geometry[key] = float(value)
+            elif key == "pixelsize1":
+                geometry["pixel1"] = float(value)
+            elif key == "pixelsize2":
+                geometry["pixel2"] = float(value)
+            elif key == "detector_config":
+                config = json.loads(value)
+                geometry.update({k: config[k] for k in ("pixel1", "pixel2") if k in config})
+    return geometry
+
+
+def geometry_from(calibration):
+    "Accept a .poni path or a calibration dict; return the geometry dict."
+    if isinstance(calibration, (str, os.PathLike)):
+        calibration = read_poni(calibration)
+    missing = [k for k in _GEOMETRY_KEYS if calibration.get(k) is None]
+    if missing:
+        raise ValueError(f"calibration is missing {missing}")
+    return {k: float(calibration[k]) for k in _GEOMETRY_KEYS}
+
+
+def pixel_angles(geometry, shape):
+    """
+    2theta and chi (radians) and the solid angle (relative to a pixel at
+    normal incidence) of every pixel centre.
+    """
+    try:
+        from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+    except ImportError:
+        try:
+            from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+        except ImportError:
+            AzimuthalIntegrator = None
+    if AzimuthalIntegrator is not None:
+        ai = AzimuthalIntegrator(**geometry)
+        tth = ai.center_array(shape, unit="2th_rad")
+        try:
+            chi = ai.center_array(shape, unit="chi_rad")
+        except (KeyError, RuntimeError):  # pyFAI before chi_rad was a unit
+            chi = ai.chiArray(shape)
+        return tth, chi, ai.solidAngleArray(shape, absolute=False)
+    # pyFAI's geometry (Geometry.calc_pos_zyx), for when it is not installed
+    g = geometry
+    d1, d2 = np.indices(shape, dtype=np.float64)
+    p1 = (d1 + 0.5) * g["pixel1"] - g["poni1"]
+    p2 = (d2 + 0.5) * g["pixel2"] - g["poni2"]
+    L = g["dist"]
+    c1, c2, c3 = np.cos([g["rot1"], g["rot2"], g["rot3"]])
+    s1, s2, s3 = np.sin([g["rot1"], g["rot2"], g["rot3"]])
+    t1 = p1 * c2 * c3 + p2 * (c3 * s1 * s2 - c1 * s3) - L * (c1 * c3 * s2 + s1 * s3)
+    t2 = p1 * c2 * s3 + p2 * (c1 * c3 + s1 * s2 * s3) - L * (-c3 * s1 + c1 * s2 * s3)
+    t3 = p1 * s2 - p2 * c2 * s1 + L * c1 * c2
+    tth = np.arctan2(np.hypot(t1, t2), t3)
+    chi = np.arctan2(t1, t2)
+    solid_angle = (L / np.sqrt(t1 ** 2 + t2 ** 2 + t3 ** 2)) ** 3
+    return tth, chi, solid_angle
+
+
+class SparseIntegrator:
+    """
+    1-D azimuthal integration of frames of one shape with one geometry.
+
+    Parameters
+    ----------
+    calibration : str or dict
+        A .poni file or a pyFAI geometry dict (dist, poni1, poni2, rot1-3,
+        pixel1, pixel2, wavelength), e.g. start['calibration_md'].
+    shape : tuple
+        Frame shape, (2048, 2048) for the PE panels.
+    npt : int
+    unit : {'q_A^-1', 'q_nm^-1', '2th_deg'}
+    mask : array of bool, optional
+        True for pixels to leave out (pyFAI's convention).
+    radial_range : (float, float), optional
+        Default: the range covered by the unmasked pixels.
+    polarization_factor : float, optional
+        As in pyFAI; None for no polarization correction.
+    correct_solid_angle : bool
+    cache_dir : str or None
+        None to keep the matrix in memory only.
+    """
+
+    def __init__(self, calibration, shape=(2048, 2048), npt=3000, unit="q_A^-1", *,
+                 mask=None, radial_range=None, polarization_factor=None,
+                 correct_solid_angle=True, cache_dir=DEFAULT_CACHE_DIR):
+        if unit not in ("q_A^-1", "q_nm^-1", "2th_deg"):
+            raise ValueError(f"unit {unit!r} is not supported")
+        self.geometry = geometry_from(calibration)
+        self.shape = tuple(int(n) for n in shape)
+        self.npt = int(npt)
+        self.unit = unit
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.radial_range = None if radial_range is None else tuple(map(float, radial_range))
+        self.polarization_factor = polarization_factor
+        self.correct_solid_angle = correct_solid_angle
+        self.cache_dir = cache_dir
+        self.key = self._key()
+        self.matrix, self.radial, self.loaded_from = self._load_or_build()
+
+    def _key(self):
+        params = {
+            "geometry": self.geometry, "shape": self.shape, "npt": self.npt,
+            "unit": self.unit, "radial_range": self.radial_range,
+            "polarization_factor": self.polarization_factor,
+            "correct_solid_angle": self.correct_solid_angle, "version": 1,
+        }
+        h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+        if self.mask is not None:
+            h.update(np.packbits(self.mask).tobytes())
+        return h.hexdigest()[:20]
+
+    def _load_or_build(self):
+        if self.key in _memory_cache:
+            _memory_cache.move_to_end(self.key)
+            return (*_memory_cache[self.key], "memory")
+        path = self.cache_dir and os.path.join(self.cache_dir, f"{self.key}.npz")
+        if path and os.path.exists(path):
+            matrix, radial = self._read(path)
+            source = path
+        else:
+            matrix, radial = self._build()
+            source = "built"
+            if path:
+                self._write(path, matrix, radial)
+        _memory_cache[self.key] = (matrix, radial)
+        while len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+        return matrix, radial, source
+
+    def _build(self):
+        from scipy import sparse
+
+        tth, chi, solid_angle = pixel_angles(self.geometry, self.shape)
+        if self.unit == "2th_deg":
+            radial = np.degrees(tth)
+        else:
+            wavelength = self.geometry["wavelength"] * (1e10 if self.unit == "q_A^-1" else 1e9)
+            radial = 4 * np.pi * np.sin(tth / 2) / wavelength
+        norm = solid_angle if self.correct_solid_angle else np.ones(self.shape)
+        if self.polarization_factor is not None:
+            f = self.polarization_factor
+            norm = norm * 0.5 * (1 + np.cos(tth) ** 2 - f * np.cos(2 * chi) * np.sin(tth) ** 2)
+        valid = np.ones(self.shape, dtype=bool) if self.mask is None else ~self.mask
+        lo, hi = self.radial_range or (radial[valid].min(), radial[valid].max())
+        edges = np.linspace(lo, hi, self.npt + 1)
+        pixels = np.flatnonzero(valid & (radial >= lo) & (radial <= hi))
+        bins = np.clip(np.searchsorted(edges, radial.ravel()[pixels], side="right") - 1,
+                       0, self.npt - 1)
+        # Row b holds 1 / sum(norm over bin b) for every pixel of the bin, so
+        # matrix @ frame is already sum(counts) / sum(norm) per bin.
+        bin_norm = np.bincount(bins, weights=norm.ravel()[pixels], minlength=self.npt)
+        with np.errstate(divide="ignore"):
+            weights = np.where(bin_norm > 0, 1 / bin_norm, 0)[bins]
+        matrix = sparse.csr_matrix((weights.astype(np.float32), (bins, pixels)),
+                                   shape=(self.npt, int(np.prod(self.shape))))
+        return matrix, (edges[:-1] + edges[1:]) / 2
+
+    @staticmethod
+    def _read(path):
+        from scipy import sparse
+
+        with np.load(path) as f:
+            matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return matrix, f["radial"]
+
+    @staticmethod
+    def _write(path, matrix, radial):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 shape=np.array(matrix.shape), radial=radial)
+        os.replace(tmp, path)
+
+    def integrate(self, frame, dark=None):
+        """
+        Return (radial, intensity) of *frame*; a stack of frames (a squashed
+        PE point, shape (number_of_sets, y, x)) is averaged first.
+        """
+        frame = np.asarray(frame, dtype=np.float32)
+        if frame.ndim == 3:
+            frame = frame.mean(axis=0)
+        if dark is not None:
+            dark = np.asarray(dark, dtype=np.float32)
+            frame = frame - (dark.mean(axis=0) if dark.ndim == 3 else dark)
+        if frame.shape != self.shape:
+            raise ValueError(f"frame shape {frame.shape} does not match {self.shape}")
+        return self.radial, self.matrix @ frame.ravel()
+
+
+def default_handler_registry():
+    from area_detector_handlers.handlers import AreaDetectorHDF5Handler, AreaDetectorTiffHandler
+
+    return {"AD_TIFF": AreaDetectorTiffHandler, "AD_HDF5": AreaDetectorHDF5Handler}
+
+
+class LiveIntegrator:
+    """
+    RunEngine callback integrating every image as soon as its event is out.
+
+    The documents are queued and processed in order on a worker thread;
+    an error there is logged and skips that document, the scan goes on.
+    join() waits until everything received so far is integrated.
+
+    Parameters
+    ----------
+    calibration : str or dict, optional
+        A .poni file or geometry dict; default: the run's
+        start['calibration_md'] (runs without one are skipped).
+    image_key : str, optional
+        Default: the first data key ending in '_image'.
+    on_pattern : callable, optional
+        Called as on_pattern(radial, intensity, event) for each image, on
+        the worker thread.
+    handler_registry : dict, optional
+        Spec -> handler for filling; default AD_TIFF and AD_HDF5 from
+        area_detector_handlers.
+    keep : int
+        Patterns kept in ``patterns`` (newest last).
+    **kwargs
+        Passed on to SparseIntegrator (npt, unit, mask, ...).
+    """
+
+    def __init__(self, calibration=None, *, image_key=None, on_pattern=None,
+                 handler_registry=None, root_map=None, keep=100, **kwargs):
+        self.calibration = calibration
+        self.image_key = image_key
+        self.on_pattern = on_pattern
+        self.handler_registry = handler_registry
+        self.root_map = root_map or {}
+        self.integrator_kwargs = kwargs
+        self.patterns = collections.deque(maxlen=keep)
+        self.integrator = None
+        self._filler = None
+        self._run_geometry = None
+        self._image_keys = {}  # descriptor uid -> image key
+        self.timings = collections.deque(maxlen=1000)
+        self._queue = queue.Queue()
+        self._worker = None
+
+    @property
+    def last(self):
+        "(radial, intensity) of the newest pattern."
+        return self.patterns[-1][1:] if self.patterns else None
+
+    def __call__(self, name, doc):
+        # runs in the RunEngine: only hand the document over
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._work, name="LiveIntegrator", daemon=True)
+            self._worker.start()
+        self._queue.put((name, doc))
+
+    def join(self):
+        "Block until every document received so far has been processed."
+        self._queue.join()
+
+    def _work(self):
+        from event_model import unpack_event_page
+
+        while True:
+            name, doc = self._queue.get()
+            try:
+                if name == "event_page":
+                    documents = [("event", event) for event in unpack_event_page(doc)]
+                else:
+                    documents = [(name, doc)]
+                for name, doc in documents:
+                    try:
+                        self._process(name, doc)
+                    except Exception:
+                        logger.exception("LiveIntegrator: %s %s failed", name, doc.get("uid"))
+            finally:
+                self._queue.task_done()
+
+    def _process(self, name, doc):
+        getattr(self, name, lambda doc: None)(doc)
+        if self._filler is not None and name in ("resource", "datum", "datum_page", "descriptor"):
+            self._filler(name, doc)
+
+    def start(self, doc):
+        from event_model import Filler
+
+        self._filler = None
+        self._image_keys.clear()
+        calibration = self.calibration or doc.get("calibration_md")
+        self._run_geometry = calibration and geometry_from(calibration)
+        if self._run_geometry is None:
+            return
+        self._filler = Filler(self.handler_registry or default_handler_registry(),
+                              root_map=self.root_map, inplace=False)
+        self._filler("start", doc)
+
+    def descriptor(self, doc):
+        if self._filler is None:
+            return
+        keys = [self.image_key] if self.image_key else sorted(
+            k for k in doc["data_keys"] if k.endswith("_image"))
+        if keys and keys[0] in doc["data_keys"]:
+            self._image_keys[doc["uid"]] = keys[0]
+
+    def event(self, doc):
+        key = self._image_keys.get(doc["descriptor"])
+        if key is None:
+            return
+        t0 = time.perf_counter()
+        _, filled = self._filler("event", doc)
+        frame = filled["data"][key]
+        shape = np.shape(frame)[-2:]
+        if (self.integrator is None or self.integrator.shape != shape
+                or self.integrator.geometry != self._run_geometry):
+            self.integrator = SparseIntegrator(self._run_geometry, shape,
+                                               **self.integrator_kwargs)
+        radial, intensity = self.integrator.integrate(frame)
+        self.timings.append(time.perf_counter() - t0)
+        self.patterns.append((doc["uid"], radial, intensity))
+        if self.on_pattern is not None:
+            self.on_pattern(radial, intensity, doc)
+
+    def stop(self, doc):
+        if self._filler is not None:
+            self._filler("stop", doc)
+            self._filler = None
+
+
+def _demo_geometry(shape):
+    return {"dist": 0.2, "poni1": shape[0] * 0.0002 / 2, "poni2": shape[1] * 0.0002 / 2,
+            "rot1": 0.01, "rot2": -0.005, "rot3": 0.0, "pixel1": 0.0002, "pixel2": 0.0002,
+            "wavelength": 1.8e-11}
+
+
+def bench(shape, npt, repeat, cache_dir):
+    "Time building, loading and applying the matrix for a PE-like geometry."
+    geometry = _demo_geometry(shape)
+    rng = np.random.default_rng(0)
+    frame = rng.poisson(100, size=shape).astype(np.uint16)
+
+    _memory_cache.clear()
+    t0 = time.perf_counter()
+    si = SparseIntegrator(geometry, shape, npt, cache_dir=cache_dir)
+    print(f"matrix ({si.loaded_from}): {time.perf_counter() - t0:.2f} s, "
+          f"{si.matrix.nnz} entries, {si.matrix.data.nbytes * 2 / 1e6:.0f} MB")
+    if cache_dir:
+        _memory_cache.clear()
+        t0 = time.perf_counter()
+        si = SparseIntegrator(geometry, shape, npt, cache_dir=cache_dir)
+        print(f"matrix ({si.loaded_from}): {time.perf_counter() - t0:.2f} s")
+    si.integrate(frame)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        si.integrate(frame)
+    print(f"integrate: {(time.perf_counter() - t0) / repeat * 1e3:.1f} ms per frame")
+    try:
+        from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+    except ImportError:
+        return
+    ai = AzimuthalIntegrator(**geometry)
+    ai.integrate1d(frame, npt, unit="q_A^-1", method=("no", "histogram", "cython"))
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        res = ai.integrate1d(frame, npt, unit="q_A^-1", method=("no", "histogram", "cython"))
+    print(f"pyFAI integrate1d (no split, histogram): "
+          f"{(time.perf_counter() - t0) / repeat * 1e3:.1f} ms per frame")
+    radial, intensity = si.integrate(frame)
+    print(f"max relative difference to pyFAI: "
+          f"{np.nanmax(np.abs(intensity - res.intensity) / np.maximum(res.intensity, 1)):.2e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    bp = sub.add_parser("bench", help="time the sparse integration on a synthetic frame")
+    bp.add_argument("--shape", type=int, nargs=2, default=(2048, 2048))
+    bp.add_argument("--npt", type=int, default=3000)
+    bp.add_argument("--repeat", type=int, default=20)
+    bp.add_argument("--cache-dir", default=None, help="also time loading from this cache")
+    ip = sub.add_parser("integrate", help="integrate TIFF files, write .chi next to them")
+    ip.add_argument("poni")
+    ip.add_argument("files", nargs="+")
+    ip.add_argument("--npt", type=int, default=3000)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(tuple(args.shape), args.npt, args.repeat, args.cache_dir)
+    elif args.command == "integrate":
+        import tifffile
+
+        si = None
+        for fn in args.files:
+            frame = tifffile.imread(fn)
+            if si is None:
+                si = SparseIntegrator(args.poni, frame.shape[-2:], args.npt)
+            radial, intensity = si.integrate(frame)
+            np.savetxt(os.path.splitext(fn)[0] + ".chi", np.column_stack([radial, intensity]),
+                       header=f"{si.unit} I")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Whole-stream export of QEPro spectra.
+
+``read_qepro_by_stream`` (startup/32-data_export.py) returns a stream as
+arrays over events; the writers here put all of it in one file instead of one
+CSV per event:
+
+* HDF5 (``write_stream_hdf5``), one group per stream, several streams of a
+  run in the same file::
+
+      /<stream>/QEPro_x_axis        (num_pixels,)            float64, once
+      /<stream>/QEPro_output        (num_events, num_pixels) float32
+      /<stream>/QEPro_sample, QEPro_dark, QEPro_reference    "
+      /<stream>/QEPro_spectrum_type, ..._integration_time,
+                ..._num_spectra, ..._buff_capacity, time      (num_events,)
+
+  with the run metadata (uid, sample_type, pumps, ...) as JSON attributes;
+* Parquet (``write_stream_parquet``), one file per stream: a row per event,
+  the spectra as fixed-size float32 lists and the x axis and metadata in the
+  schema metadata.
+
+``read_stream`` reads either back into the same dict of arrays.
+``write_spectra_csv`` writes the legacy text layout (what the old per-row
+loops wrote, value for value) a column at a time, for consumers that still
+want CSV. Time an export of a 1000-spectrum stream with::
+
+    python scripts/spectra_export.py bench --events 1000
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import tempfile
+import time as ttime
+
+import numpy as np
+
+SPECTRA_KEYS = ('QEPro_output', 'QEPro_sample', 'QEPro_dark', 'QEPro_reference')
+SCALAR_KEYS = ('QEPro_spectrum_type', 'QEPro_integration_time', 'QEPro_num_spectra',
+               'QEPro_buff_capacity', 'time')
+X_AXIS_KEY = 'QEPro_x_axis'
+
+
+def columnar(qepro_dic):
+    """
+    Split a stream into the x axis (1-D if it is the same for every event,
+    else 2-D), the spectra as 2-D float32 and the per-event scalars.
+    """
+    x_axis = np.atleast_2d(np.asarray(qepro_dic[X_AXIS_KEY], dtype=np.float64))
+    if (x_axis == x_axis[0]).all():
+        x_axis = x_axis[0]
+    spectra = {k: np.atleast_2d(np.asarray(qepro_dic[k], dtype=np.float32))
+               for k in SPECTRA_KEYS if k in qepro_dic}
+    scalars = {k: np.atleast_1d(np.asarray(qepro_dic[k]))
+               for k in SCALAR_KEYS if k in qepro_dic}
+    return x_axis, spectra, scalars
+
+
+def _json_attrs(metadata_dic):
+    return {k: json.dumps(v, default=str) for k, v in metadata_dic.items()}
+
+
+def write_stream_hdf5(path, qepro_dic, metadata_dic, stream_name='primary'):
+    "Write (or replace) group *stream_name* of the HDF5 file at *path*."
+    import h5py
+
+    x_axis, spectra, scalars = columnar(qepro_dic)
+    with h5py.File(path, 'a') as f:
+        if stream_name in f:
+            del f[stream_name]
+        group = f.create_group(stream_name)
+        group.attrs.update(_json_attrs(metadata_dic))
+        group.create_dataset(X_AXIS_KEY, data=x_axis)
+        for k, v in itertools.chain(spectra.items(), scalars.items()):
+            group.create_dataset(k, data=v)
+    return path
+
+
+def write_stream_parquet(path, qepro_dic, metadata_dic, stream_name='primary'):
+    "Write *stream_name* as the Parquet file *path*, a row per event."
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    x_axis, spectra, scalars = columnar(qepro_dic)
+    columns = {k: pa.array(v) for k, v in scalars.items()}
+    for k, v in spectra.items():
+        columns[k] = pa.FixedSizeListArray.from_arrays(pa.array(v.ravel()), v.shape[1])
+    metadata = _json_attrs(dict(metadata_dic, stream_name=stream_name))
+    metadata[X_AXIS_KEY] = json.dumps(x_axis.tolist())
+    table = pa.table(columns).replace_schema_metadata(metadata)
+    pq.write_table(table, path)
+    return path
+
+
+def read_stream(path, stream_name='primary'):
+    """
+    Read a stream written by ``write_stream_hdf5`` or ``write_stream_parquet``
+    back as (qepro_dic, metadata_dic).
+    """
+    if os.path.splitext(path)[1] == '.parquet':
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        metadata = {k.decode(): json.loads(v) for k, v in table.schema.metadata.items()}
+        qepro_dic = {X_AXIS_KEY: np.asarray(metadata.pop(X_AXIS_KEY))}
+        for k in table.column_names:
+            column = table.column(k).combine_chunks()
+            if k in SPECTRA_KEYS:
+                qepro_dic[k] = column.values.to_numpy().reshape(len(column), -1)
+            else:
+                qepro_dic[k] = column.to_numpy()
+        return qepro_dic, metadata
+
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        group = f[stream_name]
+        qepro_dic = {k: group[k][()] for k in group}
+        metadata = {k: json.loads(v) for k, v in group.attrs.items()}
+    return qepro_dic, metadata
+
+
+# formatted text of the last columns written: the x axis, and usually dark and
+# reference, are the same for every event of a stream
+_formatted = collections.OrderedDict()
+_FORMATTED_SIZE = 16
+
+
+def _format_column(values):
+    values = np.asarray(values)
+    key = (values.dtype.str, values.tobytes())
+    text = _formatted.get(key)
+    if text is None:
+        text = _formatted[key] = list(map(repr, values.tolist()))
+        if len(_formatted) > _FORMATTED_SIZE:
+            _formatted.popitem(last=False)
+    else:
+        _formatted.move_to_end(key)
+    return text
+
+
+def write_spectra_csv(fout, header, columns):
+    """
+    Write the lines of *header*, then one comma separated row per pixel of
+    *columns* (1-D arrays of equal length). Values are formatted as the
+    f-string rows of the old writers did, a column at a time, and columns
+    repeated from the previous files are not formatted again.
+    """
+    text = [_format_column(c) for c in columns]
+    with open(fout, 'w') as fp:
+        fp.writelines(line + '\n' for line in header)
+        fp.write('\n'.join(map(','.join, zip(*text))))
+        fp.write('\n')
+    return fout
+
+
+def _fake_stream(num_events, num_pixels=1044):
+    rng = np.random.default_rng(0)
+    qepro_dic = {X_AXIS_KEY: np.tile(np.linspace(200, 1000, num_pixels), (num_events, 1))}
+    for k in SPECTRA_KEYS:
+        qepro_dic[k] = rng.random((num_events, num_pixels))
+    qepro_dic.update({'QEPro_spectrum_type': np.full(num_events, 2),
+                      'QEPro_integration_time': np.full(num_events, 100),
+                      'QEPro_num_spectra': np.full(num_events, 16),
+                      'QEPro_buff_capacity': np.full(num_events, 3),
+                      'time': ttime.time() + np.arange(num_events)})
+    metadata_dic = {'uid': 'bench', 'sample_type': 'bench', 'pumps': ['dds1_p1'],
+                    'precursors': ['CsPbOA'], 'infuse_rate': [100]}
+    return qepro_dic, metadata_dic
+
+
+def bench(num_events, directory):
+    "Time every format on a stream of *num_events* spectra."
+    qepro_dic, metadata_dic = _fake_stream(num_events)
+    writers = [('hdf5', '.h5', write_stream_hdf5), ('parquet', '.parquet', write_stream_parquet)]
+    for label, ext, writer in writers:
+        path = os.path.join(directory, f'bench{ext}')
+        try:
+            t0 = ttime.perf_counter()
+            writer(path, qepro_dic, metadata_dic, 'fluorescence')
+            dt = ttime.perf_counter() - t0
+        except ImportError as e:
+            print(f'{label:8s} skipped ({e})')
+            continue
+        t0 = ttime.perf_counter()
+        back, _ = read_stream(path, 'fluorescence')
+        dt_read = ttime.perf_counter() - t0
+        assert np.allclose(back['QEPro_output'], qepro_dic['QEPro_output'], rtol=1e-6)
+        print(f'{label:8s} write {dt:6.3f} s  read {dt_read:6.3f} s  '
+              f'{os.path.getsize(path) / 1e6:6.1f} MB')
+
+    columns = ('QEPro_x_axis', 'QEPro_dark', 'QEPro_sample', 'QEPro_output')
+    t0 = ttime.perf_counter()
+    for j in range(num_events):
+        write_spectra_csv(os.path.join(directory, f'bench_{j:03d}.csv'), ['uid,bench'],
+                          [qepro_dic[k][j] for k in columns])
+    print(f'csv      write {ttime.perf_counter() - t0:6.3f} s  ({num_events} files)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('bench', help='time the writers on random spectra')
+    p.add_argument('--events', type=int, default=1000)
+    p = sub.add_parser('show', help='print the streams of an exported file')
+    p.add_argument('path')
+    p.add_argument('--stream', default='primary')
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'bench':
+        with tempfile.TemporaryDirectory() as directory:
+            bench(args.events, directory)
+    else:
+        qepro_dic, metadata = read_stream(args.path, args.stream)
+        print(json.dumps(metadata, indent=1, default=str))
+        for k, v in qepro_dic.items():
+            print(f'{k:24s} {v.dtype} {v.shape}')
+
+
+if __name__ == "__main__":
+    main()
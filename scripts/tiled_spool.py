@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""Write-ahead spool for documents on their way to Tiled.
+
+Every document is appended to an on-disk journal *before* it is posted, so
+nothing is lost if Tiled is down for longer than the retry budget or if the
+session dies. The journal is a directory of append-only msgpack segments::
+
+    <spool_dir>/000000000001.msgpack   records [seq, name, doc]
+    <spool_dir>/000000001873.msgpack   (segment name = first seq in it)
+    <spool_dir>/acked                  highest seq known to be in Tiled
+    <spool_dir>/lock                   flock'ed by the process that owns it
+
+Segments whose records are all acknowledged are deleted, as soon as the ack
+pointer passes their end (not on every ack). A new session never
+appends to an old segment, so a torn record left by a crash is only ever at
+the end of a closed segment and is ignored on read.
+
+Used by ``TiledInserter`` in startup/00-startup.py, one spool per session
+kind (``<DEFAULT_SPOOL_DIR>/bsui`` and ``/qs``), and as a CLI to inspect and
+replay leftovers by hand. The CLI works on every spool under ``--dir``::
+
+    python scripts/tiled_spool.py ls
+    python scripts/tiled_spool.py --dir ~/.cache/xpd/tiled-spool/qs ls
+    python scripts/tiled_spool.py replay --profile nsls2 --path xpd/raw
+    python scripts/tiled_spool.py replay --uri http://localhost:8000 --api-key secret
+"""
+import argparse
+import collections
+import fcntl
+import os
+import sys
+import threading
+
+import msgpack
+import numpy as np
+
+DEFAULT_SPOOL_DIR = os.environ.get(
+    "XPD_TILED_SPOOL", os.path.expanduser("~/.cache/xpd/tiled-spool"))
+
+_SUFFIX = ".msgpack"
+
+
+def _default(obj):
+    # Documents may carry numpy values; store them as plain Python so the
+    # replayed documents are what the json serializer would have sent.
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Cannot spool object of type {type(obj)}")
+
+
+class SpoolLocked(RuntimeError):
+    pass
+
+
+class TiledSpool:
+    """
+    Append-only journal of (name, doc) pairs with a persistent ack pointer.
+
+    Parameters
+    ----------
+    directory : str
+        Where the segments live. Created if missing.
+    max_segment_bytes : int
+        Roll over to a new segment once the active one is this large.
+    fsync_on : container of str
+        Document names after which the active segment is fsync'ed. Every
+        record is flushed to the OS regardless, which survives a process
+        crash; fsync also survives losing the machine.
+    lock : bool
+        Take an exclusive lock on the directory. Only one writer at a time.
+    """
+
+    def __init__(self, directory=DEFAULT_SPOOL_DIR, *, max_segment_bytes=64 * 2**20,
+                 fsync_on=("start", "descriptor", "stop"), lock=True):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync_on = frozenset(fsync_on)
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+        if lock:
+            self._lock_file = open(os.path.join(directory, "lock"), "w")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise SpoolLocked(f"{directory} is in use by another process")
+        self._mutex = threading.Lock()
+        self._packer = msgpack.Packer(default=_default)
+        self._active = None
+        self._active_path = None
+        self._acked = self._read_acked()
+        segments = self.segments()
+        # first seq of each segment on disk, oldest first
+        self._starts = [self._start(path) for path in segments]
+        last = max((seq for seq, _, _ in self._iter_segment(segments[-1])),
+                   default=0) if segments else 0
+        self._seq = max(last, self._acked)
+
+    # -- journal -----------------------------------------------------------
+
+    def segments(self):
+        "Paths of the segments on disk, oldest first."
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(_SUFFIX))
+        return [os.path.join(self.directory, n) for n in names]
+
+    @staticmethod
+    def _start(path):
+        return int(os.path.basename(path)[:-len(_SUFFIX)])
+
+    def append(self, name, doc):
+        "Journal one document and return its sequence number."
+        with self._mutex:
+            self._seq += 1
+            if self._active is None or self._active.tell() >= self.max_segment_bytes:
+                self._roll()
+            self._active.write(self._packer.pack([self._seq, name, doc]))
+            self._active.flush()
+            if name in self.fsync_on:
+                os.fsync(self._active.fileno())
+            return self._seq
+
+    def _roll(self):
+        if self._active is not None:
+            os.fsync(self._active.fileno())
+            self._active.close()
+        self._active_path = os.path.join(self.directory, f"{self._seq:012d}{_SUFFIX}")
+        self._active = open(self._active_path, "ab")
+        self._starts.append(self._seq)
+
+    def close(self):
+        with self._mutex:
+            if self._active is not None:
+                os.fsync(self._active.fileno())
+                self._active.close()
+                self._active = None
+        self._prune()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @staticmethod
+    def _iter_segment(path):
+        with open(path, "rb") as f:
+            # A truncated trailing record (crash mid-write) just ends iteration.
+            try:
+                yield from msgpack.Unpacker(f, raw=False, strict_map_key=False)
+            except (msgpack.OutOfData, ValueError):
+                return
+
+    # -- acknowledgement ---------------------------------------------------
+
+    @property
+    def acked(self):
+        return self._acked
+
+    @property
+    def last_seq(self):
+        return self._seq
+
+    def _read_acked(self):
+        try:
+            with open(os.path.join(self.directory, "acked")) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def ack(self, seq):
+        "Record that every document up to and including *seq* is in Tiled."
+        if seq <= self._acked:
+            return
+        self._acked = seq
+        path = os.path.join(self.directory, "acked")
+        with open(path + ".tmp", "w") as f:
+            f.write(str(seq))
+        os.replace(path + ".tmp", path)
+        if self._segment_done():
+            self._prune()
+
+    def _segment_done(self):
+        "Whether the ack pointer has passed the end of a segment still on disk."
+        with self._mutex:
+            # The next segment starts after the last record of this one.
+            if len(self._starts) > 1 and self._starts[1] <= self._acked + 1:
+                return True
+            # Nothing is appended without an active segment, so the last
+            # one ends at the last seq.
+            return self._active is None and bool(self._starts) and self._seq <= self._acked
+
+    def _prune(self):
+        "Delete closed segments that are fully acknowledged."
+        with self._mutex:
+            segments = self.segments()
+            for path, nxt in zip(segments, segments[1:]):
+                if path == self._active_path:
+                    break
+                if self._start(nxt) <= self._acked + 1:
+                    os.remove(path)
+            if self._active is None and segments and self._seq <= self._acked:
+                os.remove(segments[-1])
+            self._starts = [self._start(path) for path in self.segments()]
+
+    def unacked(self):
+        "Yield (seq, name, doc) for every journaled document not yet acked, in order."
+        for path in self.segments():
+            for seq, name, doc in self._iter_segment(path):
+                if seq > self._acked:
+                    yield seq, name, doc
+
+    def pending(self):
+        return self._seq - self._acked
+
+    def summary(self):
+        "Per-segment record counts, for the CLI and for a quick look in IPython."
+        rows = []
+        for path in self.segments():
+            counts = collections.Counter()
+            first = last = None
+            for seq, name, doc in self._iter_segment(path):
+                first = seq if first is None else first
+                last = seq
+                counts[name if seq > self._acked else "acked"] += 1
+            rows.append({"segment": os.path.basename(path),
+                         "bytes": os.path.getsize(path),
+                         "first": first, "last": last, "counts": dict(counts)})
+        return rows
+
+
+def replay(spool, post_document):
+    """
+    Post every unacknowledged document in journal order, acking as we go.
+
+    Stops at the first failure and re-raises it; the ack pointer marks
+    where the next attempt picks up. Returns the number of documents posted.
+    """
+    n = 0
+    for seq, name, doc in spool.unacked():
+        post_document(name, doc)
+        spool.ack(seq)
+        n += 1
+    return n
+
+
+def _print_summary(spool):
+    rows = spool.summary()
+    print(f"{spool.directory}: acked up to seq {spool.acked}")
+    if not rows:
+        print("  (empty)")
+    for row in rows:
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(row["counts"].items()))
+        print(f"  {row['segment']}  {row['bytes']:>10d} B  "
+              f"seq {row['first']}..{row['last']}  {counts}")
+    runs = collections.OrderedDict()
+    for _, name, doc in spool.unacked():
+        if name == "start":
+            runs[doc["uid"]] = doc.get("plan_name", "?")
+    for uid, plan_name in runs.items():
+        print(f"  unacked run {uid}  ({plan_name})")
+
+
+def spool_dirs(root):
+    "*root* and the directories below it that hold a spool, e.g. root/bsui and root/qs."
+    return sorted(path for path, _, files in os.walk(root)
+                  if "acked" in files or any(n.endswith(_SUFFIX) for n in files))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dir", default=DEFAULT_SPOOL_DIR,
+                        help="spool directory, or a directory of spools (default: all sessions)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("ls", help="list segments and unacknowledged runs")
+    rp = sub.add_parser("replay", help="post unacknowledged documents to Tiled")
+    source = rp.add_mutually_exclusive_group(required=True)
+    source.add_argument("--profile", help="tiled profile, e.g. nsls2")
+    source.add_argument("--uri", help="tiled server URI, e.g. a local `tiled serve`")
+    rp.add_argument("--path", default="", help="node to write to, e.g. xpd/raw")
+    rp.add_argument("--api-key", default=os.environ.get("TILED_BLUESKY_WRITING_API_KEY_XPD"))
+    args = parser.parse_args(argv)
+
+    directories = spool_dirs(args.dir)
+    if not directories:
+        print(f"{args.dir}: no spool")
+        return 0
+    if args.command == "ls":
+        for directory in directories:
+            _print_summary(TiledSpool(directory, lock=False))
+        return 0
+
+    from tiled.client import from_profile, from_uri
+
+    if args.profile:
+        client = from_profile(args.profile, api_key=args.api_key)
+    else:
+        client = from_uri(args.uri, api_key=args.api_key)
+    for key in filter(None, args.path.split("/")):
+        client = client[key]
+    status = 0
+    for directory in directories:
+        try:
+            spool = TiledSpool(directory)
+        except SpoolLocked as err:
+            print(f"{err}; stop that session (its writer replays on its own) first.")
+            status = 1
+            continue
+        try:
+            n = replay(spool, client.post_document)
+        finally:
+            spool.close()
+        print(f"{directory}: replayed {n} documents; {spool.pending()} left.")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
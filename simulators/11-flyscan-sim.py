@@ -0,0 +1,170 @@
+# simulated fly motor and free-running area detector for xrd_map(mode='fly')
+import itertools
+import threading
+import time as ttime
+
+from ophyd import Component as Cpt, Device, Signal
+from ophyd.status import DeviceStatus
+
+
+class SimFlyMotor(Device):
+    """Motor that really takes time to move, updating its readback at 10 Hz."""
+    readback = Cpt(Signal, value=0, kind="hinted")
+    setpoint = Cpt(Signal, value=0)
+    velocity = Cpt(Signal, value=1, kind="config")
+
+    update_period = 0.1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.readback.name = self.name
+
+    @property
+    def position(self):
+        return self.readback.get()
+
+    def set(self, target):
+        st = DeviceStatus(self)
+        self.setpoint.put(target)
+
+        def move():
+            start, t0 = self.readback.get(), ttime.time()
+            sign = 1 if target >= start else -1
+            while True:
+                ttime.sleep(self.update_period)
+                pos = start + sign * self.velocity.get() * (ttime.time() - t0)
+                if (pos - target) * sign >= 0:
+                    self.readback.put(target)
+                    break
+                self.readback.put(pos)
+            st.set_finished()
+
+        threading.Thread(target=move, daemon=True).start()
+        return st
+
+
+class SimCam(Device):
+    acquire = Cpt(Signal, value=1)
+    acquire_time = Cpt(Signal, value=0.1, kind="config")
+
+
+class SimProc(Device):
+    reset_filter = Cpt(Signal, value=0)
+
+
+class SimTIFF(Device):
+    num_capture = Cpt(Signal, value=0)
+    num_captured = Cpt(Signal, value=0)
+    capture = Cpt(Signal, value=0)
+    write_file = Cpt(Signal, value=0)
+    file_number = Cpt(Signal, value=0)
+    file_name = Cpt(Signal, value="sim")
+    file_template = Cpt(Signal, value="%s%s_%6.6d.tiff")
+
+    filestore_spec = "AD_TIFF"
+    reg_root = "/tmp"
+    read_path_template = "/tmp/sim_pe/%Y/%m/%d/"
+    write_time = 0.2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_file.subscribe(self._write, run=False)
+
+    def _write(self, *, value, **kwargs):
+        if value != 1:
+            return
+
+        def write():
+            ttime.sleep(self.write_time)
+            self.file_number.put(self.file_number.get() + self.num_captured.get())
+            self.capture.put(0)
+            self.num_captured.put(0)
+            self.write_file.put(0)
+
+        threading.Thread(target=write, daemon=True).start()
+
+
+class SimFreeRunDetector(Device):
+    """
+    Stand-in for pe1c: frames arrive every acquire_time * images_per_set
+    and are counted by tiff.num_captured while tiff.capture is on.
+    """
+    cam = Cpt(SimCam, "")
+    proc = Cpt(SimProc, "")
+    tiff = Cpt(SimTIFF, "")
+    images_per_set = Cpt(Signal, value=1)
+    number_of_sets = Cpt(Signal, value=1)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        threading.Thread(target=self._free_run, daemon=True).start()
+
+    def _free_run(self):
+        while True:
+            ttime.sleep(self.cam.acquire_time.get() * self.images_per_set.get())
+            tiff = self.tiff
+            if (self.cam.acquire.get() and tiff.capture.get()
+                    and tiff.num_captured.get() < tiff.num_capture.get()):
+                tiff.num_captured.put(tiff.num_captured.get() + 1)
+
+    def trigger(self):
+        """
+        Like ContinuousAcquisitionTrigger: capture number_of_sets frames of the
+        running camera, then write them, for plans that trigger pe1c (ct,
+        xrd_map(mode='step')).
+        """
+        st = DeviceStatus(self)
+        tiff = self.tiff
+
+        def written(*, value, old_value, **kwargs):
+            if old_value == 1 and value == 0:
+                tiff.write_file.clear_sub(written)
+                st.set_finished()
+
+        def captured(*, value, **kwargs):
+            if value >= tiff.num_capture.get():
+                tiff.num_captured.clear_sub(captured)
+                tiff.write_file.subscribe(written, run=False)
+                tiff.write_file.put(1)
+
+        tiff.num_capture.put(self.number_of_sets.get())
+        tiff.num_captured.subscribe(captured, run=False)
+        tiff.capture.put(1)
+        return st
+
+    _datum_counter = itertools.count()
+
+    def read(self):
+        ret = super().read()
+        # a datum id with no Resource/Datum behind it: the documents have the
+        # shape of pe1c's, the image itself is never written
+        ret[f"{self.name}_image"] = {
+            "value": f"{self.name}-sim/{next(self._datum_counter)}",
+            "timestamp": ttime.time()}
+        return ret
+
+    def describe(self):
+        ret = super().describe()
+        ret[f"{self.name}_image"] = {
+            "source": "SIM:image", "dtype": "array", "shape": [1, 2048, 2048],
+            "external": "FILESTORE:"}
+        return ret
+
+
+sim_fly_x = SimFlyMotor(name="sim_fly_x")
+sim_step_y = SimFlyMotor(name="sim_step_y")
+sim_pe1c = SimFreeRunDetector(name="pe1")
+
+
+''' test the row flyer against the simulators
+flyer = XRDMapRowFlyer(sim_pe1c, sim_fly_x, sim_step_y)
+
+def one_row():
+    yield from bps.mv(sim_fly_x.velocity, 5)
+    flyer.configure_row(0, 10, 20, 0.1)
+    yield from bps.kickoff(flyer, wait=True)
+    yield from bps.complete(flyer, wait=True)
+    yield from bps.collect(flyer)
+
+RE(bpp.run_wrapper(one_row()), print)
+'''
@@ -0,0 +1,103 @@
+# benchmark QEProRunReader (startup/32-data_export.py) against the temporary db
+import os
+import runpy
+import time as ttime
+
+import numpy as np
+from event_model import compose_run
+
+_export = runpy.run_path(os.path.join(os.path.dirname(__file__), os.pardir,
+                                      'startup', '32-data_export.py'))
+QEProRunReader = _export['QEProRunReader']
+_qepro_keys, _, _metadata_keys, _ = _export['_data_keys']()
+
+
+def insert_fake_qepro_run(db, num_events=1, num_pixels=1044,
+                          streams=('primary', 'fluorescence'), static_as_config=False):
+    """
+    Write a run shaped like a QEPro scan straight into db and return its uid.
+    With static_as_config the x axis, dark and reference are in the
+    descriptors' configuration, as QEPro records them now, instead of in
+    every event.
+    """
+    run = compose_run(metadata={
+        'sample_type': 'sim', 'pumps': ['dds1_p1', 'dds1_p2'],
+        'precursors': ['CsPbOA', 'ToABr'], 'infuse_rate': [100, 50],
+        'infuse_rate_unit': ['ul/min', 'ul/min'],
+        'pump_status': ['Infusing', 'Infusing'], 'mixer': ['30 cm'], 'note': 'sim'})
+    db.insert('start', run.start_doc)
+
+    x_axis = np.linspace(200, 1000, num_pixels)
+    static = {'QEPro_x_axis': x_axis, 'QEPro_dark': np.random.random(num_pixels),
+              'QEPro_reference': np.random.random(num_pixels)}
+    for stream in streams:
+        data_keys = {k: {'source': 'SIM:QEPro', 'dtype': 'array', 'shape': [num_pixels]}
+                     for k in _qepro_keys[:5]}
+        data_keys.update({k: {'source': 'SIM:QEPro', 'dtype': 'number', 'shape': []}
+                          for k in _qepro_keys[5:]})
+        configuration = {}
+        if static_as_config:
+            now = ttime.time()
+            configuration['QEPro'] = {
+                'data': static, 'timestamps': {k: now for k in static},
+                'data_keys': {k: data_keys.pop(k) for k in static}}
+        desc = run.compose_descriptor(name=stream, data_keys=data_keys,
+                                      configuration=configuration)
+        db.insert('descriptor', desc.descriptor_doc)
+        for _ in range(num_events):
+            data = {'QEPro_spectrum_type': 2,
+                    'QEPro_integration_time': 100, 'QEPro_num_spectra': 16,
+                    'QEPro_buff_capacity': 3}
+            if not static_as_config:
+                data.update(static)
+            for k in ('QEPro_output', 'QEPro_sample'):
+                data[k] = np.random.random(num_pixels)
+            now = ttime.time()
+            db.insert('event', desc.compose_event(
+                data=data, timestamps={k: now for k in data}))
+    db.insert('stop', run.compose_stop())
+    return run.start_doc['uid']
+
+
+def _export_naive(db, uid):
+    # what QEPro.export_from_scan used to do: one table() per key
+    data = {k: db[uid].table()[k][1] for k in _qepro_keys}
+    meta = {k: db[uid].start.get(k, ['None']) for k in _metadata_keys}
+    return data, meta
+
+
+def _export_reader(db, uid):
+    run = QEProRunReader(uid, data_agent='db', source=db)
+    primary = run.stream('primary')
+    return {k: primary[k][0] for k in _qepro_keys}, run.metadata(_metadata_keys)
+
+
+def bench_qepro_reader(db, num_runs=5, num_events=10, repeat=3):
+    uids = [insert_fake_qepro_run(db, num_events=num_events) for _ in range(num_runs)]
+
+    results = {}
+    for label, export in (('naive', _export_naive), ('reader', _export_reader)):
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = ttime.perf_counter()
+            for uid in uids:
+                export(db, uid)
+            best = min(best, ttime.perf_counter() - t0)
+        results[label] = best / num_runs
+        print(f'{label:>8}: {1e3 * results[label]:8.1f} ms per run')
+
+    for uid in uids:
+        naive, reader = _export_naive(db, uid), _export_reader(db, uid)
+        for k in _qepro_keys:
+            assert np.array_equal(naive[0][k], reader[0][k]), k
+    print(f' speedup: {results["naive"] / results["reader"]:.1f}x')
+    return results
+
+
+''' compare the old per-key reads with QEProRunReader
+bench_qepro_reader(db, num_runs=5, num_events=10)
+
+# a run with x axis, dark and reference as configuration reads the same
+uid = insert_fake_qepro_run(db, num_events=10, static_as_config=True)
+QEProRunReader(uid, data_agent='db', source=db).stream('primary')['QEPro_dark'].shape
+'''
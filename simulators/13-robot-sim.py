@@ -0,0 +1,75 @@
+# stand-in for the sample robot IOC, to measure sample_queue throughput
+# without the beamline (Robot and sample_queue come from startup/85-robot.py)
+import os
+import runpy
+import threading
+import time
+
+import numpy as np
+from ophyd import Component as Cpt, Signal
+from ophyd.sim import SynAxis
+
+sim_th = SynAxis(name='sim_th', delay=0.5)
+
+_robot = runpy.run_path(os.path.join(os.path.dirname(__file__), os.pardir,
+                                     'startup', '85-robot.py'),
+                        init_globals=dict(globals(), th=sim_th, Cpt=Cpt, time=time, np=np))
+Robot = _robot['Robot']
+
+
+class SimRobot(Robot):
+    """
+    Robot whose PVs are soft signals driven like the IOC drives them:
+    execute_cmd puts status to 'Busy', and after move_time the sample
+    address is updated and status goes back to 'Idle'.
+    """
+    sample_number = Cpt(Signal, value=0)
+    load_cmd = Cpt(Signal, value=0)
+    unload_cmd = Cpt(Signal, value=0)
+    execute_cmd = Cpt(Signal, value=0)
+    status = Cpt(Signal, value='Idle')
+    current_sample_number = Cpt(Signal, value=0)
+
+    move_time = 30  # seconds for one load or unload
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execute_cmd.subscribe(self._ioc_execute, run=False)
+
+    def _ioc_execute(self, *, value, **kwargs):
+        if value != 1:
+            return
+
+        def cycle():
+            time.sleep(0.2)
+            self.status.put('Busy')
+            time.sleep(self.move_time)
+            if self.load_cmd.get():
+                self.current_sample_number.put(self.sample_number.get())
+            elif self.unload_cmd.get():
+                self.current_sample_number.put(0)
+            self.load_cmd.put(0)
+            self.unload_cmd.put(0)
+            self.execute_cmd.put(0)
+            self.status.put('Idle')
+
+        threading.Thread(target=cycle, daemon=True).start()
+
+
+sim_robot = SimRobot(name='sim_robot', theta=sim_th)
+sample_queue = _robot['sample_queue']
+# sample_queue and the load/unload plans look the robot up in their module
+# globals; run_path returned a copy of them, so patch the functions' own
+sample_queue.__globals__.update(robot=sim_robot)
+
+
+''' samples per hour with a 30 s robot move and a 60 s measurement
+import bluesky.plans as bp
+sim_samples = [{'position': i, 'geometry': 'capillary', 'sample_name': f's{i}'} for i in range(1, 6)]
+
+def measure(sample):
+    yield from bp.count([det], md=sample)
+    yield from bps.sleep(60)
+
+RE(sample_queue(sim_samples, measure))
+'''
@@ -0,0 +1,23 @@
+# two ophyd-async PerkinElmer panels on the mock signal backend, with the IOC
+# behaviour faked by callbacks (scripts/pe_async.py: sim_perkin_elmer, sim_ioc)
+import os
+import sys
+
+from ophyd_async.core import init_devices
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+from pe_async import pe_multi_frame_count, sim_ioc, sim_perkin_elmer
+
+with init_devices(mock=True):
+    sim_pe1a = sim_perkin_elmer("sim_pe1", frame_shape=(256, 256))
+    sim_pe2a = sim_perkin_elmer("sim_pe2", frame_shape=(256, 256))
+for _det in (sim_pe1a, sim_pe2a):
+    sim_ioc(_det)
+
+
+''' arm both panels for 100 frames at once
+RE(pe_multi_frame_count([sim_pe1a, sim_pe2a], 100, 0.01), print)
+
+# 10 events of 10 frames each
+RE(pe_multi_frame_count([sim_pe1a, sim_pe2a], 100, 0.01, frames_per_event=10))
+'''
@@ -0,0 +1,220 @@
+# soft stand-ins, with the IOCs' latencies, for the devices the key plans use:
+# QEPro, syringe pumps, LED / UV shutter, the fast shutter and a temperature
+# controller (motors and pe1c: 11-flyscan-sim.py, sc / th_cal:
+# 10-motors-dets-sim.py), and RE.md on a fake Redis. 16-plan-bench.py times
+# the plans against them.
+import os
+import sys
+import tempfile
+import threading
+import time as ttime
+
+import numpy as np
+from ophyd import Component as Cpt, Device, Signal
+from ophyd.sim import SynAxis
+from ophyd.status import SubscriptionStatus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+from cached_redis_dict import CachedRedisJSONDict, fake_redis
+from optical_sources import OpticalSources
+
+
+class SlowSignal(Signal):
+    """Soft signal whose set completes *latency* s later, like a CA put with completion."""
+
+    def __init__(self, *args, latency=0.05, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+
+    def set(self, value, **kwargs):
+        kwargs.setdefault("settle_time", self.latency)
+        return super().set(value, **kwargs)
+
+
+class SimQEPro(Device):
+    """
+    Stand-in for QEPro (startup/25-QEPro.py) with the signals the plans and
+    the exporters read. A put of 1 to acquire takes integration_time (ms) x
+    num_spectra plus readout_time, then updates the spectra and drops
+    acquire back to 0, so trigger (grab_frame) waits as long as on the IOC.
+    With collect_mode 'Single' each of the num_spectra spectra is posted as
+    it is integrated (QEProBurst). The lamp only reaches the sample while
+    *shutter* (if given) is 'High', and the LED excites PL while *led* is.
+    Like the hardware, either responds response_time s after the put has
+    completed, and then takes about warmup s to reach full intensity.
+    """
+    integration_time = Cpt(SlowSignal, value=100)
+    num_spectra = Cpt(SlowSignal, value=10)
+    buff_capacity = Cpt(SlowSignal, value=3)
+    buff_max_capacity = Cpt(Signal, value=1000)
+    collect_mode = Cpt(SlowSignal, value="Average")
+    spectra_collected = Cpt(Signal, value=0)
+    spectrum_type = Cpt(SlowSignal, value="Corrected Sample")
+    correction = Cpt(SlowSignal, value="Dark")
+    electric_dark_correction = Cpt(SlowSignal, value=1)
+
+    x_axis = Cpt(Signal, value=np.linspace(200, 1000, 1044), kind="config")
+    output = Cpt(Signal, value=np.zeros(1044))
+    sample = Cpt(Signal, value=np.zeros(1044))
+    dark = Cpt(Signal, value=np.zeros(1044), kind="config")
+    reference = Cpt(Signal, value=np.zeros(1044), kind="config")
+
+    acquire = Cpt(Signal, value=0, kind="omitted")
+
+    readout_time = 0.05
+    response_time = 0.5
+    warmup = 0.3
+    has_buffer_feature = True
+
+    def __init__(self, *args, shutter=None, led=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shutter = shutter
+        self._led = led
+        self._switch = {}  # source name -> (on, since, previous state)
+        for source in (shutter, led):
+            if source is not None:
+                source.subscribe(self._switched, run=True)
+        self.acquire.subscribe(self._ioc_collect, run=False)
+        self._rng = np.random.default_rng(0)
+
+    def _switched(self, *, value, obj, **kwargs):
+        on = value == "High"
+        state = self._switch.get(obj.name)
+        if state is None or state[0] != on:
+            previous = None if state is None else state[:2] + (None,)
+            self._switch[obj.name] = (on, ttime.monotonic() + self.response_time, previous)
+
+    def _level(self, state, now):
+        if state is None:
+            return 0.
+        on, since, previous = state
+        if now < since:
+            return self._level(previous, now)
+        return 1 - np.exp(-(now - since) / self.warmup) if on else 0.
+
+    def _intensity(self, source):
+        # 0 (off) to 1 (warmed up)
+        if source is None:
+            return 1.
+        return self._level(self._switch.get(source.name), ttime.monotonic())
+
+    def _spectra(self):
+        x = self.x_axis.get()
+        dark = 1000 + 10 * self._rng.standard_normal(x.size)
+        lamp = 1000 + 3e4 * np.exp(-((x - 550) / 250) ** 2)
+        emission = 2e4 * np.exp(-((x - 515) / 12) ** 2)
+        transmitted = (lamp - 1000) * 10 ** -(0.5 * np.exp(-((x - 480) / 40) ** 2))
+        # the raw counts see whatever light arrives, whatever the spectrum type
+        sample = (dark + self._intensity(self._shutter) * transmitted
+                  + self._intensity(self._led) * emission + 50 * self._rng.standard_normal(x.size))
+        if self.spectrum_type.get() == "Absorbtion":
+            output = -np.log10(np.clip((sample - dark) / (lamp - 1000), 1e-4, None))
+        else:
+            output = sample - dark
+        return sample, dark, lamp, output
+
+    def _ioc_collect(self, *, value, old_value, **kwargs):
+        if value != 1 or old_value == 1:
+            return
+
+        def post():
+            # like the IOC, DARK / REFERENCE only change when one is taken
+            sample, dark, reference, output = self._spectra()
+            self.sample.put(sample)
+            if self.spectrum_type.get() == "Dark":
+                self.dark.put(dark)
+            elif self.spectrum_type.get() == "Reference":
+                self.reference.put(reference)
+            self.output.put(output)
+            self.spectra_collected.put(self.spectra_collected.get() + 1)
+
+        def collect():
+            self.spectra_collected.put(0)
+            if self.collect_mode.get() == "Single":
+                for _ in range(self.num_spectra.get()):
+                    ttime.sleep(1e-3 * self.integration_time.get())
+                    post()
+                ttime.sleep(self.readout_time)
+            else:
+                ttime.sleep(1e-3 * self.integration_time.get() * self.num_spectra.get()
+                            + self.readout_time)
+                post()
+            self.acquire.put(0)
+
+        threading.Thread(target=collect, daemon=True).start()
+
+    def trigger(self):
+        def is_done(value, old_value, **kwargs):
+            return old_value == 1 and value == 0
+
+        status = SubscriptionStatus(self.acquire, run=False, callback=is_done)
+        self.acquire.put(1)
+        return status
+
+
+class SimSyringePump(Device):
+    """
+    Stand-in for a syrng_DDS_ax axis (startup/27-pump_dds.py): rate
+    readbacks follow their setpoints and status follows infuse / stop.
+    """
+    status = Cpt(Signal, value="Idle")
+    infuse_rate = Cpt(SlowSignal, value=100, kind="hinted")
+    infuse_rate_unit = Cpt(SlowSignal, value="ul/min", kind="hinted")
+    read_infuse_rate = Cpt(Signal, value=100, kind="hinted")
+    read_infuse_rate_unit = Cpt(Signal, value="ul/min", kind="hinted")
+    pump_infuse = Cpt(SlowSignal, value=0, kind="omitted")
+    pump_stop = Cpt(SlowSignal, value=0, kind="omitted")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.infuse_rate.subscribe(
+            lambda value, **kwargs: self.read_infuse_rate.put(value), run=False)
+        self.infuse_rate_unit.subscribe(
+            lambda value, **kwargs: self.read_infuse_rate_unit.put(value), run=False)
+        self.pump_infuse.subscribe(self._ioc_status("Infusing"), run=False)
+        self.pump_stop.subscribe(self._ioc_status("Idle"), run=False)
+
+    def _ioc_status(self, status):
+        def update(*, value, **kwargs):
+            if value == 1:
+                self.status.put(status)
+        return update
+
+
+# the 28-Lights_shutter.py signals, 'Low' / 'High'
+sim_LED = SlowSignal(name="LED_M365LP1", value="Low", kind="hinted")
+sim_UV_shutter = SlowSignal(name="UV_shutter", value="Low", kind="hinted")
+sim_deuterium = SlowSignal(name="Deuterium", value="High", kind="config")
+sim_halogen = SlowSignal(name="Halogen", value="High", kind="config")
+
+# fast shutter, moved to -20 (open) / 20 (closed) like fs
+sim_fs = SynAxis(name="fs", delay=0.1)
+sim_fs.set(20).wait()
+
+sim_qepro = SimQEPro(name="QEPro", shutter=sim_UV_shutter, led=sim_LED)
+sim_optical_sources = OpticalSources([sim_LED, sim_UV_shutter, sim_deuterium, sim_halogen],
+                                     detector=sim_qepro,
+                                     path=os.path.join(tempfile.gettempdir(), "sim_optical_settle.json"))
+sim_dds1_p1 = SimSyringePump(name="DDS1_p1")
+sim_dds1_p2 = SimSyringePump(name="DDS1_p2")
+
+# a Eurotherm ramping at 1 K/s
+sim_eurotherm = SimFlyMotor(name="eurotherm")
+sim_eurotherm.readback.put(25)
+
+# RE.md on a fake Redis, through the same cache as startup/970-load.py
+RE.md = CachedRedisJSONDict(fake_redis(), prefix="", configure_notifications=True)
+RE.md.update({"cycle": "sim", "data_session": "pass-000000", "beamline_id": "xpd-sim"})
+
+
+''' one absorbance and one fluorescence spectrum, in LiveTable
+RE(bps.mv(sim_LED, 'Low', sim_UV_shutter, 'High'))
+RE(bp.count([sim_qepro]), LiveTable(['QEPro_integration_time', 'QEPro_spectrum_type']))
+
+# the shutter as the plans switch it: settled once the intensity is steady
+RE(sim_optical_sources.mv(sim_LED, 'Low', sim_UV_shutter, 'High'))
+sim_optical_sources.profiles()
+
+# 50 spectra of 10 ms as one EventPage (qepro_burst, startup/25-QEPro.py)
+RE(qepro_burst(sim_qepro, 50, integration_time=10))
+'''
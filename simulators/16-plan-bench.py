@@ -0,0 +1,169 @@
+# time the key plans of the profile against the simulated beamline
+# (11-flyscan-sim.py, 15-beamline-sim.py, 94-ecal-adaptive-sim.py) on the
+# temporary databroker, with a per-command breakdown from scripts/re_tracer.py
+import json
+import os
+import runpy
+import statistics
+import sys
+import time as ttime
+
+import bluesky.plan_stubs as bps
+import numpy as np
+import pandas as pd
+from bluesky.callbacks.best_effort import BestEffortCallback
+from ophyd import Component as Cpt, Signal
+from ophyd.sim import make_fake_device
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+from re_tracer import RETracer, chrome_trace, summarize
+
+
+def _run_startup(filename, **init_globals):
+    "Run a startup file with the simulated devices bound in its namespace."
+    return runpy.run_path(os.path.join(os.path.dirname(__file__), os.pardir, 'startup', filename),
+                          init_globals=dict(globals(), **init_globals))
+
+
+# xpdacq's glbl and xpd_configuration, as far as the plans read them
+sim_glbl = {'frame_acq_time': sim_pe1c.cam.acquire_time.get(), 'shutter_control': True}
+sim_xpd_configuration = {'area_det': sim_pe1c, 'shutter': sim_fs}
+
+
+def sim_configure_area_det(det, exposure, acq_time=None):
+    "xpdacq's configure_area_det for sim_pe1c: whole frames of acq_time per exposure."
+    if acq_time is None:
+        acq_time = det.cam.acquire_time.get()
+    num_frame = max(1, int(np.ceil(exposure / acq_time)))
+    yield from bps.mv(det.cam.acquire_time, acq_time, det.images_per_set, num_frame)
+    return num_frame, acq_time, num_frame * acq_time
+
+
+_bundle = _run_startup('30-bundle-plan.py', glbl=sim_glbl, LED=sim_LED,
+                       UV_shutter=sim_UV_shutter, optical_sources=sim_optical_sources)
+xray_uvvis_plan = _bundle['xray_uvvis_plan']
+
+ct = _run_startup('85-robot.py', th=sim_th, pe1c=sim_pe1c, Cpt=Cpt, time=ttime, np=np)['ct']
+
+xrd_map = _run_startup('81_xpd_map_flyscan.py', glbl=sim_glbl, dark_frame_cache=None,
+                       configure_area_det=sim_configure_area_det)['xrd_map']
+
+# flash_step reads its devices from the module namespace of 95-flash.py, which
+# makes the real (EPICS) ones when it runs, so the simulated ones are swapped
+# into that namespace afterwards
+_flash = _run_startup('95-flash.py')
+flash_step = _flash['flash_step']
+
+
+class SimFlashPower(_flash['FlashPower']):
+    # make_fake_device only replaces the stock EpicsSignal classes, not these
+    # subclasses of it, which would still connect to the PSU
+    current_sp = Cpt(Signal, value=0)
+    voltage_sp = Cpt(Signal, value=0)
+    enabled = Cpt(Signal, value=0, kind='omitted')
+
+
+sim_flash_power = make_fake_device(SimFlashPower)('SIM:PSU', name='flash_power')
+sim_flash_power.current.name = 'I'
+sim_flash_power.voltage.name = 'V'
+sim_flash_power.current_sp.name = 'Isp'
+sim_flash_power.current_sp.subscribe(
+    lambda value, **kwargs: sim_flash_power.current.sim_put(value), run=False)
+sim_flash_power.voltage_sp.subscribe(
+    lambda value, **kwargs: sim_flash_power.voltage.sim_put(value), run=False)
+sim_MM = make_fake_device(_flash['KeithlyMM'])('SIM:MM', name='MM')
+sim_bec = BestEffortCallback()
+sim_bec.disable_plots()
+flash_step.__globals__.update(
+    flash_power=sim_flash_power, MM=sim_MM, eurotherm=sim_eurotherm, bec=sim_bec,
+    xpd_configuration=sim_xpd_configuration,
+    _configure_area_det=lambda exposure: sim_configure_area_det(sim_pe1c, exposure),
+    open_shutter_stub=lambda: bps.mv(sim_fs, -20), close_shutter_stub=lambda: bps.mv(sim_fs, 20))
+
+# name -> function returning a fresh plan
+BENCH_PLANS = {
+    'ct': lambda: ct(None, 0.1),
+    'xrd_map': lambda: xrd_map([sim_pe1c], sim_fs, sim_fly_x, 0, 1, 5, sim_step_y, 0, 1, 3, 0.1),
+    'xrd_map_fly': lambda: xrd_map([sim_pe1c], sim_fs, sim_fly_x, 0, 1, 5, sim_step_y, 0, 1, 3, 0.1,
+                                   mode='fly'),
+    'xray_uvvis_plan': lambda: xray_uvvis_plan(
+        sim_pe1c, sim_qepro, num_abs=5, num_flu=5, sample_type='sim',
+        pump_list=[sim_dds1_p1, sim_dds1_p2], precursor_list=['CsPbOA', 'ToABr'],
+        mixer=['30 cm']),
+    'Ecal': lambda: Ecal_adaptive(12.398 / 66.4 * 1.001, detectors=[sc], motor=th_cal,
+                                  detector_name='det'),
+    'flash_step': lambda: flash_step(
+        pd.DataFrame({'I': [0.5, 1.0], 'V': [10, 20], 't': [2, 2]}), 0.2, {},
+        dets=[sim_pe1c], delay=0.5, mm_mode='Current'),
+}
+
+plan_bench_tracer = RETracer()
+
+
+def bench_plans(names=None, *, repeat=3, trace_dir=None, save=None, baseline=None):
+    """
+    Run each plan of BENCH_PLANS *repeat* times and print min / median / max
+    wall time and, for the median run, the three commands that took longest.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Keys of BENCH_PLANS, all by default.
+    repeat : int, optional
+    trace_dir : str, optional
+        Save the traces of every plan there as <name>.trace.json.
+    save : str, optional
+        Write the results as JSON, to be passed as *baseline* later.
+    baseline : str, optional
+        JSON of an earlier run; adds the ratio of the medians to the table.
+
+    Returns
+    -------
+    results : dict
+        {name: {'times': [...], 'median': ..., 'top': [(command, seconds)]}}
+    """
+    old = {}
+    if baseline is not None:
+        with open(baseline) as f:
+            old = json.load(f)
+    results = {}
+    plan_bench_tracer.install(RE)
+    try:
+        for name in names or BENCH_PLANS:
+            times, runs = [], []
+            for _ in range(repeat):
+                plan_bench_tracer.clear()
+                t0 = ttime.perf_counter()
+                RE(BENCH_PLANS[name]())
+                times.append(ttime.perf_counter() - t0)
+                runs.append(list(plan_bench_tracer.spans))
+            median = statistics.median(times)
+            spans = runs[min(range(repeat), key=lambda i: abs(times[i] - median))]
+            top = [(key, total) for (key, kind), (n, total, longest)
+                   in summarize(spans, 'command').items() if kind in ('msg', 'plan')][:3]
+            results[name] = {'times': times, 'median': median, 'top': top}
+            if trace_dir is not None:
+                with open(os.path.join(trace_dir, f'{name}.trace.json'), 'w') as f:
+                    json.dump(chrome_trace(spans, plan_bench_tracer.epoch), f)
+    finally:
+        plan_bench_tracer.uninstall(RE)
+
+    print(f"{'plan':<16s} {'min s':>8s} {'median s':>9s} {'max s':>8s} {'vs base':>8s}  slowest commands")
+    for name, res in results.items():
+        ratio = f"{res['median'] / old[name]['median']:8.2f}" if name in old else f"{'':8s}"
+        top = ', '.join(f'{key} {total:.2f}s' for key, total in res['top'])
+        print(f"{name:<16s} {min(res['times']):8.2f} {res['median']:9.2f} "
+              f"{max(res['times']):8.2f} {ratio}  {top}")
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+''' time every plan, keep the numbers, and compare after a change
+bench_plans(repeat=3, save='/tmp/bench_before.json', trace_dir='/tmp')
+bench_plans(repeat=3, baseline='/tmp/bench_before.json')
+
+# one plan, then look at where its time went
+bench_plans(['xray_uvvis_plan'], repeat=1, trace_dir='/tmp')
+'''
@@ -0,0 +1,20 @@
+# run the adaptive Ecal of startup/91-plans-ecal.py against the Si dip simulator
+# (sc, th_cal from 10-motors-dets-sim.py)
+import os
+import runpy
+
+_ecal = runpy.run_path(os.path.join(os.path.dirname(__file__), os.pardir,
+                                    'startup', '91-plans-ecal.py'),
+                       init_globals=globals())
+Ecal_adaptive = _ecal['Ecal']
+seek_peak = _ecal['seek_peak']
+ecal_result = _ecal['myresult']
+
+
+''' compare with the simulated wavelength, 12.398 / 66.4 = 0.18672 A
+RE(Ecal_adaptive(12.398 / 66.4 * 1.001, detectors=[sc], motor=th_cal, detector_name='det'))
+print(ecal_result.wavelength, ecal_result.wavelength_stderr)
+
+# for comparison, the fixed grid version from 93-ecal-version3.py
+RE(Ecal(12.398 / 66.4 * 1.001, detector_name='det'))
+'''
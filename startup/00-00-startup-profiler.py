@@ -0,0 +1,298 @@
+# Runs before every other startup file (sorts ahead of 00-startup.py).
+#
+#   XPD_PROFILE_STARTUP=1   report wall time, imports and PV connection time
+#                           per startup file once the last one has run
+#   XPD_LAZY_STARTUP=1      do not run the heavy analysis files at startup;
+#                           their names are bound to placeholders that run
+#                           the file on first use. A comma separated list of
+#                           file names picks the files instead of the default,
+#                           e.g. to also defer rarely used devices:
+#                           XPD_LAZY_STARTUP=31-data_analysis.py,95-flash.py
+#
+# Both only apply to an IPython session; the queueserver worker loads the
+# startup files on its own and needs the real objects for plan introspection.
+import ast
+import builtins
+import glob
+import os
+import sys
+import time as ttime
+
+from IPython import get_ipython
+
+DEFAULT_LAZY_STARTUP_FILES = ('31-data_analysis.py', '42-energy-calib.py',
+                              '91-plans-ecal.py', '96-dan_functions.py')
+
+
+class StartupProfiler:
+    """
+    Per startup file: wall time, time spent in (outermost) imports, number of
+    modules imported, EpicsSignals created and time spent waiting for PV
+    connections.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self._import_depth = 0
+        self._import_time = 0.
+        self._connect_depth = 0
+        self._connect_time = 0.
+        self._signals = 0
+        self._installed = False
+
+    def install(self):
+        if self._installed:
+            return
+        self._installed = True
+        import ophyd
+        import ophyd.signal
+
+        profiler = self
+        real_import = builtins.__import__
+
+        def timed_import(*args, **kwargs):
+            profiler._import_depth += 1
+            t0 = ttime.perf_counter()
+            try:
+                return real_import(*args, **kwargs)
+            finally:
+                profiler._import_depth -= 1
+                if profiler._import_depth == 0:
+                    profiler._import_time += ttime.perf_counter() - t0
+
+        builtins.__import__ = timed_import
+
+        def timed_connect(real):
+            def wait_for_connection(self, *args, **kwargs):
+                profiler._connect_depth += 1
+                t0 = ttime.perf_counter()
+                try:
+                    return real(self, *args, **kwargs)
+                finally:
+                    profiler._connect_depth -= 1
+                    if profiler._connect_depth == 0:
+                        profiler._connect_time += ttime.perf_counter() - t0
+            return wait_for_connection
+
+        for cls in (ophyd.signal.EpicsSignalBase, ophyd.Device):
+            cls.wait_for_connection = timed_connect(cls.wait_for_connection)
+
+        real_init = ophyd.signal.EpicsSignalBase.__init__
+
+        def counted_init(self, *args, **kwargs):
+            profiler._signals += 1
+            real_init(self, *args, **kwargs)
+
+        ophyd.signal.EpicsSignalBase.__init__ = counted_init
+
+    def measure(self, fname, run):
+        "Call run() and record what it cost under the name fname."
+        self.install()
+        counters = (self._import_time, self._connect_time, self._signals, len(sys.modules))
+        t0 = ttime.perf_counter()
+        try:
+            return run()
+        finally:
+            self.rows.append({
+                'file': fname,
+                'wall': ttime.perf_counter() - t0,
+                'imports': self._import_time - counters[0],
+                'modules': len(sys.modules) - counters[3],
+                'pv_connect': self._connect_time - counters[1],
+                'signals': self._signals - counters[2],
+            })
+
+    def note(self, fname, what):
+        self.rows.append({'file': fname, 'wall': 0., 'imports': 0., 'modules': 0,
+                          'pv_connect': 0., 'signals': 0, 'note': what})
+
+    def report(self, top=5):
+        total = sum(row['wall'] for row in self.rows)
+        print(f"\n{'startup file':<32}{'wall s':>9}{'import s':>10}{'modules':>9}"
+              f"{'PV conn s':>11}{'signals':>9}")
+        for row in self.rows:
+            print(f"{row['file']:<32}{row['wall']:>9.2f}{row['imports']:>10.2f}{row['modules']:>9d}"
+                  f"{row['pv_connect']:>11.2f}{row['signals']:>9d}  {row.get('note', '')}")
+        print(f"{'total':<32}{total:>9.2f}")
+        slowest = sorted(self.rows, key=lambda row: row['wall'], reverse=True)[:top]
+        print("slowest: " + ", ".join(f"{row['file']} ({row['wall']:.1f} s)" for row in slowest))
+
+
+_MISSING = object()
+
+
+class LazyStartupName:
+    """
+    Stands in for a name defined by a startup file that has not run yet.
+    Attribute access, calls, indexing and iteration run the file and are
+    then forwarded to the real object.
+    """
+
+    def __init__(self, loader, name):
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_name', name)
+
+    def _resolve(self):
+        return self._loader.load()[self._name]
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def __contains__(self, item):
+        return item in self._resolve()
+
+    def __repr__(self):
+        return f"<{self._name} from {os.path.basename(self._loader.path)}, not loaded yet>"
+
+
+class LazyStartupFile:
+    "Runs one startup file into the user namespace the first time it is needed."
+
+    def __init__(self, shell, path, execfile):
+        self.shell = shell
+        self.path = path
+        self._execfile = execfile
+        self.names, self.imported = _top_level_names(path)
+        self.loaded = False
+        self._loading = False
+
+    def install(self):
+        ns = self.shell.user_ns
+        for name in self.names:
+            # modules like np or plt that an earlier file already imported
+            # must not drag this file in when touched
+            if name in self.imported and name in ns:
+                continue
+            ns[name] = LazyStartupName(self, name)
+
+    def load(self):
+        if self.loaded:
+            return self.shell.user_ns
+        if self._loading:
+            raise RuntimeError(f"{self.path} uses one of its own names before defining it")
+        self._loading = True
+        ns = self.shell.user_ns
+        before = {name: ns.get(name, _MISSING) for name in self.names}
+        print(f"Loading {self.path} on first use...")
+        try:
+            self._execfile(self.path, ns, raise_exceptions=True)
+        finally:
+            self._loading = False
+        # Names that a later startup file has taken over since keep the later
+        # value, as they would have if this file had run in order.
+        for name, value in before.items():
+            owned = value is _MISSING or (
+                isinstance(value, LazyStartupName) and value._loader is self)
+            if not owned:
+                ns[name] = value
+        self.loaded = True
+        return ns
+
+
+def _top_level_names(path):
+    """
+    Names bound at module level by a file (defs, classes, assignments,
+    imports), and the subset bound by imports.
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    imported = set()
+
+    def targets(node):
+        if isinstance(node, ast.Name):
+            names.append(node.id)
+        elif isinstance(node, (ast.Tuple, ast.List)):
+            for elt in node.elts:
+                targets(elt)
+
+    def visit(body):
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.append(node.name)
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    targets(target)
+            elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+                targets(node.target)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    if alias.name != '*':
+                        names.append(alias.asname or alias.name.split('.')[0])
+                        imported.add(names[-1])
+            elif isinstance(node, (ast.If, ast.Try, ast.With, ast.For, ast.While)):
+                for field in ('body', 'orelse', 'finalbody'):
+                    visit(getattr(node, field, []))
+                for handler in getattr(node, 'handlers', []):
+                    visit(handler.body)
+
+    visit(tree.body)
+    names = list(dict.fromkeys(n for n in names if not n.startswith('__')))
+    return names, imported
+
+
+def _lazy_startup_files():
+    setting = os.environ.get('XPD_LAZY_STARTUP', '')
+    if setting.lower() in ('', '0', 'false', 'no'):
+        return set()
+    if setting.lower() in ('1', 'true', 'yes'):
+        return set(DEFAULT_LAZY_STARTUP_FILES)
+    return {name.strip() for name in setting.split(',') if name.strip()}
+
+
+def _install_startup_hooks(shell):
+    startup_dir = os.path.dirname(os.path.abspath(__file__))
+    startup_files = sorted(glob.glob(os.path.join(startup_dir, '*.py')) +
+                           glob.glob(os.path.join(startup_dir, '*.ipy')))
+    last_file = os.path.basename(startup_files[-1]) if startup_files else None
+    lazy_files = _lazy_startup_files()
+    profiler = StartupProfiler() if os.environ.get('XPD_PROFILE_STARTUP') else None
+    execfile = shell.safe_execfile
+
+    def safe_execfile(fname, *args, **kwargs):
+        base = os.path.basename(fname)
+        if os.path.dirname(os.path.abspath(fname)) != startup_dir:
+            return execfile(fname, *args, **kwargs)
+        if base in lazy_files:
+            lazy = LazyStartupFile(shell, fname, execfile)
+            lazy.install()
+            lazy_startup[base] = lazy
+            print(f"Deferring {fname} ({len(lazy.names)} names) until first use")
+            if profiler is not None:
+                profiler.note(base, 'lazy')
+        elif profiler is not None:
+            profiler.measure(base, lambda: execfile(fname, *args, **kwargs))
+        else:
+            execfile(fname, *args, **kwargs)
+        if base == last_file and profiler is not None:
+            profiler.report()
+
+    shell.safe_execfile = safe_execfile
+    return profiler
+
+
+def load_lazy_startup():
+    "Run every startup file that lazy mode has deferred."
+    for lazy in lazy_startup.values():
+        lazy.load()
+
+
+lazy_startup = {}
+_shell = get_ipython()
+if _shell is not None and hasattr(_shell, 'safe_execfile'):
+    startup_profiler = _install_startup_hooks(_shell)
+    if startup_profiler is not None:
+        # this file's own share of the startup happens before the hook exists
+        startup_profiler.install()
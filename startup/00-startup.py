@@ -1,11 +1,17 @@
 # Make ophyd listen to pyepics.
+import atexit
+import itertools
 import nslsii
 import ophyd.signal
 import logging
 import os
+import queue
+import sys
+import threading
 import time as ttime
 from IPython import get_ipython
 from databroker import Broker
+from event_model import pack_event_page
 from tiled.client import from_profile
 
 ip = get_ipython()
@@ -40,34 +46,228 @@ ip = get_ipython()
 ip.prompts = ProposalIDPrompt(ip)
 
 class TiledInserter:
-    
-    def __init__(self, tiled_writing_client):
-        
+    """
+    Post documents to Tiled from a background thread.
+
+    ``insert`` only puts the document on a bounded queue, so the RunEngine
+    subscription returns immediately no matter how Tiled is doing. A writer
+    thread drains the queue in batches, coalesces consecutive Events from the
+    same descriptor into a single EventPage and posts them with the retry loop.
+
+    If a ``spool`` (see scripts/tiled_spool.py) is given, every document is
+    journaled to local disk before it is queued. When Tiled stops answering,
+    or the queue overflows, the writer goes offline: it stops posting from
+    the queue and instead replays the journal in order every
+    ``retry_interval`` seconds until it has caught up. Leftovers from a
+    previous session are replayed first.
+
+    Without a spool, what happens when the queue is full is set by
+    ``overflow``:
+
+    * 'block' -- wait for room (default, nothing is ever lost)
+    * 'drop'  -- discard the incoming Event; all other documents still block
+    * 'raise' -- raise ``queue.Full`` on the RunEngine thread
+    """
+
+    ATTEMPTS = 20
+    SPOOLED_ATTEMPTS = 3
+    RETRY_DELAY = 2
+
+    def __init__(self, tiled_writing_client, *, spool=None, max_queue_size=10_000,
+                 max_batch_size=1_000, overflow="block", retry_interval=30):
+        if overflow not in ("block", "drop", "raise"):
+            raise ValueError(
+                f"overflow must be 'block', 'drop' or 'raise', not {overflow!r}")
         self.tiled_writing_client = tiled_writing_client
-        
+        self.spool = spool
+        self.max_batch_size = max_batch_size
+        self.overflow = overflow
+        self.retry_interval = retry_interval
+        self.dropped = 0
+        self.error = None
+        # Anything left over from a previous session has to go first.
+        self.offline = spool is not None and spool.pending() > 0
+        self._last_replay = -float("inf")
+        self._insert_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="tiled-inserter",
+                                        daemon=True)
+        self._thread.start()
+
     def insert(self, name, doc):
-        ATTEMPTS = 20
-        error = None
-        
-        for attempt in range(ATTEMPTS):
+        if self.spool is not None:
+            with self._insert_lock:
+                seq = self.spool.append(name, doc)
+                try:
+                    self._queue.put_nowait((seq, name, doc))
+                except queue.Full:
+                    # Safe on disk; the writer picks it up from the journal.
+                    self.offline = True
+            return
+        if self.overflow == "block" or (self.overflow == "drop" and name != "event"):
+            self._queue.put((None, name, doc))
+            return
+        try:
+            self._queue.put_nowait((None, name, doc))
+        except queue.Full:
+            if self.overflow == "raise":
+                raise
+            self.dropped += 1
+
+    def pending(self):
+        "Number of documents not yet in Tiled (queued, or journaled if spooling)."
+        if self.spool is not None:
+            return self.spool.pending()
+        return self._queue.qsize()
+
+    def flush(self):
+        "Block until the queue is drained. Offline, documents stay in the spool."
+        self._queue.join()
+
+    def close(self, timeout=None):
+        "Drain the queue and stop the writer thread."
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self.spool is not None and not self._thread.is_alive():
+            self.spool.close()
+
+    def _run(self):
+        while True:
+            try:
+                # Offline, wake up periodically to retry the journal.
+                batch = [self._queue.get(timeout=self.retry_interval if self.offline else None)]
+            except queue.Empty:
+                batch = []
+            try:
+                while len(batch) < self.max_batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in batch
+            try:
+                self._handle([item for item in batch if item is not None])
+            except Exception:
+                logger.exception("Unexpected failure in the Tiled writer thread")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _handle(self, batch):
+        if self.spool is None:
+            for _, name, doc in self._coalesce(batch):
+                self._post(name, doc)
+            return
+        if not self.offline:
+            # Skip what a replay already covered; a gap means something
+            # overflowed and only the journal has it.
+            batch = [item for item in batch if item[0] > self.spool.acked]
+            seqs = [self.spool.acked] + [seq for seq, _, _ in batch]
+            if any(b != a + 1 for a, b in zip(seqs, seqs[1:])):
+                self.offline = True
+            else:
+                try:
+                    for seq, name, doc in self._coalesce(batch):
+                        self._post(name, doc, attempts=self.SPOOLED_ATTEMPTS)
+                        self.spool.ack(seq)
+                except Exception:
+                    logger.warning("Tiled unreachable, spooling documents to %s",
+                                   self.spool.directory)
+                    self.offline = True
+        if self.offline:
+            self._replay()
+
+    def _replay(self):
+        now = ttime.monotonic()
+        if now - self._last_replay < self.retry_interval:
+            return
+        self._last_replay = now
+        records = self.spool.unacked()
+        try:
+            while True:
+                chunk = list(itertools.islice(records, self.max_batch_size))
+                if not chunk:
+                    break
+                for seq, name, doc in self._coalesce(chunk):
+                    self.tiled_writing_client.post_document(name, doc)
+                    self.spool.ack(seq)
+        except Exception as exc:
+            self.error = exc
+            logger.warning("Tiled still unreachable, %d documents spooled: %r",
+                           self.spool.pending(), exc)
+            return
+        self.offline = False
+        logger.info("Spooled documents replayed, posting to Tiled directly again")
+
+    @staticmethod
+    def _coalesce(batch):
+        """
+        Merge runs of Events sharing a descriptor into EventPages.
+
+        Takes and yields (seq, name, doc); a page carries the seq of its last Event.
+        """
+        events = []
+        for seq, name, doc in batch:
+            if name == "event" and (not events or events[-1][1]["descriptor"] == doc["descriptor"]):
+                events.append((seq, doc))
+                continue
+            if events:
+                yield TiledInserter._page(events)
+                events = []
+            if name == "event":
+                events.append((seq, doc))
+            else:
+                yield seq, name, doc
+        if events:
+            yield TiledInserter._page(events)
+
+    @staticmethod
+    def _page(events):
+        seq = events[-1][0]
+        if len(events) == 1:
+            return seq, "event", events[0][1]
+        return seq, "event_page", pack_event_page(*(doc for _, doc in events))
+
+    def _post(self, name, doc, attempts=None):
+        attempts = attempts or self.ATTEMPTS
+        for attempt in range(attempts):
             try:
                 self.tiled_writing_client.post_document(name, doc)
             except Exception as exc:
                 print("Document saving failure:", repr(exc))
-                error = exc
+                self.error = exc
             else:
-                break
-            ttime.sleep(2)
-        else:
-            # Out of attempts
-            raise error
-
+                return
+            ttime.sleep(self.RETRY_DELAY)
+        if self.spool is not None:
+            raise self.error
+        # Out of attempts; nothing is raised on the RunEngine thread anymore.
+        logger.error("Giving up on %s document after %d attempts: %r",
+                     name, attempts, self.error)
+
+
+# Local write-ahead journal for documents headed to Tiled; see scripts/tiled_spool.py.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+from tiled_spool import DEFAULT_SPOOL_DIR, SpoolLocked, TiledSpool
+
+try:
+    tiled_spool = TiledSpool(
+        os.path.join(DEFAULT_SPOOL_DIR, "qs" if is_re_worker_active() else "bsui"))
+except SpoolLocked as err:
+    print(f"WARNING: {err}; documents will not be spooled in this session.")
+    tiled_spool = None
+if tiled_spool is not None and tiled_spool.pending():
+    print(f"{tiled_spool.pending()} documents left over in {tiled_spool.directory} "
+          "will be replayed to Tiled in the background.")
 
 # Define tiled catalog
 tiled_writing_client = from_profile(
     "nsls2", api_key=os.environ["TILED_BLUESKY_WRITING_API_KEY_XPD"]
 )["xpd"]["raw"]
-tiled_inserter = TiledInserter(tiled_writing_client)
+tiled_inserter = TiledInserter(tiled_writing_client, spool=tiled_spool)
+# Give queued documents a chance to reach Tiled when the session ends.
+atexit.register(tiled_inserter.close, timeout=60)
 if not is_re_worker_active():
     c = tiled_reading_client = from_profile("nsls2")["xpd"]["raw"]
     db = Broker(c)
@@ -85,6 +285,13 @@ nslsii.configure_base(
     redis_url="info.xpd.nsls2.bnl.gov",
 )
 
+# RE.md lives in Redis; keep a local copy of it so reads do not cost a round
+# trip each. See scripts/cached_redis_dict.py; RE.md.stats() shows hit rate
+# and staleness.
+from cached_redis_dict import CachedRedisJSONDict
+
+RE.md = CachedRedisJSONDict.wrap(RE.md)
+
 del one_1d_step
 del one_nd_step
 del one_shot
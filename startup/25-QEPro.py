@@ -1,5 +1,7 @@
 from gc import collect
+import json
 import logging
+import os
 import time
 
 import epics
@@ -9,6 +11,97 @@ from ophyd import (Device, Component as Cpt, FormattedComponent as FC,
 from ophyd import (EpicsSignal, EpicsSignalRO, DeviceStatus, DerivedSignal)
 from ophyd.areadetector import EpicsSignalWithRBV as SignalWithRBV
 from ophyd.status import SubscriptionStatus
+from spectra_export import write_spectra_csv
+
+
+class QEProSpectrumCache:
+    """
+    The dark and reference spectra of a QEPro, keyed by the settings they
+    were taken with.
+
+    The key is (QEPro name, 'Dark' or 'Reference', integration_time,
+    num_spectra, buff_capacity, electric_dark_correction, and the state of
+    every signal in *light_sources*, e.g. the deuterium and halogen lamps of
+    28-Lights_shutter.py). Entries older than *max_age* seconds, or taken
+    under another data session, are treated as missing. With
+    *drift_tolerance* set, QEPro.use_cached_ref_bkg also checks a single
+    spectrum against the cached one and re-acquires when their relative RMS
+    difference is larger. The cache is written to *path* on every update
+    and read back when the profile starts.
+
+    Example::
+
+        qepro_spectrum_cache.max_age = 600          # re-take every 10 minutes
+        qepro_spectrum_cache.drift_tolerance = 0.02
+        qepro_spectrum_cache.clear()                # force fresh ones
+    """
+
+    def __init__(self, path=os.path.expanduser("~/.cache/xpd/qepro_spectra.json"),
+                 max_age=3600, drift_tolerance=None, light_sources=()):
+        self.path = path
+        self.max_age = max_age
+        self.drift_tolerance = drift_tolerance
+        self.light_sources = list(light_sources)
+        self._entries = {}
+        self.load()
+
+    def key(self, qepro, kind):
+        return "|".join(map(str, (
+            qepro.name, kind,
+            qepro.integration_time.get(),
+            qepro.num_spectra.get(),
+            qepro.buff_capacity.get(),
+            qepro.electric_dark_correction.get(),
+            *(sig.get() for sig in self.light_sources))))
+
+    def get(self, qepro, kind, max_age=None):
+        "Return a valid cached *kind* ('Dark' or 'Reference') spectrum, or None."
+        entry = self._entries.get(self.key(qepro, kind))
+        if entry is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if time.time() - entry["time"] > max_age:
+            return None
+        if entry["data_session"] != RE.md.get("data_session"):
+            return None
+        return entry["spectrum"]
+
+    def put(self, qepro, kind, spectrum):
+        self._entries[self.key(qepro, kind)] = {
+            "time": time.time(),
+            "data_session": RE.md.get("data_session"),
+            "spectrum": np.array(spectrum, dtype=float),
+        }
+        self.save()
+
+    def clear(self):
+        self._entries.clear()
+        self.save()
+
+    def save(self):
+        state = {key: dict(entry, spectrum=entry["spectrum"].tolist())
+                 for key, entry in self._entries.items()}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            print(f"Ignoring unreadable QEPro spectrum cache {self.path}: {err}")
+            return
+        for key, entry in state.items():
+            self._entries[key] = dict(entry, spectrum=np.array(entry["spectrum"]))
+
+
+# the lamps are added by 28-Lights_shutter.py
+qepro_spectrum_cache = QEProSpectrumCache()
+
 
 class QEProTEC(Device):
 
@@ -83,17 +176,20 @@ class QEPro(Device):
     buff_capacity = Cpt(SignalWithRBV, 'BUFF_CAPACITY')
     buff_element_count = Cpt(EpicsSignalRO, 'BUFF_ELEMENT_COUNT_RBV')
 
-    # Formatted Spectra
+    # Formatted Spectra. Dark and reference only change when they are
+    # re-taken, so they go into the descriptors (read_configuration) and not
+    # into every event; QEProRunReader (32-data_export.py) repeats them over
+    # the events again.
     output = Cpt(EpicsSignal, 'OUTPUT', kind='normal')
     sample = Cpt(EpicsSignal, 'SAMPLE', kind='normal')
-    dark = Cpt(EpicsSignal, 'DARK', kind='normal')
-    reference = Cpt(EpicsSignal, 'REFERENCE', kind='normal')
+    dark = Cpt(EpicsSignal, 'DARK', kind='config')
+    reference = Cpt(EpicsSignal, 'REFERENCE', kind='config')
 
     # Length of spectrum (in pixels)
     formatted_spectrum_len = Cpt(EpicsSignalRO, 'FORMATTED_SPECTRUM_LEN_RBV')
 
     # X-axis format and array
-    x_axis = Cpt(EpicsSignal, 'X_AXIS', kind='normal')
+    x_axis = Cpt(EpicsSignal, 'X_AXIS', kind='config')
     x_axis_format = Cpt(SignalWithRBV, 'X_AXIS_FORMAT')
 
     # Dark/Ref available signals
@@ -152,13 +248,15 @@ class QEPro(Device):
         time.sleep(1)
         self.spectrum_type.put(current_spectrum)
 
-    def get_dark_frame2(self):
+    def get_dark_frame2(self, cache=qepro_spectrum_cache):
 
         current_spectrum = self.spectrum_type.get()
         yield from bps.abs_set(self.spectrum_type, 'Dark', wait=True)
         yield from bps.abs_set(self.acquire, 1, wait=True)
         yield from bps.sleep(1)
         yield from bps.abs_set(self.spectrum_type, current_spectrum, wait=True)
+        if cache is not None:
+            cache.put(self, 'Dark', self.dark.get())
 
 
     def get_reference_frame(self):
@@ -170,64 +268,124 @@ class QEPro(Device):
         self.spectrum_type.put(current_spectrum)
 
 
-    def get_reference_frame2(self):
+    def get_reference_frame2(self, cache=qepro_spectrum_cache):
 
         current_spectrum = self.spectrum_type.get()
         yield from bps.abs_set(self.spectrum_type, 'Reference', wait=True)
         yield from bps.abs_set(self.acquire, 1, wait=True)
         yield from bps.sleep(1)
         yield from bps.abs_set(self.spectrum_type, current_spectrum, wait=True)
-
-
-    def take_ref_bkg(self, integration_time=15, num_spectra_to_average=16, buffer=3, electric_dark_correction=True):
+        if cache is not None:
+            cache.put(self, 'Reference', self.reference.get())
+
+
+    def use_cached_ref_bkg(self, cache=qepro_spectrum_cache, drift_tolerance=None,
+                           check_reference=False):
+        """
+        Plan: if *cache* holds a valid dark and reference for the current
+        settings, put them back into the IOC (when it holds others) and
+        return True; return False if either has to be acquired.
+
+        With a drift tolerance (*drift_tolerance*, else cache.drift_tolerance)
+        a single spectrum is taken with the lamp shuttered and the cached
+        ones are rejected if it differs from the dark by more than that
+        relative RMS. With check_reference=True (only meaningful with the
+        blank in the cell) the same is done with the shutter open against
+        the reference.
+        """
+        if cache is None:
+            return False
+        spectra = {kind: cache.get(self, kind) for kind in ('Dark', 'Reference')}
+        if any(spectrum is None for spectrum in spectra.values()):
+            return False
+        drift_tolerance = cache.drift_tolerance if drift_tolerance is None else drift_tolerance
+        if drift_tolerance is not None:
+            checks = [('Dark', 'Low')] + [('Reference', 'High')] * check_reference
+            for kind, shutter in checks:
+                yield from optical_sources.mv(LED, 'Low', UV_shutter, shutter, detector=self)
+                drift = yield from self._drift(spectra[kind])
+                if drift > drift_tolerance:
+                    print(f'Cached {kind.lower()} drifted by {drift:.3f} > {drift_tolerance}, re-acquiring.')
+                    return False
+            yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
+
+        for kind, sig in (('Dark', self.dark), ('Reference', self.reference)):
+            if not np.array_equal(np.asarray(sig.get()), spectra[kind]):
+                yield from bps.abs_set(sig, spectra[kind], wait=True)
+        print('Using the cached dark and reference.')
+        return True
+
+
+    def _drift(self, spectrum):
+        # relative RMS difference of one raw spectrum from *spectrum*
+        settings = {self.collect_mode: 'Single', self.num_spectra: 1}
+        restore = {sig: sig.get() for sig in settings}
+        for sig, value in settings.items():
+            yield from bps.abs_set(sig, value, wait=True)
+        yield from bps.trigger(self, wait=True)
+        sample = np.asarray(self.sample.get(), dtype=float)
+        for sig, value in restore.items():
+            yield from bps.abs_set(sig, value, wait=True)
+        return np.sqrt(np.mean((sample - spectrum) ** 2) / np.mean(spectrum ** 2))
+
+
+    def take_ref_bkg(self, integration_time=15, num_spectra_to_average=16, buffer=3, electric_dark_correction=True,
+                     force=False):
         yield from self.setup_collection2(integration_time=integration_time, num_spectra_to_average=num_spectra_to_average, buffer=buffer,
                                          spectrum_type='Absorbtion', correction_type='Reference',
                                          electric_dark_correction=True)
+        if not force and (yield from self.use_cached_ref_bkg()):
+            return
         # yield from LED_off()
         # yield from shutter_close()
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', detector=self)
         yield from self.get_dark_frame2()
-        yield from bps.mv(UV_shutter, 'High')
+        yield from optical_sources.mv(UV_shutter, 'High', detector=self)
         yield from self.get_reference_frame2()
 
 
-    def take_ref_bkg2(self, integration_time=15, num_spectra_to_average=16, buffer=3, electric_dark_correction=True):
+    def take_ref_bkg2(self, integration_time=15, num_spectra_to_average=16, buffer=3, electric_dark_correction=True,
+                     force=False):
         yield from self.setup_collection2(integration_time=integration_time, num_spectra_to_average=num_spectra_to_average, buffer=buffer,
                                          spectrum_type='Absorbtion', correction_type='Reference',
                                          electric_dark_correction=True)
+        # on a cache hit the runs still record the (cached) dark and reference
+        cached = not force and (yield from self.use_cached_ref_bkg())
         # yield from LED_off()
         # yield from shutter_close()
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
-        yield from bps.sleep(5)
-        yield from self.get_dark_frame2()
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', detector=self)
+        if not cached:
+            yield from self.get_dark_frame2()
         yield from count([self])
-        yield from bps.mv(UV_shutter, 'High')
-        yield from bps.sleep(5)
-        yield from self.get_reference_frame2()
+        yield from optical_sources.mv(UV_shutter, 'High', detector=self)
+        if not cached:
+            yield from self.get_reference_frame2()
         yield from count([self])
 
 
     def take_ref_bkg3(self, integration_time=15, num_spectra_to_average=16,
-                      buffer=3, electric_dark_correction=True, ref_name='test', csv_path=None):
+                      buffer=3, electric_dark_correction=True, ref_name='test', csv_path=None, force=False):
         yield from self.setup_collection2(integration_time=integration_time, num_spectra_to_average=num_spectra_to_average, buffer=buffer,
                                          spectrum_type='Absorbtion', correction_type='Reference',
                                          electric_dark_correction=True)
+        # on a cache hit the runs still record, and export, the cached spectra
+        cached = not force and (yield from self.use_cached_ref_bkg())
         # yield from LED_off()
         # yield from shutter_close()
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
-        yield from bps.sleep(5)
-        yield from self.get_dark_frame2()
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', detector=self)
+        if not cached:
+            yield from self.get_dark_frame2()
         uid = (yield from count([self], md = {'note':'Dark'}))
         if csv_path != None:
             print(f'Export dark file to {csv_path}...')
             self.export_from_scan(uid, csv_path, sample_type=f'Dark_{integration_time}ms')
 
-        yield from bps.mv(UV_shutter, 'High')
-        yield from bps.sleep(2)
-        yield from self.get_reference_frame2()
+        yield from optical_sources.mv(UV_shutter, 'High', detector=self)
+        if not cached:
+            yield from self.get_reference_frame2()
         uid = (yield from count([self], md = {'note':ref_name}))
 
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
 
         if csv_path != None:
             print(f'Export reference file to {csv_path}...')
@@ -315,24 +473,19 @@ class QEPro(Device):
 
         print(f'Writing out CSV file to {write_path}...')
 
-        with open(write_path, 'w') as fp:
-            x_axis_data = self.x_axis.get()
-            output_data = self.output.get()
-            sample_data = self.sample.get()
-            dark_data = self.dark.get()
-            reference_data = self.reference.get()
-            if self.spectrum_type.get(as_string=True) == 'Absorbtion':
-                fp.write('Energy,Dark,Reference,Sample,Absorbtion\n')
-            else:
-                fp.write('Energy,Dark,Raw Sample,Corrected Sample\n')
-
-            for i in range(len(output_data)):
-                if self.spectrum_type.get(as_string=True) == 'Absorbtion':
-                    fp.write(f'{x_axis_data[i]},{dark_data[i]},{reference_data[i]},{sample_data[i]},{output_data[i]}\n')
-                else:
-                    fp.write(f'{x_axis_data[i]},{dark_data[i]},{sample_data[i]},{output_data[i]}\n')
+        x_axis_data = self.x_axis.get()
+        output_data = self.output.get()
+        sample_data = self.sample.get()
+        dark_data = self.dark.get()
+        if self.spectrum_type.get(as_string=True) == 'Absorbtion':
+            header = ['Energy,Dark,Reference,Sample,Absorbtion']
+            columns = [x_axis_data, dark_data, self.reference.get(), sample_data, output_data]
+        else:
+            header = ['Energy,Dark,Raw Sample,Corrected Sample']
+            columns = [x_axis_data, dark_data, sample_data, output_data]
+        write_spectra_csv(write_path, header, columns)
 
-            print('Done.')
+        print('Done.')
 
     def plot_spectra(self):
         x_axis_data = self.x_axis.get()
@@ -386,8 +539,7 @@ class QEPro(Device):
                 yield from bps.abs_set(self.spectrum_type, spectrum_type, wait=True)
                 # yield from LED_off()
                 # yield from shutter_open()
-                yield from bps.mv(LED, 'Low', UV_shutter, 'High')
-                yield from bps.sleep(2)
+                yield from optical_sources.mv(LED, 'Low', UV_shutter, 'High', detector=self)
                 uid = (yield from count([self], md=_md))
 
 
@@ -399,11 +551,10 @@ class QEPro(Device):
                 yield from bps.abs_set(self.spectrum_type, spectrum_type, wait=True)
                 # yield from shutter_close()
                 # yield from LED_on()
-                yield from bps.mv(LED, 'High', UV_shutter, 'Low')
-                yield from bps.sleep(2)
+                yield from optical_sources.mv(LED, 'High', UV_shutter, 'Low', detector=self)
                 uid = (yield from count([self], md=_md))
 
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
 
         if csv_path!=None or plot==True:
             yield from bps.sleep(2)
@@ -413,86 +564,39 @@ class QEPro(Device):
         if wait==True:
             time.sleep(2)
 
+        # Everything below is served from one fetch of the run (see
+        # QEProRunReader in 32-data_export.py).
+        run = QEProRunReader(uid, data_agent=data_agent)
+        primary = run.stream('primary')
+
         if data_agent == 'db':
-            unix_time = db[uid].start['time']
-            date, time = _readable_time(unix_time)
-
-            x_axis_data = db[uid].table().QEPro_x_axis[1]
-            output_data = db[uid].table().QEPro_output[1]
-            sample_data = db[uid].table().QEPro_sample[1]
-            dark_data = db[uid].table().QEPro_dark[1]
-            reference_data = db[uid].table().QEPro_reference[1]
-            spectrum_type = db[uid].table().QEPro_spectrum_type[1]
-            int_time = db[uid].table().QEPro_integration_time[1]
-            num_average = db[uid].table().QEPro_num_spectra[1]
-            boxcar_width = db[uid].table().QEPro_buff_capacity[1]
-
-            full_uid = db[uid].start['uid']
-
-            metadata_list=['pumps','precursors','infuse_rate','infuse_rate_unit','pump_status',
-                           'mixer','sample_type']
-            if 'pumps' in db[uid].start.keys():
-                pump_names = db[uid].start['pumps']
-            else: pump_names = ['None']
-            if 'precursors' in db[uid].start.keys():
-                precursor = db[uid].start['precursors']
-            else: precursor = ['None']
-            if 'infuse_rate' in db[uid].start.keys():
-                infuse_rate = db[uid].start['infuse_rate']
-            else: infuse_rate = ['None']
-            if 'infuse_rate_unit' in db[uid].start.keys():
-                infuse_rate_unit = db[uid].start['infuse_rate_unit']
-            else: infuse_rate_unit = ['None']
-            if 'pump_status' in db[uid].start.keys():
-                pump_status = db[uid].start['pump_status']
-            else: pump_status = ['None']
-            if 'mixer' in db[uid].start.keys():
-                mixer = db[uid].start['mixer']
-            else: mixer = ['None']
-            if 'sample_type' in db[uid].start.keys():
-                sample_type = db[uid].start['sample_type']
-            # else: sample_type = None
-
-
-        if data_agent == 'tiled':
-            run = tiled_client[uid]
-            ds = run.primary.read()
-            meta = run.metadata
-
-            date, time = _readable_time(int(ds['time'][0]))
-            x_axis_data = ds['QEPro_x_axis'].values[0]
-            output_data = ds['QEPro_output'].values[0]
-            sample_data = ds['QEPro_sample'].values[0]
-            dark_data = ds['QEPro_dark'].values[0]
-            reference_data = ds['QEPro_reference'].values[0]
-            spectrum_type = ds['QEPro_spectrum_type'].values[0]
-            int_time = ds['QEPro_integration_time'].values[0]
-            num_average = ds['QEPro_num_spectra'].values[0]
-            boxcar_width = ds['QEPro_buff_capacity'].values[0]
-
-            full_uid = meta['start']['uid']
-
-            if 'pumps' in meta['start'].keys():
-                pump_names = meta['start']['pumps']
-            else: pump_names = ['None']
-            if 'precursors' in meta['start'].keys():
-                precursor = meta['start']['precursors']
-            else: precursor = ['None']
-            if 'infuse_rate' in meta['start'].keys():
-                infuse_rate = meta['start']['infuse_rate']
-            else: infuse_rate = ['None']
-            if 'infuse_rate_unit' in meta['start'].keys():
-                infuse_rate_unit = meta['start']['infuse_rate_unit']
-            else: infuse_rate_unit = ['None']
-            if 'pump_status' in meta['start'].keys():
-                pump_status = meta['start']['pump_status']
-            else: pump_status = ['None']
-            if 'mixer' in meta['start'].keys():
-                mixer = meta['start']['mixer']
-            else: mixer = ['None']
-            if 'sample_type' in meta['start'].keys():
-                sample_type = meta['start']['sample_type']
-            # else: sample_type = None
+            unix_time = run.start['time']
+        else:
+            unix_time = int(primary['time'][0])
+        date, clock = _readable_time(unix_time)
+
+        x_axis_data = primary['QEPro_x_axis'][0]
+        output_data = primary['QEPro_output'][0]
+        sample_data = primary['QEPro_sample'][0]
+        dark_data = primary['QEPro_dark'][0]
+        reference_data = primary['QEPro_reference'][0]
+        spectrum_type = primary['QEPro_spectrum_type'][0]
+        int_time = primary['QEPro_integration_time'][0]
+        num_average = primary['QEPro_num_spectra'][0]
+        boxcar_width = primary['QEPro_buff_capacity'][0]
+
+        full_uid = run.uid
+
+        meta = run.metadata(['pumps', 'precursors', 'infuse_rate', 'infuse_rate_unit',
+                             'pump_status', 'mixer'], default=['None'])
+        pump_names = meta['pumps']
+        precursor = meta['precursors']
+        infuse_rate = meta['infuse_rate']
+        infuse_rate_unit = meta['infuse_rate_unit']
+        pump_status = meta['pump_status']
+        mixer = meta['mixer']
+        if 'sample_type' in run.start:
+            sample_type = run.start['sample_type']
 
 
         if plot == True:
@@ -511,15 +615,15 @@ class QEPro(Device):
 
             if spectrum_type == 3:
                 spec = 'Abs'
-                fout = f'{csv_path}/{sample_type}_{spec}_{date}-{time}_{uid[0:8]}.csv'
+                fout = f'{csv_path}/{sample_type}_{spec}_{date}-{clock}_{uid[0:8]}.csv'
 
             if spectrum_type == 2:
                 spec = 'PL'
-                fout = f'{csv_path}/{sample_type}_{spec}_{date}-{time}_{uid[0:8]}.csv'
+                fout = f'{csv_path}/{sample_type}_{spec}_{date}-{clock}_{uid[0:8]}.csv'
 
             with open(fout, 'w') as fp:
                 fp.write(f'uid,{full_uid}\n')
-                fp.write(f'Time_QEPro,{date},{time}\n')
+                fp.write(f'Time_QEPro,{date},{clock}\n')
                 fp.write(f'Integration time (ms),{int_time}\n')
                 fp.write(f'Number of averaged spectra,{num_average}\n')
                 fp.write(f'Boxcar width,{boxcar_width}\n')
@@ -542,6 +646,166 @@ class QEPro(Device):
                     else:
                         fp.write(f'{x_axis_data[i]},{dark_data[i]},{sample_data[i]},{output_data[i]}\n')
 
+class QEProBurst:
+    """
+    *num_spectra* consecutive spectra of *qepro*, each kept with its own
+    timestamp, from one acquisition instead of a trigger round trip each.
+
+    kickoff sets the spectrometer to collect that many spectra without
+    averaging (collect_mode 'Single') and starts it. Every update of OUTPUT
+    and of SAMPLE is kept with the IOC's timestamp of it, and each OUTPUT is
+    paired with the SAMPLE posted closest to it. complete waits for the
+    acquisition to end, or fails after twice the expected time plus
+    *timeout* s. collect emits the spectra as one EventPage, a row per
+    spectrum. The settings are restored on complete.
+
+    That the IOC posts OUTPUT once per spectrum in Single mode is an
+    assumption; if fewer updates arrive than SPECTRA_COLLECTED reports,
+    collect says so.
+    """
+
+    def __init__(self, qepro, num_spectra, *, stream_name='primary', name=None, timeout=10):
+        self.qepro = qepro
+        self.num_spectra = num_spectra
+        self.stream_name = stream_name
+        self.name = name or f"{qepro.name}_burst"
+        self.timeout = timeout
+        self._updates = {}
+        self._restore = {}
+        self._subs = {}
+        self._done = None
+        self._collected = None
+
+    def _update(self, value, timestamp, obj, **kwargs):
+        self._updates[obj].append((timestamp, np.array(value)))
+
+    def kickoff(self):
+        q = self.qepro
+        settings = {q.collect_mode: 'Single', q.num_spectra: self.num_spectra}
+        self._restore = {sig: sig.get() for sig in settings}
+        for sig, value in settings.items():
+            sig.set(value).wait()
+
+        self._updates = {q.output: [], q.sample: []}
+        self._subs = {sig: sig.subscribe(self._update, run=False) for sig in self._updates}
+        self._collected = None
+        expected = 1e-3 * q.integration_time.get() * self.num_spectra
+        self._done = SubscriptionStatus(
+            q.acquire, run=False, timeout=2 * expected + self.timeout,
+            callback=lambda value, old_value, **kwargs: old_value == 1 and value == 0)
+        q.acquire.put(1)
+        status = DeviceStatus(self)
+        status.set_finished()
+        return status
+
+    def complete(self):
+        def stop(status):
+            for sig, sub in self._subs.items():
+                sig.unsubscribe(sub)
+            self._collected = self.qepro.spectra_collected.get()
+            for sig, value in self._restore.items():
+                sig.put(value)
+
+        self._done.add_callback(stop)
+        return self._done
+
+    def describe_collect(self):
+        q = self.qepro
+        return {self.stream_name: {**q.output.describe(), **q.sample.describe()}}
+
+    # x axis, dark and reference, once in the descriptor
+    def describe_configuration(self):
+        return self.qepro.describe_configuration()
+
+    def read_configuration(self):
+        return self.qepro.read_configuration()
+
+    def _pair(self):
+        # each OUTPUT with the SAMPLE nearest in time, if within half a spectrum
+        outputs = self._updates[self.qepro.output]
+        samples = self._updates[self.qepro.sample]
+        sample_times = np.array([t for t, _ in samples])
+        tolerance = .5e-3 * self.qepro.integration_time.get()
+        rows, unpaired = [], 0
+        for t, output in outputs:
+            i = int(np.argmin(np.abs(sample_times - t))) if samples else None
+            if i is None or abs(sample_times[i] - t) > tolerance:
+                unpaired += 1
+                sample = np.full_like(output, np.nan, dtype=float)
+            else:
+                sample = samples[i][1]
+            rows.append((t, output, sample))
+        if unpaired:
+            print(f"{self.name}: no SAMPLE within {tolerance:.3g} s of {unpaired} OUTPUT updates")
+        return rows
+
+    def collect_pages(self):
+        rows = self._pair()
+        if len(rows) < self.num_spectra:
+            print(f"{self.name}: {len(rows)} of {self.num_spectra} spectra were received, "
+                  f"the IOC reports {self._collected} collected")
+        if not rows:
+            return
+        times, output, sample = zip(*rows)
+        times = list(times)
+        yield {
+            "data": {self.qepro.output.name: list(output), self.qepro.sample.name: list(sample)},
+            "timestamps": {self.qepro.output.name: times, self.qepro.sample.name: times},
+            "time": times,
+        }
+
+
+def qepro_burst(qepro, num_spectra, *, integration_time=None, spectrum_type=None,
+                correction_type=None, md=None):
+    """
+    Record *num_spectra* single spectra of *qepro* as fast as it integrates
+    them, one event each with the spectrometer's timestamp (see QEProBurst).
+
+    Parameters
+    ----------
+    qepro : QEPro
+    num_spectra : int
+    integration_time : float, optional
+        In ms; the current one by default.
+    spectrum_type, correction_type : str, optional
+        e.g. 'Absorbtion' and 'Reference', or 'Corrected Sample' and 'Dark';
+        the current ones by default.
+    md : dict, optional
+
+    Examples
+    --------
+    PL every 20 ms for 2 s of mixing:
+
+    >>> RE(qepro_burst(qepro, 100, integration_time=20,
+    ...                spectrum_type='Corrected Sample', correction_type='Dark'))
+    """
+    flyer = QEProBurst(qepro, num_spectra)
+    for sig, value in ((qepro.integration_time, integration_time),
+                       (qepro.correction, correction_type),
+                       (qepro.spectrum_type, spectrum_type)):
+        if value is not None:
+            yield from bps.abs_set(sig, value, wait=True)
+    _md = {'detectors': [qepro.name],
+           'plan_name': 'qepro_burst',
+           'plan_args': {'qepro': repr(qepro), 'num_spectra': num_spectra,
+                         'integration_time': integration_time,
+                         'spectrum_type': spectrum_type, 'correction_type': correction_type},
+           'uvvis': [spectrum_type or qepro.spectrum_type.get(as_string=True),
+                     correction_type or qepro.correction.get(as_string=True),
+                     qepro.integration_time.get(), 1, qepro.buff_capacity.get()],
+           'sp_num_frames': num_spectra,
+           'sp_time_per_frame': 1e-3 * qepro.integration_time.get()}
+    _md.update(md or {})
+
+    @bpp.run_decorator(md=_md)
+    def inner():
+        yield from bps.kickoff(flyer, wait=True)
+        yield from bps.complete(flyer, wait=True)
+        yield from bps.collect(flyer)
+
+    return (yield from inner())
+
+
 from tiled.client.context import CannotPrompt
 try:
     from tiled.client import from_profile
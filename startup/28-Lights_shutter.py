@@ -1,5 +1,6 @@
 from ophyd import Device, EpicsMotor, EpicsSignal, EpicsSignalRO
 from ophyd import Component as Cpt
+from optical_sources import OpticalSources  # scripts/
 #import time
 #import pandas as pd
 #import numpy as np
@@ -17,6 +18,14 @@ halogen = EpicsSignal('XF:28IDC-ES:1{Light:Abs-Hal:1}Cmd', name='Halogen', strin
 UV_shutter = EpicsSignal('XF:28IDC-ES:1{Light:Abs-Sht:1}Cmd', name='UV_shutter', string=True, kind='hinted')
 # 0: 'Low' --> shutter close.; 1: 'High' --> Shutter open.
 
+# cached QEPro darks / references are only valid for the lamps they were taken with
+qepro_spectrum_cache.light_sources = [deuterium, halogen]
+
+# switch them with optical_sources.mv(LED, 'Low', UV_shutter, 'High'): no put
+# when already there, and done once qepro (or detector=...) reads a changed,
+# then steady intensity (scripts/optical_sources.py) instead of after a fixed sleep
+optical_sources = OpticalSources([LED, UV_shutter, deuterium, halogen], detector=qepro)
+
 
 def LED_on():
     yield from bps.abs_set(LED, 'High', wait=True)
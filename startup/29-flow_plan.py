@@ -190,30 +190,35 @@ def setup_collection_q(integration_time=100, num_spectra_to_average=10, buffer=3
 
 def take_ref_bkg_q(integration_time=15, num_spectra_to_average=16,
                    buffer=3, electric_dark_correction=True, ref_name='test',
-                   data_agent='db', csv_path=None):
+                   data_agent='db', csv_path=None, force=False):
 
     yield from qepro.setup_collection2(integration_time=integration_time,
                                        num_spectra_to_average=num_spectra_to_average, buffer=buffer,
                                        spectrum_type='Absorbtion', correction_type='Reference',
                                        electric_dark_correction=True)
 
+    # the dark and reference taken with these settings, if still valid
+    # (qepro_spectrum_cache in 25-QEPro.py); force=True re-takes them. On a
+    # cache hit the runs below still record, and export, the cached spectra.
+    cached = not force and (yield from qepro.use_cached_ref_bkg())
+
     # yield from LED_off()
     # yield from shutter_close()
-    yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
-    yield from bps.sleep(5)
-    yield from qepro.get_dark_frame2()
+    yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low')
+    if not cached:
+        yield from qepro.get_dark_frame2()
     uid = (yield from count([qepro], md = {'note':'Dark'}))
     print(f'Dark uid is {uid}')
     if csv_path != None:
         print(f'Export dark file to {csv_path}...')
         qepro.export_from_scan(uid, csv_path, sample_type=f'Dark_{integration_time}ms', data_agent=data_agent)
 
-    yield from bps.mv(UV_shutter, 'High')
-    yield from bps.sleep(2)
-    yield from qepro.get_reference_frame2()
+    yield from optical_sources.mv(UV_shutter, 'High')
+    if not cached:
+        yield from qepro.get_reference_frame2()
     uid = (yield from count([qepro], md = {'note':ref_name}))
     print(f'Reference uid is {uid}')
-    yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+    yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
 
     if csv_path != None:
         print(f'Export reference file to {csv_path}...')
@@ -277,8 +282,7 @@ def take_a_uvvis_csv_q(sample_type='test', plot=False, csv_path=None, data_agent
             yield from bps.abs_set(qepro.spectrum_type, spectrum_type, wait=True)
             # yield from LED_off()
             # yield from shutter_open()
-            yield from bps.mv(LED, 'Low', UV_shutter, 'High')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'Low', UV_shutter, 'High')
             uid = (yield from count_stream(qepro, stream_name="take_a_uvvis", md=_md))
     
     else:
@@ -290,12 +294,11 @@ def take_a_uvvis_csv_q(sample_type='test', plot=False, csv_path=None, data_agent
             yield from bps.abs_set(qepro.spectrum_type, spectrum_type, wait=True)
             # yield from shutter_close()
             # yield from LED_on()
-            yield from bps.mv(LED, 'High', UV_shutter, 'Low')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'High', UV_shutter, 'Low')
             uid = (yield from count_stream(qepro, stream_name="take_a_uvvis", md=_md))
 
     # yield from bps.create(name="take_a_uvvis")
-    yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+    yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
 
     if csv_path!=None or plot==True:
         yield from bps.sleep(2)
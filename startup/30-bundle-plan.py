@@ -153,8 +153,7 @@ def xray_uvvis_plan(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_t
             # yield from bps.abs_set(qepro.correction, correction_type, wait=True)
             # yield from bps.abs_set(qepro.spectrum_type, spectrum_type, wait=True)
             yield from bps.mv(det2.correction, correction_type, det2.spectrum_type, spectrum_type)
-            yield from bps.mv(LED, 'Low', UV_shutter, 'High')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'Low', UV_shutter, 'High', detector=det2)
 
         for i in range(num_abs):
             yield from bps.trigger(det2, wait=True)
@@ -176,8 +175,7 @@ def xray_uvvis_plan(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_t
             # yield from bps.abs_set(qepro.correction, correction_type, wait=True)
             # yield from bps.abs_set(qepro.syield from bps.sleep(xray_time)pectrum_type, spectrum_type, wait=True)
             yield from bps.mv(det2.correction, correction_type, det2.spectrum_type, spectrum_type)
-            yield from bps.mv(LED, 'High', UV_shutter, 'Low')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'High', UV_shutter, 'Low', detector=det2)
 
         for i in range(num_flu):  # TODO: fix the number of triggers
             yield from bps.trigger(det2, wait=True)
@@ -189,7 +187,7 @@ def xray_uvvis_plan(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_t
             yield from bps.save()  # TODO: check if it's needed, most likely yes.
             # yield from bps.sleep(2)
 
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
         # t1 = time.time()
         # xray_time = det1_time-(t1-t0)
         # print(f'{xray_time = }')
@@ -273,8 +271,7 @@ def xray_uvvis_plan2(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_
             # yield from bps.abs_set(qepro.correction, correction_type, wait=True)
             # yield from bps.abs_set(qepro.spectrum_type, spectrum_type, wait=True)
             yield from bps.mv(det2.correction, correction_type, det2.spectrum_type, spectrum_type)
-            yield from bps.mv(LED, 'Low', UV_shutter, 'High')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'Low', UV_shutter, 'High', detector=det2)
 
         for i in range(num_abs):
             yield from bps.trigger(det2, wait=True)
@@ -296,8 +293,7 @@ def xray_uvvis_plan2(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_
             # yield from bps.abs_set(qepro.correction, correction_type, wait=True)
             # yield from bps.abs_set(qepro.syield from bps.sleep(xray_time)pectrum_type, spectrum_type, wait=True)
             yield from bps.mv(det2.correction, correction_type, det2.spectrum_type, spectrum_type)
-            yield from bps.mv(LED, 'High', UV_shutter, 'Low')
-            yield from bps.sleep(2)
+            yield from optical_sources.mv(LED, 'High', UV_shutter, 'Low', detector=det2)
 
         for i in range(num_flu):  # TODO: fix the number of triggers
             yield from bps.trigger(det2, wait=True)
@@ -309,7 +305,7 @@ def xray_uvvis_plan2(det1, det2, *args, md=None, num_abs=10, num_flu=10, sample_
             yield from bps.save()  # TODO: check if it's needed, most likely yes.
             # yield from bps.sleep(2)
 
-        yield from bps.mv(LED, 'Low', UV_shutter, 'Low')
+        yield from optical_sources.mv(LED, 'Low', UV_shutter, 'Low', settle=False)
         try:  
             yield from stop_group([pump_list[-1]])
             print(f'\nUV-Vis acquisition finished and stop infusing of {pump_list[-1].name} for toluene dilution\n')
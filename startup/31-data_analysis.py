@@ -1,3 +1,4 @@
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -6,6 +7,7 @@ from scipy import integrate
 from scipy.optimize import curve_fit
 from scipy.signal import find_peaks
 # import 32-data_export as de
+from pl_batch_fit import PLFitPool  # scripts/, put on sys.path by 00-startup.py
 
 
 
@@ -206,6 +208,88 @@ def good_bad_data(x, y, key_height = 2000, data_id = 'test', distance=30, height
 
 
 
+## Same criteria as good_bad_data for a 2-D stack of spectra (one per row) sharing x.
+## The integrations and the c1 screen are done on the whole stack at once, so
+## find_peaks only runs on rows that could still be good.
+## Returns lists of peak2, prop2 per row with the meaning they have in good_bad_data.
+def good_bad_data_batch(x, y, key_height = 2000, data_id = 'test', distance=30, height=30, 
+                        c2_c3 = False, threshold=[560, 100000, 200000], int_boundary = [340, 400, 800], 
+                        dummy_test = False):
+
+    x = np.asarray(x)
+    if x.ndim == 2:
+        x = x[0]
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+
+    if (len(int_boundary)>=3 and c2_c3==True):
+        w1, _ = find_nearest(x, int_boundary[0])
+        w2, _ = find_nearest(x, int_boundary[1])
+        w3, _ = find_nearest(x, int_boundary[2])
+
+        LED_integration = integrate.simpson(y[:, w1:w2], axis=1)
+        PL_integration = integrate.simpson(y[:, w2:w3], axis=1)
+        peak_diff = PL_integration - LED_integration
+    else:
+        peak_diff = np.full(y.shape[0], np.nan)
+
+    # No peak can be higher than the highest point, so rows whose maximum
+    # (above 400 nm unless dummy_test) is below key_height fail c1 outright.
+    region = np.ones(x.shape, dtype=bool) if dummy_test else (x >= 400)
+    if region.any():
+        row_max = y[:, region].max(axis=1)
+    else:
+        row_max = np.zeros(y.shape[0])
+    maybe_good = row_max >= key_height
+
+    peaks, props = [], []
+    reasons = {'c1': 0, 'c2': 0, 'c3': 0, 'no peak': 0}
+    for i in range(y.shape[0]):
+        if not maybe_good[i]:
+            reasons['c1'] += 1
+            peaks.append([])
+            props.append([])
+            continue
+
+        peak, _ = find_peaks(y[i], height=height, distance=distance)
+        if dummy_test:
+            peak2 = peak
+        else:
+            peak2 = peak[x[peak] >= 400]
+        if len(peak2) == 0:
+            reasons['no peak'] += 1
+            peaks.append([])
+            props.append([])
+            continue
+
+        heights = y[i][peak2]
+        top = peak2[heights.argmax()]
+
+        bad = None
+        if heights.max() < key_height:
+            bad = 'c1'
+        elif c2_c3 == True and not np.isnan(peak_diff[i]):
+            if x[top] < threshold[0]:
+                bad = 'c2' if peak_diff[i] < threshold[1] else None
+            elif x[top] > threshold[0] and peak_diff[i] < threshold[2]:
+                bad = 'c3'
+
+        if bad:
+            reasons[bad] += 1
+            peaks.append([])
+            props.append([])
+        else:
+            peaks.append(np.asarray(peak2))
+            props.append({'peak_heights': list(heights)})
+
+    n_good = sum(1 for p in peaks if len(p))
+    n_bad = ', '.join(f'{v} by {k}' for k, v in reasons.items() if v)
+    print(f'{data_id}: {n_good} of {y.shape[0]} spectra are good.' + (f' Bad: {n_bad}.' if n_bad else ''))
+
+    return peaks, props
+
+
+
+
 
 
 def _1peak_fit_good_PL(x0, y0, fit_function, peak=False, maxfev=100000, fit_boundary=[340, 400, 800], raw_data=False,
@@ -378,6 +462,10 @@ def _identify_multi_in_kafka(qepro_dic, metadata_dic, key_height=200, distance=1
     
     
 def _fitting_in_kafka(x0, y0, data_id, peak, prop, is_one_peak=True, dummy_test=False):
+    # A whole stream (one spectrum per row of y0) goes to the batch fitter.
+    if np.ndim(y0) == 2:
+        return _fitting_stream_in_kafka(x0, y0, data_id, peak, prop, is_one_peak=is_one_peak, dummy_test=dummy_test)
+
     print(f'\n** Average of {data_id} has peaks at {peak}**\n')
     
     print(f'\n** start to do peak fitting by Gaussian**\n')
@@ -416,6 +504,80 @@ def _fitting_in_kafka(x0, y0, data_id, peak, prop, is_one_peak=True, dummy_test=
 
 
 
+pl_fit_pool = PLFitPool(time_budget=5.0, maxfev=10000)
+
+
+## Window, initial guess and bounds as in _1peak_fit_good_PL / _2peak_fit_good_PL
+def _pl_fit_attempts(x0, y0, peak, model, fit_boundary=[340, 400, 800], dummy_test=False):
+    w1, _ = find_nearest(x0, fit_boundary[0])
+    w2, _ = find_nearest(x0, fit_boundary[1])
+    w3, _ = find_nearest(x0, fit_boundary[2])
+
+    i0, i1 = (w1, w2) if (dummy_test and model == '_1gauss') else (w2, w3)
+    x = x0[i0:i1]
+    y = y0[i0:i1]
+    mean = sum(x * y) / sum(y)
+    sigma = np.sqrt(sum(abs(y) * (x - mean) ** 2) / sum(y))
+
+    if model == '_1gauss':
+        initial_guess = [y0[peak[-1]], x0[peak[-1]], sigma]
+        bnd = ((0,200,0),(y.max()*1.15,1000, np.inf))
+    else:
+        initial_guess = [y0[peak[0]], x0[peak[0]], sigma, y0[peak[-1]], x0[peak[-1]], sigma]
+        bnd = ((0,200,0,0,200,0),(y.max()*1.15,1000, np.inf, y.max()*1.15,1000, np.inf))
+
+    # bounded first, then unbounded, both inside the per-spectrum time budget
+    return [(model, initial_guess, bnd, (i0, i1)),
+            (model, initial_guess, (-np.inf, np.inf), (i0, i1))]
+
+
+
+## Fit every good spectrum of a stream in one call.
+## peak, prop are the per-row lists from good_bad_data_batch.
+## Returns one (x, y, peak, fit_function, popt) per row as _fitting_in_kafka does,
+## or None for rows that are bad, failed or ran out of time.
+def _fitting_stream_in_kafka(x0, y0, data_id, peak, prop, is_one_peak=True, dummy_test=False, pool=None):
+    pool = pool or pl_fit_pool
+    x0 = np.asarray(x0)
+    if x0.ndim == 2:
+        x0 = x0[0]
+    y0 = np.asarray(y0, dtype=float)
+
+    rows, row_peaks = [], {}
+    for i in range(y0.shape[0]):
+        if len(peak[i]) == 0:
+            continue
+        p = np.asarray(peak[i])
+        top = np.asarray([p[np.argmax(prop[i]['peak_heights'])]])
+        # 2 peaks: try _2gauss, fall back to _1gauss on the highest one
+        attempts = []
+        if not is_one_peak and len(p) == 2:
+            attempts += _pl_fit_attempts(x0, y0[i], p, '_2gauss')
+        attempts += _pl_fit_attempts(x0, y0[i], top, '_1gauss', dummy_test=dummy_test)
+        row_peaks[i] = {'_2gauss': p, '_1gauss': top}
+        rows.append((i, y0[i], attempts))
+
+    print(f'\n** start to do peak fitting by Gaussian on {len(rows)} spectra of {data_id}**\n')
+    t0 = time.monotonic()
+    results = pool.fit(x0, rows)
+
+    fit_functions = {'_1gauss': _1gauss, '_2gauss': _2gauss}
+    fitted = [None] * y0.shape[0]
+    status = {}
+    for r in results:
+        status[r['status']] = status.get(r['status'], 0) + 1
+        if r['status'] != 'ok':
+            continue
+        i = r['index']
+        i0, i1 = r['window']
+        p = row_peaks[i][r['model']]
+        fitted[i] = (x0[i0:i1], y0[i][i0:i1], p - i0, fit_functions[r['model']], r['popt'])
+
+    print(f'{data_id}: fitted {status} in {time.monotonic() - t0:.1f} s')
+    return fitted
+
+
+
 ### Calculate photoluminescence quantum yield (plqy) ###
 ## reference 1: Fluorescein, SI: https://onlinelibrary.wiley.com/doi/full/10.1002/adfm.201900712
 ## reference 2: Quinine, SI: https://pubs.rsc.org/en/content/articlelanding/2020/re/d0re00129e
@@ -4,6 +4,7 @@ import time
 import numpy as np
 import pandas as pd
 import os
+from spectra_export import write_spectra_csv, write_stream_hdf5, write_stream_parquet  # scripts/
 # from 31-data_analysis import *
 
 
@@ -143,52 +144,213 @@ def _data_keys():
     return qepro_list, qepro_dic, metadata_list, metadata_dic
 
 
-### the export funs below are revised from self.export_from_scan in 10-QEPro.py
-def export_qepro_by_stream(uid, csv_path, stream_name='primary', data_agent='tiled', plot=False, wait=False):
-    if wait==True:
-        time.sleep(2)
-    
-    qepro_dic, metadata_dic = read_qepro_by_stream(uid, stream_name=stream_name, data_agent=data_agent)
-    dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name=stream_name)
-    print(f'Export {stream_name} in uid: {uid[0:8]} to ../{os.path.basename(csv_path)} done!')
-    
+def _default_run_source(data_agent):
+    if data_agent == 'db':
+        try:
+            return db
+        except NameError:
+            import databroker
+            return databroker.Broker.named('xpd')
 
-def read_qepro_by_stream(uid, stream_name='primary', data_agent='tiled'):
-    
     if data_agent == 'catalog':
         try:
-            catalog
+            return catalog
         except NameError:
             import databroker
-            # catalog = databroker.catalog['xpd-ldrd20-31']
-            catalog = databroker.catalog['xpd']
-        run = catalog[uid]
-        meta = run.metadata
-    
+            # return databroker.catalog['xpd-ldrd20-31']
+            return databroker.catalog['xpd']
+
     if data_agent == 'tiled':
         try:
-            from_profile
+            return tiled_client
         except NameError:
             from tiled.client import from_profile
-            # tiled_client = from_profile("xpd-ldrd20-31")
-            tiled_client = from_profile("xpd")
-            
-        run = tiled_client[uid]
-        meta = run.metadata
-   
+            # return from_profile("xpd-ldrd20-31")
+            return from_profile("xpd")
+
+    raise ValueError(f"data_agent must be 'tiled', 'catalog' or 'db', not {data_agent!r}")
+
+
+def _stack_column(values):
+    # db tables hold one array per row; turn them into (num_events, ...) like xarray does
+    values = list(values)
+    try:
+        return np.stack([np.asarray(v) for v in values])
+    except ValueError:
+        return np.asarray(values, dtype=object)
+
+
+class QEProRunReader:
+    """
+    Pull what an export needs out of one run, fetching each piece only once.
+
+    The start document is fetched when the reader is made; the descriptors
+    and each stream are fetched the first time they are asked for (streams
+    restricted to ``fields``) and kept.
+    Looking up N keys therefore costs one request per stream instead of N.
+
+    Parameters
+    ----------
+    uid : str
+        Run uid (or anything the data source accepts as a key).
+    data_agent : {'tiled', 'catalog', 'db'}
+        Where to read from.
+    fields : list of str, optional
+        Data keys to read from each stream. Defaults to the QEPro keys
+        from ``_data_keys()``.
+    source : optional
+        Tiled client, catalog or Broker to use instead of the default one.
+
+    Examples
+    --------
+    >>> run = QEProRunReader(uid)
+    >>> run.stream('primary')['QEPro_output'][0]
+    >>> run.metadata(['pumps', 'precursors'])
+    """
+
+    def __init__(self, uid, data_agent='tiled', fields=None, source=None):
+        if source is None:
+            source = _default_run_source(data_agent)
+        self.data_agent = data_agent
+        self.fields = list(fields) if fields is not None else _data_keys()[0]
+        self._run = source[uid]
+        if data_agent == 'db':
+            self.start = dict(self._run.start)
+        else:
+            self.start = dict(self._run.metadata['start'])
+        self.uid = self.start['uid']
+        self._descriptors = None
+        self._streams = {}
+
+    @property
+    def descriptors(self):
+        "{stream name: [descriptor docs]}, fetched once."
+        if self._descriptors is None:
+            self._descriptors = {}
+            if self.data_agent == 'db':
+                for d in self._run.descriptors:
+                    self._descriptors.setdefault(d.get('name', 'primary'), []).append(d)
+            else:
+                for stream_name in self._run:
+                    self._descriptors[stream_name] = list(
+                        self._run[stream_name].metadata.get('descriptors', []))
+        return self._descriptors
+
+    def stream(self, stream_name='primary'):
+        """
+        Return {data_key: array over events} for the requested fields plus
+        'time'. Raises KeyError if the run has no such stream.
+        """
+        if stream_name not in self._streams:
+            self._streams[stream_name] = self._read_stream(stream_name)
+        return self._streams[stream_name]
+
+    def _read_stream(self, stream_name):
+        descriptors = self.descriptors.get(stream_name, [])
+        event_fields = [k for k in self.fields
+                        if any(k in d.get('data_keys', {}) for d in descriptors)]
+        if self.data_agent == 'db':
+            if stream_name not in self.descriptors:
+                raise KeyError(stream_name)
+            table = self._run.table(stream_name, fields=event_fields)
+            data = {k: _stack_column(table[k]) for k in event_fields if k in table}
+            data['time'] = np.asarray([t.timestamp() for t in table['time']])
+            return self._add_configuration(data, descriptors)
+
+        node = self._run[stream_name]
+        try:
+            # 'time' is a variable like the others; without it the dataset
+            # only has the event index as its time coordinate
+            ds = node.read(variables=['time', *(event_fields or self.fields)])
+        except (TypeError, KeyError):
+            # older servers/catalogs can not project columns
+            ds = node.read()
+        data = {k: ds[k].values for k in self.fields if k in ds}
+        data['time'] = ds['time'].values
+        return self._add_configuration(data, descriptors)
+
+    def _add_configuration(self, data, descriptors):
+        # Fields recorded once per descriptor as configuration (QEPro x_axis,
+        # dark, reference) are repeated over the events, as read-only views,
+        # so they index like the event data. Older runs have them as events.
+        num_events = len(data['time'])
+        for d in descriptors:
+            for config in d.get('configuration', {}).values():
+                for k, v in config.get('data', {}).items():
+                    if k in self.fields and k not in data:
+                        v = np.asarray(v)
+                        data[k] = np.broadcast_to(v, (num_events, *v.shape))
+        return data
+
+    def metadata(self, keys=None, default=[None]):
+        "Start document values for *keys*, with *default* for the missing ones."
+        if keys is None:
+            keys = _data_keys()[2]
+        return {k: self.start.get(k, default) for k in keys}
+
+
+### the export funs below are revised from self.export_from_scan in 10-QEPro.py
+def export_qepro_by_stream(uid, csv_path, stream_name='primary', data_agent='tiled', plot=False, wait=False,
+                           file_format='csv'):
+    # file_format: 'csv' (a file per event, as before), 'hdf5' or 'parquet'
+    # (the whole stream in one file, see dic_to_columnar)
+    if wait==True:
+        time.sleep(2)
     
+    qepro_dic, metadata_dic = read_qepro_by_stream(uid, stream_name=stream_name, data_agent=data_agent)
+    if file_format == 'csv':
+        dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name=stream_name)
+    else:
+        dic_to_columnar(csv_path, qepro_dic, metadata_dic, stream_name=stream_name, file_format=file_format)
+    print(f'Export {stream_name} in uid: {uid[0:8]} to ../{os.path.basename(csv_path)} done!')
+
+
+def export_qepro_run(uid, out_path, stream_names=None, data_agent='tiled', file_format='hdf5'):
+    """
+    Export every stream of a run (or *stream_names*) from one fetch of it:
+    all into one HDF5 file, or a Parquet file per stream. Returns the paths.
+    """
+    run = QEProRunReader(uid, data_agent=data_agent)
+    paths = []
+    for stream_name in stream_names or list(run.descriptors):
+        qepro_dic, metadata_dic = read_qepro_by_stream(uid, stream_name=stream_name, run=run)
+        if qepro_dic:
+            paths.append(dic_to_columnar(out_path, qepro_dic, metadata_dic, stream_name=stream_name,
+                                         file_format=file_format))
+    print(f'Export uid: {uid[0:8]} to ../{os.path.basename(out_path)} done!')
+    return sorted(set(paths))
+
+
+def dic_to_columnar(out_path, qepro_dic, metadata_dic, stream_name='primary', file_format='hdf5'):
+    """
+    Write a stream from read_qepro_by_stream as one file: the x axis once
+    and the spectra as (num_events, num_pixels) float32 (scripts/spectra_export.py).
+    HDF5 files hold every stream of a run, one group each.
+    """
+    date, clock = _readable_time(metadata_dic['time'])
+    stem = f"{out_path}/{metadata_dic['sample_type']}_{date}-{clock}_{metadata_dic['uid'][0:8]}"
+    if file_format == 'hdf5':
+        return write_stream_hdf5(f'{stem}.h5', qepro_dic, metadata_dic, stream_name=stream_name)
+    if file_format == 'parquet':
+        return write_stream_parquet(f'{stem}_{stream_name}.parquet', qepro_dic, metadata_dic,
+                                    stream_name=stream_name)
+    raise ValueError(f"file_format must be 'csv', 'hdf5' or 'parquet', not {file_format!r}")
+    
+
+def read_qepro_by_stream(uid, stream_name='primary', data_agent='tiled', run=None):
+    # Pass a QEProRunReader as run to export several streams of one scan
+    # without fetching it again.
+    if run is None:
+        run = QEProRunReader(uid, data_agent=data_agent)
+
     try:
-        data = run[stream_name].read()
+        data = run.stream(stream_name)
         qepro_list, qepro_dic, metadata_list, metadata_dic = _data_keys()
 
         for i in qepro_list:
-            qepro_dic[i] = data[i].values
+            qepro_dic[i] = data[i]
 
-        for i in metadata_list:
-            if i in meta['start'].keys():
-                metadata_dic[i] = meta['start'][i]
-            else:
-                metadata_dic[i] = [None]
+        metadata_dic.update(run.metadata(metadata_list))
         metadata_dic['stream_name'] = stream_name
 
     except (KeyError, AttributeError):
@@ -297,6 +459,39 @@ def ML_to_device_parameters(ML_dof, metadata_dic, unit = 'ul/min',
     return device_parameters
 
 
+def _csv_header(full_uid, date, time, int_time, num_average, boxcar_width, metadata_dic):
+    # the lines above the spectra in the exported csv files
+    pump_names = metadata_dic['pumps']
+    precursor = metadata_dic['precursors']
+    infuse_rate = metadata_dic['infuse_rate']
+    infuse_rate_unit = metadata_dic['infuse_rate_unit']
+    pump_status = metadata_dic['pump_status']
+    mixer = metadata_dic['mixer']
+    note = metadata_dic['note']
+
+    header = [f'uid,{full_uid}',
+              f'Time_QEPro,{date},{time}',
+              f'Integration time (ms),{int_time}',
+              f'Number of averaged spectra,{num_average}',
+              f'Boxcar width,{boxcar_width}']
+    for i in range(len(pump_names)):
+        header.append(f'{pump_names[i]},{precursor[i]},{infuse_rate[i]},{infuse_rate_unit[i]},{pump_status[i]}')
+    if mixer != None:
+        for i in range(len(mixer)):
+            header.append(f'Mixer no. {i+1},{mixer[i]}')
+    if type(note) is str:
+        header.append(f'Note,{note}')
+    return header
+
+
+def _csv_spectra(is_absorbance, x_axis_data, dark_data, reference_data, sample_data, output_data):
+    # (column names, columns) of the spectra in the exported csv files
+    if is_absorbance:
+        return ('Wavelength,Dark,Reference,Sample,Absorbance',
+                [x_axis_data, dark_data, reference_data, sample_data, output_data])
+    return 'Wavelength,Dark,Sample,Fluorescence', [x_axis_data, dark_data, sample_data, output_data]
+
+
 def dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name='primary', fitting=None, plqy_dic=None):
     # to save fitting results for good data, fitting needs be a dict with two keys:
     # fitting = {'fit_function': da._1gauss, 'curve_fit': popt}
@@ -308,13 +503,6 @@ def dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name='primar
     int_time = qepro_dic['QEPro_integration_time']
     num_average = qepro_dic['QEPro_num_spectra']
     boxcar_width = qepro_dic['QEPro_buff_capacity']
-    pump_names = metadata_dic['pumps']
-    precursor = metadata_dic['precursors']
-    infuse_rate = metadata_dic['infuse_rate']
-    infuse_rate_unit = metadata_dic['infuse_rate_unit']
-    pump_status = metadata_dic['pump_status']
-    mixer = metadata_dic['mixer']
-    note = metadata_dic['note']
 
     x_axis_data = qepro_dic['QEPro_x_axis']
     dark_data = qepro_dic['QEPro_dark']
@@ -343,67 +531,20 @@ def dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name='primar
             spec = 'PL'
             fout = f'{csv_path}/{sample_type}_{spec}_{date}-{time}_{full_uid[0:8]}.csv'
 
-        with open(fout, 'w') as fp:
-            fp.write(f'uid,{full_uid}\n')
-            fp.write(f'Time_QEPro,{date},{time}\n')
-            fp.write(f'Integration time (ms),{int_time[0]}\n')
-            fp.write(f'Number of averaged spectra,{num_average[0]}\n')
-            fp.write(f'Boxcar width,{boxcar_width[0]}\n')
-
-            for i in range(len(pump_names)):
-                fp.write(f'{pump_names[i]},{precursor[i]},{infuse_rate[i]},{infuse_rate_unit[i]},{pump_status[i]}\n')
-        
-            if mixer != None:
-                for i in range(len(mixer)):
-                    fp.write(f'Mixer no. {i+1},{mixer[i]}\n')
-
-            if type(note) is str:
-                fp.write(f'Note,{note}\n')
-
-            if spectrum_type == 3:
-                fp.write('Wavelength,Dark,Reference,Sample,Absorbance\n')
-            else:
-                fp.write('Wavelength,Dark,Sample,Fluorescence\n')
-
-            for i in range(x_axis_data.shape[1]):
-                if spectrum_type == 3:
-                    fp.write(f'{x_axis_data[0,i]},{dark_data[0,i]},{reference_data[0,i]},{sample_data[0,i]},{output_data[0,i]}\n')
-                else:
-                    fp.write(f'{x_axis_data[0,i]},{dark_data[0,i]},{sample_data[0,i]},{output_data[0,i]}\n')
+        header = _csv_header(full_uid, date, time, int_time[0], num_average[0], boxcar_width[0], metadata_dic)
+        names, columns = _csv_spectra(spectrum_type == 3, x_axis_data[0], dark_data[0], reference_data[0],
+                                      sample_data[0], output_data[0])
+        write_spectra_csv(fout, header + [names], columns)
     
     elif stream_name != 'primary' and fitting == None:
         new_dir = f'{csv_path}/{date}{time}_{full_uid[0:8]}_{stream_name}'
         os.makedirs(new_dir, exist_ok=True)
         for j in range(x_axis_data.shape[0]):
             fout = f'{new_dir}/{sample_type}_{date}-{time}_{full_uid[0:8]}_{j:03d}.csv'
-            
-            with open(fout, 'w') as fp:
-                fp.write(f'uid,{full_uid}\n')
-                fp.write(f'Time_QEPro,{date},{time}\n')
-                fp.write(f'Integration time (ms),{int_time[j]}\n')
-                fp.write(f'Number of averaged spectra,{num_average[j]}\n')
-                fp.write(f'Boxcar width,{boxcar_width[j]}\n')
-
-                for i in range(len(pump_names)):
-                    fp.write(f'{pump_names[i]},{precursor[i]},{infuse_rate[i]},{infuse_rate_unit[i]},{pump_status[i]}\n')
-            
-                if mixer != None:
-                    for i in range(len(mixer)):
-                        fp.write(f'Mixer no. {i+1},{mixer[i]}\n')
-
-                if type(note) is str:
-                    fp.write(f'Note,{note}\n')
-
-                if spectrum_type[0] == 3:
-                    fp.write('Wavelength,Dark,Reference,Sample,Absorbance\n')
-                else:
-                    fp.write('Wavelength,Dark,Sample,Fluorescence\n')
-
-                for i in range(x_axis_data.shape[1]):
-                    if spectrum_type[0] == 3:
-                        fp.write(f'{x_axis_data[j,i]},{dark_data[j,i]},{reference_data[j,i]},{sample_data[j,i]},{output_data[j,i]}\n')
-                    else:
-                        fp.write(f'{x_axis_data[j,i]},{dark_data[j,i]},{sample_data[j,i]},{output_data[j,i]}\n')
+            header = _csv_header(full_uid, date, time, int_time[j], num_average[j], boxcar_width[j], metadata_dic)
+            names, columns = _csv_spectra(spectrum_type[0] == 3, x_axis_data[j], dark_data[j], reference_data[j],
+                                          sample_data[j], output_data[j])
+            write_spectra_csv(fout, header + [names], columns)
     
     elif type(fitting) is dict:
         if stream_name == 'primary':
@@ -414,56 +555,31 @@ def dic_to_csv_for_stream(csv_path, qepro_dic, metadata_dic, stream_name='primar
             os.makedirs(new_dir, exist_ok=True)
             fout = f'{new_dir}/{sample_type}_{date}-{time}_{full_uid[0:8]}_fitted.csv'
 
-        with open(fout, 'w') as fp:
-            fp.write(f'uid,{full_uid}\n')
-            fp.write(f'Time_QEPro,{date},{time}\n')
-            fp.write(f'Integration time (ms),{int_time[0]}\n')
-            fp.write(f'Number of averaged spectra,{num_average[0]}\n')
-            fp.write(f'Boxcar width,{boxcar_width[0]}\n')
+        header = _csv_header(full_uid, date, time, int_time[0], num_average[0], boxcar_width[0], metadata_dic)
+        try:
+            fun_name = f1.__name__
+            header.append(f'fitting function,{fun_name}')
+        except (AttributeError, TypeError):
+            pass
 
-            for i in range(len(pump_names)):
-                fp.write(f'{pump_names[i]},{precursor[i]},{infuse_rate[i]},{infuse_rate_unit[i]},{pump_status[i]}\n')
-        
-            if mixer != None:
-                for i in range(len(mixer)):
-                    fp.write(f'Mixer no. {i+1},{mixer[i]}\n')
+        header.append('popt' + ''.join(f',{p}' for p in popt))
 
-            if type(note) is str:
-                fp.write(f'Note,{note}\n')
-            
-            try:
-                fun_name = f1.__name__
-                fp.write(f'fitting function,{fun_name}\n')
-            except (AttributeError, TypeError):
-                pass
-
-            fp.write('popt')
-            for i in range(len(popt)):
-                fp.write(f',{popt[i]}')
-            fp.write('\n')
-
-            try: 
-                plqy = plqy_dic['plqy']
-                PL_integral = plqy_dic['PL_integral']
-                Absorbance_365 = plqy_dic['Absorbance_365']
-                fp.write(f'plqy,{plqy},PL_integral,{PL_integral},Absorbance_365,{Absorbance_365}\n')
-            except (TypeError, KeyError):
-                pass
-
-            # fp.write('Wavelength,Dark,Sample,Fluorescence_mean,Fitting\n')
-            # for i in range(x_axis_data.shape[1]):
-            #     fp.write(f'{x_axis_data[-1,i]},{dark_data[-1,i]},{sample_data[-1,i]},{output_mean[i]},{fitted_y[i]}\n')
-
-            if spectrum_type[0] == 3:
-                fp.write('Wavelength,Dark,Reference,Sample,Absorbance_mean,Offset\n')
-            else:
-                fp.write('Wavelength,Dark,Sample,Fluorescence_mean,Fitting\n')
+        try: 
+            plqy = plqy_dic['plqy']
+            PL_integral = plqy_dic['PL_integral']
+            Absorbance_365 = plqy_dic['Absorbance_365']
+            header.append(f'plqy,{plqy},PL_integral,{PL_integral},Absorbance_365,{Absorbance_365}')
+        except (TypeError, KeyError):
+            pass
 
-            for i in range(x_axis_data.shape[1]):
-                if spectrum_type[0] == 3:
-                    fp.write(f'{x_axis_data[-1,i]},{dark_data[-1,i]},{reference_data[-1,i]},{sample_data[-1,i]},{output_mean[i]},{output_mean[i]-fitted_y[i]}\n')
-                else:
-                    fp.write(f'{x_axis_data[-1,i]},{dark_data[-1,i]},{sample_data[-1,i]},{output_mean[i]},{fitted_y[i]}\n')
+        if spectrum_type[0] == 3:
+            header.append('Wavelength,Dark,Reference,Sample,Absorbance_mean,Offset')
+            columns = [x_axis_data[-1], dark_data[-1], reference_data[-1], sample_data[-1],
+                       output_mean, output_mean - fitted_y]
+        else:
+            header.append('Wavelength,Dark,Sample,Fluorescence_mean,Fitting')
+            columns = [x_axis_data[-1], dark_data[-1], sample_data[-1], output_mean, fitted_y]
+        write_spectra_csv(fout, header, columns)
 
         
 
@@ -484,57 +600,23 @@ def export_qepro_from_uid(uid, csv_path, sample_type=None, plot=False, data_agen
 
 
 def read_qepro_from_tiled(uid):
-    try:
-       from_profile
-    except NameError:
-        from tiled.client import from_profile
-        # tiled_client = from_profile("xpd-ldrd20-31")
-        tiled_client = from_profile("xpd")  
-    
-    run = tiled_client[uid]
-    ds = run.primary.read()
-    meta = run.metadata
-    
-    # date, time = _readable_time(ds['time'][0])
-    # full_uid = meta['start']['uid']
-    
-    qepro_list, qepro_dic, metadata_list, metadata_dic = _data_keys()
+    return _read_qepro_first_event(QEProRunReader(uid, data_agent='tiled'))
 
-    for i in qepro_list:
-        qepro_dic[i] = ds[i].values[0]
 
-    for i in metadata_list:
-        if i in meta['start'].keys():
-            metadata_dic[i] = meta['start'][i]
-        else:
-            metadata_dic[i] = [None]
-    
-    return qepro_dic, metadata_dic
 
+def read_qepro_from_db(uid):
+    return _read_qepro_first_event(QEProRunReader(uid, data_agent='db'))
 
 
-def read_qepro_from_db(uid):
-    try:
-        db
-    except NameError:
-        import databroker
-        # db = databroker.Broker.named('xpd-ldrd20-31')
-        db = databroker.Broker.named('xpd')
-    
-    # full_uid = db[uid].start['uid']
-    # unix_time = db[uid].start['time']     
-    # date, time = _readable_time(unix_time)
 
+def _read_qepro_first_event(run):
     qepro_list, qepro_dic, metadata_list, metadata_dic = _data_keys()
 
+    primary = run.stream('primary')
     for i in qepro_list:
-        qepro_dic[i] = db[uid].table()[i][1]
+        qepro_dic[i] = primary[i][0]
 
-    for i in metadata_list:
-        if i in db[uid].start.keys():
-            metadata_dic[i] = db[uid].start[i]
-        else:
-            metadata_dic[i] = [None]
+    metadata_dic.update(run.metadata(metadata_list))
     
     return qepro_dic, metadata_dic
 
@@ -550,13 +632,6 @@ def dic_to_csv(csv_path, qepro_dic, metadata_dic):
     int_time = qepro_dic['QEPro_integration_time']
     num_average = qepro_dic['QEPro_num_spectra']
     boxcar_width = qepro_dic['QEPro_buff_capacity']
-    pump_names = metadata_dic['pumps']
-    precursor = metadata_dic['precursors']
-    infuse_rate = metadata_dic['infuse_rate']
-    infuse_rate_unit = metadata_dic['infuse_rate_unit']
-    pump_status = metadata_dic['pump_status']
-    mixer = metadata_dic['mixer']
-    note = metadata_dic['note']
 
     x_axis_data = qepro_dic['QEPro_x_axis']
     dark_data = qepro_dic['QEPro_dark']
@@ -572,31 +647,8 @@ def dic_to_csv(csv_path, qepro_dic, metadata_dic):
         spec = 'PL'
         fout = f'{csv_path}/{sample_type}_{spec}_{date}-{time}_{uid[0:8]}.csv'
 
-    with open(fout, 'w') as fp:
-        fp.write(f'uid,{full_uid}\n')
-        fp.write(f'Time_QEPro,{date},{time}\n')
-        fp.write(f'Integration time (ms),{int_time}\n')
-        fp.write(f'Number of averaged spectra,{num_average}\n')
-        fp.write(f'Boxcar width,{boxcar_width}\n')
-
-        for i in range(len(pump_names)):
-            fp.write(f'{pump_names[i]},{precursor[i]},{infuse_rate[i]},{infuse_rate_unit[i]},{pump_status[i]}\n')
-    
-        if mixer != None:
-            for i in range(len(mixer)):
-                fp.write(f'Mixer no. {i+1},{mixer[i]}\n')
-
-        if type(note) is str:
-            fp.write(f'Note,{note}\n')
-
-        if spectrum_type == 3:
-            fp.write('Wavelength,Dark,Reference,Sample,Absorbance\n')
-        else:
-            fp.write('Wavelength,Dark,Sample,Fluorescence\n')
-
-        for i in range(len(output_data)):
-            if spectrum_type == 3:
-                fp.write(f'{x_axis_data[i]},{dark_data[i]},{reference_data[i]},{sample_data[i]},{output_data[i]}\n')
-            else:
-                fp.write(f'{x_axis_data[i]},{dark_data[i]},{sample_data[i]},{output_data[i]}\n')
+    header = _csv_header(full_uid, date, time, int_time, num_average, boxcar_width, metadata_dic)
+    names, columns = _csv_spectra(spectrum_type == 3, x_axis_data, dark_data, reference_data,
+                                  sample_data, output_data)
+    write_spectra_csv(fout, header + [names], columns)
 
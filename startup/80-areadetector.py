@@ -1,18 +1,29 @@
+import functools
+import json
 import time as ttime
+from collections import OrderedDict
 from copy import deepcopy
+
+import bluesky.plan_stubs as bps
+import bluesky.preprocessors as bpp
+import bluesky_darkframes
 from ophyd.areadetector import (PerkinElmerDetector, ImagePlugin,
                                 TIFFPlugin, StatsPlugin, HDF5Plugin,
                                 ProcessPlugin, ROIPlugin)
-from ophyd.device import BlueskyInterface
+from ophyd.device import BlueskyInterface, Staged
+from ophyd.signal import EpicsSignalBase
+from ophyd.areadetector.plugins import HDF5Plugin_V33
 from ophyd.areadetector.trigger_mixins import SingleTrigger, MultiTrigger
 from nslsii.ad33 import SingleTriggerV33, StatsPluginV33
 from ophyd.areadetector.filestore_mixins import (FileStoreIterativeWrite,
                                                  FileStoreHDF5IterativeWrite,
+                                                 FileStoreHDF5,
                                                  FileStoreTIFFSquashing,
                                                  FileStoreTIFF)
 from ophyd import Signal, EpicsSignal, EpicsSignalRO # Tim test
 from ophyd import Component as C
 from ophyd import StatusBase
+from ophyd.status import SubscriptionStatus
 
 
 # monkey patch for trailing slash problem
@@ -111,17 +122,152 @@ class SavedImageSignal(Signal):
         return ret
 
 
-def take_dark(cam, light_field, dark_field_name):
-    # close shutter
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Cannot store object of type {type(obj)}")
+
+
+class DarkFrameCache:
+    """
+    Dark frames keyed by the detector acquisition configuration.
+
+    The key is (detector name, acquire_time, images_per_set, number_of_sets,
+    bin_x, bin_y), so a lookup is one dict access. Each entry is a
+    ``bluesky_darkframes.SnapshotDevice`` of the detector right after the
+    dark was read; re-emitting it re-mints its Resource/Datum uids, so one
+    dark can be referenced by many runs. Entries older than *max_age*
+    seconds, or taken under another data session, are treated as missing.
+    The cache is written to *path* on every update and read back when the
+    profile starts, so darks survive a restart.
 
-    # take the dark frame
-    cam.stage()
-    st = cam.trigger()
-    while not st.done:
-        ttime.sleep(.1)
-    ret = cam.read()
-    desc = cam.describe()
-    cam.unstage()
+    Example::
+
+        dark_frame_cache.max_age = 600   # re-take darks every 10 minutes
+        dark_frame_cache.clear()         # force fresh darks
+    """
+
+    def __init__(self, path=os.path.expanduser("~/.cache/xpd/dark_frames.json"),
+                 max_age=1800):
+        self.path = path
+        self.max_age = max_age
+        self._entries = {}
+        self.load()
+
+    @staticmethod
+    def key(det):
+        def get(attr):
+            obj = det
+            for part in attr.split("."):
+                obj = getattr(obj, part, None)
+                if obj is None:
+                    return None
+            return obj.get()
+
+        return (det.name,
+                get("cam.acquire_time"),
+                get("images_per_set"),
+                get("number_of_sets"),
+                get("cam.bin_x"),
+                get("cam.bin_y"))
+
+    def get(self, det, max_age=None):
+        "Return a SnapshotDevice of a valid dark for *det*, or None."
+        entry = self._entries.get(self._str_key(self.key(det)))
+        if entry is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if ttime.time() - entry["time"] > max_age:
+            return None
+        if entry["data_session"] != RE.md.get("data_session"):
+            return None
+        return entry["snapshot"]
+
+    def put(self, det, snapshot):
+        self._entries[self._str_key(self.key(det))] = {
+            "time": ttime.time(),
+            "data_session": RE.md.get("data_session"),
+            "snapshot": snapshot,
+        }
+        self.save()
+
+    def clear(self):
+        self._entries.clear()
+        self.save()
+
+    @staticmethod
+    def _str_key(key):
+        return "|".join(map(str, key))
+
+    def save(self):
+        state = {}
+        for key, entry in self._entries.items():
+            snap = entry["snapshot"]
+            state[key] = {
+                "time": entry["time"],
+                "data_session": entry["data_session"],
+                "name": snap.name,
+                "describe": snap._describe,
+                "describe_configuration": snap._describe_configuration,
+                "read": snap._read,
+                "read_configuration": snap._read_configuration,
+                "asset_docs": snap._asset_docs_cache,
+            }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f, default=_json_default)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            print(f"Ignoring unreadable dark-frame cache {self.path}: {err}")
+            return
+        for key, item in state.items():
+            # Rebuild the snapshot without a live device to read from.
+            snap = bluesky_darkframes.SnapshotDevice.__new__(bluesky_darkframes.SnapshotDevice)
+            Device.__init__(snap, name=item["name"])
+            snap._describe = item["describe"]
+            snap._describe_configuration = item["describe_configuration"]
+            snap._read = item["read"]
+            snap._read_configuration = item["read_configuration"]
+            snap._read_attrs = list(item["read"])
+            snap._configuration_attrs = list(item["read_configuration"])
+            snap._asset_docs_cache = [tuple(doc) for doc in item["asset_docs"]]
+            snap._assets_collected = False
+            # Those uids were already emitted by the run that took the dark.
+            snap._remake_docs()
+            self._entries[key] = {"time": item["time"],
+                                  "data_session": item["data_session"],
+                                  "snapshot": snap}
+
+
+dark_frame_cache = DarkFrameCache()
+
+
+def take_dark(cam, light_field, dark_field_name, cache=dark_frame_cache):
+    snapshot = cache.get(cam) if cache is not None else None
+    if snapshot is None:
+        # close shutter
+
+        # take the dark frame
+        cam.stage()
+        st = cam.trigger()
+        while not st.done:
+            ttime.sleep(.1)
+        cam.read()
+        snapshot = bluesky_darkframes.SnapshotDevice(cam)
+        cam.unstage()
+        if cache is not None:
+            cache.put(cam, snapshot)
+    ret = snapshot.read()
+    desc = snapshot.describe()
 
     # save the df uid
     df = ret[light_field]
@@ -131,7 +277,8 @@ def take_dark(cam, light_field, dark_field_name):
     df_sig.stashed_datakey = desc[light_field]
 
 
-class XPDFileStoreTIFFSquashing(FileStoreTIFFSquashing):
+class XPDSquashedImageKey:
+    "Describe the image as one squashed frame per set, as uint16."
     def describe(self):
         description = super().describe()
         key = f"{self.parent.name}_image"
@@ -147,9 +294,68 @@ class XPDFileStoreTIFFSquashing(FileStoreTIFFSquashing):
         return description
 
 
-class XPDTIFFPlugin(TIFFPlugin, XPDFileStoreTIFFSquashing,
-                    FileStoreIterativeWrite):
+class XPDFileStoreTIFFSquashing(XPDSquashedImageKey, FileStoreTIFFSquashing):
+    pass
+
+
+class XPDFileStoreHDF5Squashing(XPDSquashedImageKey, FileStoreHDF5):
+    """
+    The HDF5 counterpart of XPDFileStoreTIFFSquashing: the proc plugin still
+    averages images_per_set frames, but instead of one TIFF per set every set
+    is streamed into a single file that is opened at stage and closed at
+    unstage, i.e. one file per run. The file is written in SWMR mode (it can
+    be read while it grows, flushed once per point) and blosc/lz4
+    compressed. Each point is number_of_sets frames of that file, found by
+    the AD_HDF5 handler from point_number and frame_per_point; reading it
+    needs the blosc filter plugin (blosc-hdf5-plugin).
+    """
+    def __init__(self, *args, images_per_set_name='images_per_set',
+                 number_of_sets_name='number_of_sets', cam_name='cam',
+                 proc_name='proc', **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ips_name = images_per_set_name
+        self._num_sets_name = number_of_sets_name
+        self._cam_name = cam_name
+        self._proc_name = proc_name
+        cam = getattr(self.parent, self._cam_name)
+        proc = getattr(self.parent, self._proc_name)
+        self.stage_sigs.update([
+            (proc.nd_array_port, cam.port_name.get()),
+            (proc.reset_filter, 1),
+            (proc.enable_filter, 1),
+            (proc.filter_type, 'Average'),
+            (proc.auto_reset_filter, 1),
+            (proc.filter_callbacks, 1),
+            ('nd_array_port', proc.port_name.get()),
+            ('num_capture', 0),  # stream until unstaged
+            ('compression', 4),  # blosc
+            ('blosc_compressor', 1),  # lz4
+            ('blosc_shuffle', 1),  # byte shuffle
+            ('blosc_level', 5),
+            ('swmr_mode', 'On'),
+        ])
+        # capture opens the file, so it has to come after the settings above
+        self.stage_sigs.move_to_end('capture')
+
+    def get_frames_per_point(self):
+        return getattr(self.parent, self._num_sets_name).get()
 
+    def stage(self):
+        cam = getattr(self.parent, self._cam_name)
+        proc = getattr(self.parent, self._proc_name)
+        images_per_set = getattr(self.parent, self._ips_name).get()
+        num_sets = getattr(self.parent, self._num_sets_name).get()
+        self.stage_sigs.update([
+            (proc.num_filter, images_per_set),
+            (cam.num_images, images_per_set * num_sets),
+            ('num_frames_flush', num_sets),
+        ])
+        self.stage_sigs.move_to_end('capture')
+        super().stage()
+
+
+class XPDAssetPaths:
+    "Take the read and write paths from RE.md (cycle, data_session) at stage."
     def update_paths(self):
         directory_path_leaf = f"proposals/{RE.md['cycle']}/{RE.md['data_session']}/assets/{self.parent.name}/%Y/%m/%d/"
         win_dir = directory_path_leaf.replace("/", "\\")
@@ -163,23 +369,170 @@ class XPDTIFFPlugin(TIFFPlugin, XPDFileStoreTIFFSquashing,
         super().stage()
 
 
-class XPDHDF5Plugin(HDF5Plugin, FileStoreHDF5IterativeWrite):
+class XPDTIFFPlugin(XPDAssetPaths, TIFFPlugin, XPDFileStoreTIFFSquashing,
+                    FileStoreIterativeWrite):
+    pass
+
+
+class XPDHDF5Plugin(XPDAssetPaths, HDF5Plugin_V33, XPDFileStoreHDF5Squashing,
+                    FileStoreIterativeWrite):
     pass
 
 
-class XPDPerkinElmer(PerkinElmerDetector):
+class _DiffStageSigs(OrderedDict):
+    """
+    A device's stage_sigs while a DiffStaging detector stages it. Only the
+    actions are kept for Device.stage to write in order; settings that
+    differ from the readbacks are collected in ``pending``, or written right
+    away once the detector has written the pending ones (settings a
+    plugin's stage() adds just before staging), and the rest are dropped.
+    """
+    def __init__(self, detector, device):
+        super().__init__()
+        self._detector = detector
+        self._device = device
+        self.pending = {}
+
+    def update(self, other=(), **kwargs):
+        for key, value in OrderedDict(other, **kwargs).items():
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        sig = getattr(self._device, key) if isinstance(key, str) else key
+        if sig.attr_name in self._detector._ordered_stage_attrs:
+            super().__setitem__(key, value)
+            return
+        # the same signal may be listed by name and as a Signal; last one wins
+        if self.pending is not None:
+            self.pending.pop(sig, None)
+        current = self._detector._readback(sig)
+        if self._detector._unchanged(sig, value, current):
+            return
+        if self.pending is not None:
+            self.pending[sig] = (value, current)
+        else:
+            self._detector._apply([(self._device, sig, value, current)])
+
+
+class DiffStaging:
+    """
+    Stage by writing only the stage_sigs that differ from the detector's
+    current settings, and write those all at once.
+
+    The current settings are the monitored readbacks (the first stage
+    subscribes to them). acquire, capture, reset_filter and write_file are
+    actions rather than settings, so they are always written, in order,
+    after everything else. Of the settings, the cam's and the plugins'
+    ``enable`` are put back at unstage as usual; the rest (file plugin,
+    proc filter, callbacks...) stay as staged, so the next stage of the
+    same configuration writes nothing. Set ``diff_staging = False`` on an
+    instance to stage the plain ophyd way. ``last_stage_writes`` lists the
+    settings written by the last stage.
+    """
+    diff_staging = True
+    _ordered_stage_attrs = ('acquire', 'capture', 'reset_filter', 'write_file')
+    _restored_stage_attrs = ('enable',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._readbacks = {}
+        self._applied = {}
+        self.last_stage_writes = []
+
+    def _staged_devices(self, device=None):
+        device = self if device is None else device
+        yield device
+        for attr in device._sub_devices:
+            yield from self._staged_devices(getattr(device, attr))
+
+    def _readback_changed(self, sig, value=None, **kwargs):
+        self._readbacks[sig] = value
+
+    def _readback(self, sig):
+        if not isinstance(sig, EpicsSignalBase):
+            return sig.get()
+        if sig not in self._readbacks:
+            sig.subscribe(functools.partial(self._readback_changed, sig), run=False)
+            self._readbacks[sig] = sig.get()
+        return self._readbacks[sig]
+
+    @staticmethod
+    def _same(sig, a, b):
+        enum_strs = getattr(sig, 'enum_strs', None) or ()
+        a, b = (enum_strs[v] if isinstance(v, (int, np.integer)) and 0 <= v < len(enum_strs) else v
+                for v in (a, b))
+        if isinstance(a, str) or isinstance(b, str):
+            return str(a) == str(b)
+        try:
+            return bool(np.allclose(a, b, rtol=getattr(sig, 'rtolerance', None) or 1e-9,
+                                    atol=getattr(sig, 'tolerance', None) or 0))
+        except (TypeError, ValueError):
+            return a == b
+
+    def _unchanged(self, sig, value, current):
+        if self._same(sig, value, current):
+            return True
+        # Settings the IOC rounds never read back as written; they count as
+        # unchanged as long as the readback is still what it was after the
+        # last write.
+        applied = self._applied.get(sig)
+        return (applied is not None and self._same(sig, applied[0], value)
+                and self._same(sig, applied[1], current))
+
+    def _apply(self, changes):
+        "Write (device, sig, value, current) changes in parallel."
+        statuses = [sig.set(value) for _, sig, value, _ in changes]
+        for (device, sig, value, current), status in zip(changes, statuses):
+            status.wait()
+            self._applied[sig] = (value, sig.get())
+            if sig.attr_name in self._restored_stage_attrs or sig.parent is self.cam:
+                device._original_vals.setdefault(sig, current)
+            self.last_stage_writes.append(sig.name)
+
+    def stage(self):
+        if not self.diff_staging or self._staged != Staged.no:
+            return super().stage()
+        self.last_stage_writes = []
+        swapped = []
+        try:
+            for device in self._staged_devices():
+                view = _DiffStageSigs(self, device)
+                view.update(device.stage_sigs)
+                swapped.append((device, device.stage_sigs))
+                device.stage_sigs = view
+            # several plugins ask for the same cam setting; write it once
+            changes = {}
+            for device, _ in swapped:
+                for sig, (value, current) in device.stage_sigs.pending.items():
+                    changes.setdefault(sig, (device, sig, value, current))
+                device.stage_sigs.pending = None
+            self._apply(list(changes.values()))
+        except Exception:
+            for device, stage_sigs in swapped:
+                device.stage_sigs = stage_sigs
+            self.unstage()
+            raise
+        try:
+            return super().stage()
+        finally:
+            for device, stage_sigs in swapped:
+                device.stage_sigs = stage_sigs
+            self.log.debug("Staged %s, wrote %s", self.name, self.last_stage_writes)
+
+
+class XPDStatsPlugin(StatsPluginV33):
+    "StatsPluginV33 plus the time series PVs used by StatsTimeSeries."
+    ts_control = C(EpicsSignal, 'TS:TSControl', string=True, kind='omitted', lazy=True,
+                   doc="0='Erase/Start' 1='Start' 2='Stop' 3='Read'")
+    ts_timestamp = C(EpicsSignal, 'TS:TSTimestamp', kind='omitted', lazy=True)
+
+
+class XPDPerkinElmerBase(DiffStaging, PerkinElmerDetector):
+    "Everything of XPDPerkinElmer except the file plugin."
     image = C(ImagePlugin, 'image1:')
     _default_configuration_attrs = (
         PerkinElmerDetector._default_configuration_attrs +
         ('images_per_set', 'number_of_sets', 'pixel_size'))
-    tiff = C(XPDTIFFPlugin, 'TIFF1:',
-             write_path_template='/a/b/c/',
-             read_path_template='/a/b/c',
-             cam_name='cam',  # used to configure "tiff squashing"
-             proc_name='proc',  # ditto
-             read_attrs=[],
-             root='/nsls2/data/xpd-new/')
-
 
     proc = C(ProcessPlugin, 'Proc1:')
 
@@ -192,11 +545,11 @@ class XPDPerkinElmer(PerkinElmerDetector):
     pixel_size = C(Signal, value=.0002, kind='config')
     #testing DO
     detector_type = C(Signal, value='Perkin', kind='config')
-    stats1 = C(StatsPluginV33, 'Stats1:')
-    stats2 = C(StatsPluginV33, 'Stats2:')
-    stats3 = C(StatsPluginV33, 'Stats3:')
-    stats4 = C(StatsPluginV33, 'Stats4:')
-    stats5 = C(StatsPluginV33, 'Stats5:', kind = 'hinted')
+    stats1 = C(XPDStatsPlugin, 'Stats1:')
+    stats2 = C(XPDStatsPlugin, 'Stats2:')
+    stats3 = C(XPDStatsPlugin, 'Stats3:')
+    stats4 = C(XPDStatsPlugin, 'Stats4:')
+    stats5 = C(XPDStatsPlugin, 'Stats5:', kind = 'hinted')
     #stats5.total.kind = 'hinted'
 
     roi1 = C(ROIPlugin, 'ROI1:')
@@ -211,13 +564,44 @@ class XPDPerkinElmer(PerkinElmerDetector):
         self.stage_sigs.update([(self.cam.trigger_mode, 'Internal')])
 
 
+class XPDPerkinElmer(XPDPerkinElmerBase):
+    tiff = C(XPDTIFFPlugin, 'TIFF1:',
+             write_path_template='/a/b/c/',
+             read_path_template='/a/b/c',
+             cam_name='cam',  # used to configure "tiff squashing"
+             proc_name='proc',  # ditto
+             read_attrs=[],
+             root='/nsls2/data/xpd-new/')
+
+
+class XPDPerkinElmerHDF5(XPDPerkinElmerBase):
+    "XPDPerkinElmer writing one compressed HDF5 file per run through HDF1:."
+    hdf5 = C(XPDHDF5Plugin, 'HDF1:',
+             write_path_template='/a/b/c/',
+             read_path_template='/a/b/c',
+             cam_name='cam',
+             proc_name='proc',
+             read_attrs=[],
+             root='/nsls2/data/xpd-new/')
+
+
 class ContinuousAcquisitionTrigger(BlueskyInterface):
     """
     This trigger mixin class records images when it is triggered.
 
     It expects the detector to *already* be acquiring, continously.
+
+    With ``double_buffer = True`` (e.g. ``pe1c.double_buffer = True`` before a
+    tseries) the next set starts summing in the proc plugin as soon as the
+    current one is captured, while the TIFF plugin is still writing it, and
+    capture is re-armed the moment the write is done. The next trigger then
+    claims a set that is already under way, so for short exposures a cycle
+    costs about the capture time instead of capture plus write. The frames of
+    a pre-armed set are taken before its trigger, so only use this when
+    nothing moves between triggers. ``acquisition_stats()`` reports the
+    effective rates and the frames that were acquired but never saved.
     """
-    def __init__(self, *args, plugin_name=None, image_name=None, **kwargs):
+    def __init__(self, *args, plugin_name=None, image_name=None, double_buffer=False, **kwargs):
         if plugin_name is None:
             raise ValueError("plugin name is a required keyword argument")
         super().__init__(*args, **kwargs)
@@ -228,51 +612,239 @@ class ContinuousAcquisitionTrigger(BlueskyInterface):
         self.cam.stage_sigs[self.cam.image_mode] = 'Continuous'
         self._plugin.stage_sigs[self._plugin.file_write_mode] = 'Capture'
         self._image_name = image_name
-        self._status = None
+        self.double_buffer = double_buffer
+        # Sets in flight, oldest first: dicts with 'phase' ('summing',
+        # 'capturing', 'writing' or 'written'), 'num_sets' and 'status' (None
+        # until a trigger claims a pre-armed set). At most one is capturing
+        # or summing (the proc plugin) and one writing (the TIFF plugin).
+        self._sets = []
+        self._lock = threading.RLock()
+        self._stats = None
         self._num_captured_signal = self._plugin.num_captured
         self._num_captured_signal.subscribe(self._num_captured_changed)
-        self._save_started = False
 
     def stage(self):
         if self.cam.acquire.get() != 1:
             raise RuntimeError("The ContinuousAcuqisitionTrigger expects "
                                "the detector to already be acquiring.")
-        return super().stage()
+        ret = super().stage()
+        self._sets = []
+        self._stats = {'triggers': 0, 'frames_saved': 0, 'first_trigger': None,
+                       'last_done': None, 'cycle_times': [],
+                       'array_counter': self.cam.array_counter.get(),
+                       'dropped_arrays': self._plugin.dropped_arrays.get()}
+        return ret
         # put logic to look up proper dark frame
         # die if none is found
 
+    def unstage(self):
+        self._discard_prearmed()
+        if self.double_buffer and self._stats and self._stats['triggers']:
+            stats = self.acquisition_stats()
+            print(f"{self.name}: {stats['set_rate']:.2f} sets/s, {stats['frame_rate']:.2f} frames/s "
+                  f"saved, {stats['frames_dropped']} frames not saved")
+        return super().unstage()
+
+    def _in_phase(self, *phases):
+        return [s for s in self._sets if s['phase'] in phases]
+
+    def _discard_prearmed(self):
+        with self._lock:
+            for s in [s for s in self._sets if s['status'] is None]:
+                if s['phase'] == 'capturing':
+                    self._plugin.capture.put(0)
+                # a set already written just leaves files no datum points to
+                self._sets.remove(s)
+
+    def _arm_capture(self, s):
+        s['phase'] = 'capturing'
+        self._plugin.num_capture.put(s['num_sets'])
+        self._plugin.capture.put(1)  # Now the TIFF plugin is capturing.
+
+    def _prearm(self):
+        "Start the next set while the proc plugin is free."
+        if (not self.double_buffer or not self._staged
+                or any(s['status'] is None for s in self._sets)
+                or self._in_phase('summing', 'capturing')):
+            return
+        s = {'phase': 'summing', 'num_sets': self.number_of_sets.get(), 'status': None}
+        self._sets.append(s)
+        self.proc.reset_filter.put(1)
+        if not self._in_phase('writing'):
+            self._arm_capture(s)
+
+    def trigger(self):
+        "Trigger one acquisition."
+        if not self._staged:
+            raise RuntimeError("This detector is not ready to trigger."
+                               "Call the stage() method before triggering.")
+        status = DeviceStatus(self)
+        with self._lock:
+            stats = self._stats
+            stats['triggers'] += 1
+            stats['first_trigger'] = stats['first_trigger'] or ttime.time()
+            self._trigger_time = ttime.time()
+            prearmed = [s for s in self._sets if s['status'] is None]
+            if prearmed and prearmed[0]['num_sets'] != self.number_of_sets.get():
+                self._discard_prearmed()
+                prearmed = []
+            if prearmed:
+                s = prearmed[0]
+                s['status'] = status
+                self.dispatch(self._image_name, ttime.time())
+                if s['phase'] == 'written':
+                    self._set_done(s)
+                if s['phase'] in ('writing', 'written'):
+                    self._prearm()
+                return status
+            s = {'phase': 'capturing', 'num_sets': self.number_of_sets.get(), 'status': status}
+            self._sets.append(s)
+            self._plugin.num_capture.put(s['num_sets'])
+            self.dispatch(self._image_name, ttime.time())
+            # reset the proc buffer, this needs to be generalized
+            self.proc.reset_filter.put(1)
+            self._plugin.capture.put(1)  # Now the TIFF plugin is capturing.
+        return status
+
+    def _set_done(self, s):
+        stats = self._stats
+        now = ttime.time()
+        stats['frames_saved'] += self.images_per_set.get() * s['num_sets']
+        stats['cycle_times'].append(now - max(stats['last_done'] or 0, self._trigger_time))
+        stats['last_done'] = now
+        self._sets.remove(s)
+        s['status']._finished()
+
+    def _num_captured_changed(self, value=None, old_value=None, **kwargs):
+        "This is called when the 'acquire' signal changes."
+        with self._lock:
+            capturing = self._in_phase('capturing')
+            writing = self._in_phase('writing')
+            if capturing and value == capturing[0]['num_sets']:
+                s = capturing[0]
+                # This is run on a thread, so exceptions might pass silently.
+                # Print and reraise so they are at least noticed.
+                try:
+                    self.tiff.write_file.put(1)
+                except Exception as e:
+                    print(e)
+                    raise
+                s['phase'] = 'writing'
+                if s['status'] is not None:
+                    self._prearm()
+            elif value == 0 and writing:
+                s = writing[0]
+                s['phase'] = 'written'
+                if s['status'] is not None:
+                    self._set_done(s)
+                summing = self._in_phase('summing')
+                if summing:
+                    self._arm_capture(summing[0])
+
+    def acquisition_stats(self):
+        """
+        Since staging: sets and frames saved per second (first trigger to
+        last completed set), mean cycle time, frames the detector acquired
+        that did not end up in a saved set, and arrays the file plugin
+        dropped.
+        """
+        stats = self._stats or {}
+        if not stats.get('last_done'):
+            return {'triggers': stats.get('triggers', 0), 'set_rate': 0., 'frame_rate': 0.,
+                    'mean_cycle_time': None, 'frames_saved': 0, 'frames_dropped': 0,
+                    'plugin_dropped_arrays': 0}
+        elapsed = stats['last_done'] - stats['first_trigger']
+        acquired = self.cam.array_counter.get() - stats['array_counter']
+        return {
+            'triggers': stats['triggers'],
+            'set_rate': len(stats['cycle_times']) / elapsed if elapsed else 0.,
+            'frame_rate': stats['frames_saved'] / elapsed if elapsed else 0.,
+            'mean_cycle_time': float(np.mean(stats['cycle_times'])),
+            'frames_saved': stats['frames_saved'],
+            'frames_dropped': max(0, acquired - stats['frames_saved']),
+            'plugin_dropped_arrays': self._plugin.dropped_arrays.get() - stats['dropped_arrays'],
+        }
+
+
+
+class ContinuousAcquisitionTriggerHDF5(BlueskyInterface):
+    """
+    ContinuousAcquisitionTrigger for a detector that writes through
+    XPDHDF5Plugin.
+
+    The detector is expected to already be acquiring. The HDF5 file stays open
+    (capturing) from stage to unstage; the plugin's callbacks are off between
+    triggers, and each trigger switches them on until number_of_sets more
+    sets are in the file. The sets have to land in the file in step with the
+    point numbers, so a trigger fails if the file holds more sets than the
+    previous points account for, and number_of_sets can not change within a
+    run.
+    """
+    def __init__(self, *args, plugin_name=None, image_name=None, **kwargs):
+        if plugin_name is None:
+            raise ValueError("plugin name is a required keyword argument")
+        super().__init__(*args, **kwargs)
+        self._plugin = getattr(self, plugin_name)
+        if image_name is None:
+            image_name = '_'.join([self.name, 'image'])
+        self._plugin.stage_sigs['enable'] = 0
+        self.cam.stage_sigs[self.cam.image_mode] = 'Continuous'
+        self._image_name = image_name
+        self._status = None
+        self._target = None
+        self._num_sets = None
+        self._num_captured_signal = self._plugin.num_captured
+        self._num_captured_signal.subscribe(self._num_captured_changed)
+
+    def stage(self):
+        if self.cam.acquire.get() != 1:
+            raise RuntimeError("The ContinuousAcuqisitionTrigger expects "
+                               "the detector to already be acquiring.")
+        self._num_sets = self.number_of_sets.get()
+        self._target = 0
+        return super().stage()
+
+    def unstage(self):
+        self._status = None
+        return super().unstage()
+
     def trigger(self):
         "Trigger one acquisition."
         if not self._staged:
             raise RuntimeError("This detector is not ready to trigger."
                                "Call the stage() method before triggering.")
-        self._save_started = False
-        self._status = DeviceStatus(self)
-        self._desired_number_of_sets = self.number_of_sets.get()
-        self._plugin.num_capture.put(self._desired_number_of_sets)
+        if self.number_of_sets.get() != self._num_sets:
+            raise RuntimeError(f"number_of_sets changed from {self._num_sets} since "
+                               f"{self.name} was staged; unstage and stage again.")
+        status = DeviceStatus(self)
+        captured = self._num_captured_signal.get()
+        if captured != self._target:
+            status.set_exception(RuntimeError(
+                f"{self._plugin.full_file_name.get()} holds {captured} sets, "
+                f"{self._target} expected; the images no longer match their points."))
+            return status
+        self._target = captured + self._num_sets
+        self._status = status
         self.dispatch(self._image_name, ttime.time())
-        # reset the proc buffer, this needs to be generalized
+        # reset the proc buffer so the first set is averaged from scratch
         self.proc.reset_filter.put(1)
-        self._plugin.capture.put(1)  # Now the TIFF plugin is capturing.
-        return self._status
+        self._plugin.enable.put(1)
+        return status
 
     def _num_captured_changed(self, value=None, old_value=None, **kwargs):
-        "This is called when the 'acquire' signal changes."
-        if self._status is None:
+        "This is called when the 'num_captured' signal changes."
+        status = self._status
+        if status is None or value < self._target:
             return
-        if value == self._desired_number_of_sets:
-            # This is run on a thread, so exceptions might pass silently.
-            # Print and reraise so they are at least noticed.
-            try:
-                self.tiff.write_file.put(1)
-            except Exception as e:
-                print(e)
-                raise
-            self._save_started = True
-        if value == 0 and self._save_started:
-            self._status._finished()
-            self._status = None
-            self._save_started = False
+        self._status = None
+        # This is run on a thread, so exceptions might pass silently.
+        # Print and reraise so they are at least noticed.
+        try:
+            self._plugin.enable.put(0)
+        except Exception as e:
+            print(e)
+            raise
+        status._finished()
 
 
 
@@ -283,6 +855,14 @@ class PerkinElmerContinuous(ContinuousAcquisitionTrigger, XPDPerkinElmer):
 class PerkinElmerStandardV33(SingleTriggerV33, XPDPerkinElmer):
     pass
 
+
+class PerkinElmerContinuousHDF5(ContinuousAcquisitionTriggerHDF5, XPDPerkinElmerHDF5):
+    pass
+
+
+class PerkinElmerStandardHDF5(SingleTriggerV33, XPDPerkinElmerHDF5):
+    pass
+
 class PerkinElmerMulti(MultiTrigger, XPDPerkinElmer):
     shutter = C(EpicsSignal, 'XF:28IDC-ES:1{Sh:Exp}Cmd-Cmd')
 
@@ -395,5 +975,185 @@ for det in [
     det.cam.bin_y.kind = 'config'
     det.detector_type.kind = 'config'
 
+
+# The PE panels writing one HDF5 file per run instead of one TIFF per set.
+# Each is a full device tree, so they are only made when asked for, e.g.
+#   pe1ch = pe_hdf5('pe1', continuous=True)
+#   RE(count([pe1ch], 10))
+_pe_pv_prefixes = {'pe1': pe1_pv_prefix, 'pe2': pe2_pv_prefix}
+_pe_hdf5 = {}
+
+
+def pe_hdf5(name, continuous=False):
+    """
+    The HDF5 version of PE detector *name* ('pe1' or 'pe2'): like pe1c if
+    *continuous*, else like pe1. Made on the first call, then reused.
+    """
+    key = (name, continuous)
+    if key not in _pe_hdf5:
+        if continuous:
+            det = PerkinElmerContinuousHDF5(_pe_pv_prefixes[name], name=name,
+                                            read_attrs=['hdf5', 'stats1.total'],
+                                            plugin_name='hdf5')
+        else:
+            det = PerkinElmerStandardHDF5(_pe_pv_prefixes[name], name=name, read_attrs=['hdf5'])
+        det.hdf5.update_paths()
+        det.cam.bin_x.kind = 'config'
+        det.cam.bin_y.kind = 'config'
+        det.detector_type.kind = 'config'
+        _pe_hdf5[key] = det
+    return _pe_hdf5[key]
+
+
+# the EPICS epoch, 1990-01-01, in UNIX time
+EPICS_EPOCH = 631152000
+
+
+class StatsTimeSeries:
+    """
+    Per-frame totals of the stats plugins of an already acquiring PE
+    detector, with no image files: nothing here arms a file plugin.
+
+    The stats plugins keep the time series themselves (their TS: buffers),
+    so frames are not missed however fast the detector runs. kickoff erases
+    and starts the buffers; complete waits for *num_points* frames, or, with
+    num_points=None, stops at once (e.g. at the end of a ramp wrapped with
+    ``bpp.fly_during_wrapper``, then up to the IOC's TSNumPoints frames are
+    kept); collect reads the buffers back as one EventPage with a row per
+    frame, timed by the frame's NDArray timestamp.
+    """
+
+    def __init__(self, det, stats=('stats1', 'stats2', 'stats3', 'stats4', 'stats5'), *,
+                 num_points=None, stream_name='stats', name=None):
+        self.det = det
+        self.plugins = [getattr(det, key) for key in stats]
+        self.num_points = num_points
+        self.stream_name = stream_name
+        self.name = name or f"{det.name}_stats_ts"
+        self._kickoff_time = None
+
+    def kickoff(self):
+        if self.det.cam.acquire.get() != 1:
+            raise RuntimeError(f"StatsTimeSeries expects {self.det.name} to already be acquiring.")
+        for p in self.plugins:
+            if self.num_points:
+                p.ts_num_points.set(self.num_points).wait()
+        self._kickoff_time = ttime.time()
+        for p in self.plugins:
+            p.ts_control.put('Erase/Start')
+        status = DeviceStatus(self)
+        status.set_finished()
+        return status
+
+    def complete(self):
+        if self.num_points is None:
+            self._stop()
+            status = DeviceStatus(self)
+            status.set_finished()
+            return status
+        statuses = [SubscriptionStatus(p.ts_current_point,
+                                       lambda value, **kwargs: value >= self.num_points)
+                    for p in self.plugins]
+        status = functools.reduce(lambda a, b: a & b, statuses)
+        status.add_callback(lambda _: self._stop())
+        return status
+
+    def _stop(self):
+        for p in self.plugins:
+            p.ts_control.set('Stop').wait()
+            p.ts_control.set('Read').wait()
+
+    def _to_unix(self, timestamps):
+        # NDArray timestamps are EPICS-epoch seconds with most drivers; take
+        # whichever reading lands near kickoff.
+        if abs(timestamps[0] + EPICS_EPOCH - self._kickoff_time) < abs(timestamps[0] - self._kickoff_time):
+            return timestamps + EPICS_EPOCH
+        return timestamps
+
+    def describe_collect(self):
+        return {self.stream_name: {p.total.name: p.total.describe()[p.total.name]
+                                   for p in self.plugins}}
+
+    def collect_pages(self):
+        totals = {}
+        for p in self.plugins:
+            n = int(p.ts_current_point.get())
+            if self.num_points is None and n == p.ts_num_points.get():
+                print(f"{p.name}: time series buffer full at {n} frames, later frames were not kept")
+            timestamps = np.round(np.asarray(p.ts_timestamp.get(), dtype=float)[:n], 6)
+            totals[p.total.name] = dict(zip(timestamps, np.asarray(p.ts_total.get())[:n]))
+        # The buffers were started one after the other, so they can differ by
+        # a frame at either end; keep the frames every plugin has.
+        common = sorted(set.intersection(*(set(t) for t in totals.values())))
+        if not common:
+            return
+        times = self._to_unix(np.array(common)).tolist()
+        data = {key: [float(t[ts]) for ts in common] for key, t in totals.items()}
+        yield {
+            "data": data,
+            "timestamps": {key: times for key in data},
+            "time": times,
+        }
+
+
+def stats_tseries(det, num_frames, *, frame_time=None,
+                  stats=('stats1', 'stats2', 'stats3', 'stats4', 'stats5'), md=None):
+    """
+    Record the stats totals of *num_frames* consecutive frames of *det*
+    (already acquiring, e.g. pe1c) without writing images.
+
+    Parameters
+    ----------
+    det : PerkinElmerContinuous
+    num_frames : int
+        At most the IOC's time series length (TSNumPoints).
+    frame_time : float, optional
+        Set det.cam.acquire_time first.
+    stats : tuple of str, optional
+        The stats plugins to record.
+    md : dict, optional
+
+    Examples
+    --------
+    >>> RE(stats_tseries(pe1c, 1000, frame_time=0.1))
+
+    During another plan, e.g. a temperature ramp, for as long as it runs:
+
+    >>> RE(bpp.fly_during_wrapper(Tramp_gas_plan([rga], 'He', 5, 300, 350, 5),
+    ...                           [StatsTimeSeries(pe1c)]))
+    """
+    flyer = StatsTimeSeries(det, stats, num_points=num_frames, stream_name='primary')
+    if frame_time is not None:
+        yield from bps.mv(det.cam.acquire_time, frame_time)
+    _md = {'detectors': [det.name],
+           'plan_name': 'stats_tseries',
+           'plan_args': {'det': repr(det), 'num_frames': num_frames,
+                         'frame_time': frame_time, 'stats': list(stats)},
+           'sp_num_frames': num_frames,
+           'sp_time_per_frame': frame_time}
+    _md.update(md or {})
+
+    @bpp.run_decorator(md=_md)
+    def inner():
+        yield from bps.kickoff(flyer, wait=True)
+        yield from bps.complete(flyer, wait=True)
+        yield from bps.collect(flyer)
+
+    return (yield from inner())
+
+
 # some defaults, as an example of how to use this
 # pe1.configure(dict(images_per_set=6, number_of_sets=10))
+
+
+# ophyd-async versions of the PE panels (scripts/pe_async.py): prepared for N
+# frames at a time and armed together, e.g.
+#   RE(pe_multi_frame_count([pe1a, pe2a], 100, 0.2))
+# They are only connected when that plan first uses them, so the profile
+# neither waits for nor touches the PE IOCs at startup.
+from ophyd_async.core import init_devices
+from pe_async import PerkinElmerAsync, XPDPathProvider, pe_multi_frame_count
+
+with init_devices(connect=False):
+    pe1a = PerkinElmerAsync(pe1_pv_prefix, XPDPathProvider(lambda: RE.md), name='pe1')
+    pe2a = PerkinElmerAsync(pe2_pv_prefix, XPDPathProvider(lambda: RE.md), name='pe2')
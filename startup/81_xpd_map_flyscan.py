@@ -1,6 +1,7 @@
 """Plan to run a XRD map "fly-scan" over a large sample."""
 import datetime
 import pprint
+import threading
 import time as ttime
 import uuid
 
@@ -13,7 +14,7 @@ from bluesky.utils import short_uid
 
 import bluesky_darkframes
 from ophyd import Signal
-from ophyd.status import Status
+from ophyd.status import DeviceStatus, Status
 
 
 # vendored, simplified, and made public from bluesky_darkframes
@@ -64,6 +65,7 @@ def xrd_map(
     md=None,
     backoff=0,
     snake=True,
+    mode="step",
 ):
     """
     Collect a 2D XRD map by "flying" in one direction.
@@ -103,7 +105,21 @@ def xrd_map(
        How far to move beyond the fly dimensions to get up to speed
     snake : bool
        If we should "snake" or "typewriter" the fly axis
+    mode : {'step', 'fly'}
+       'step' times every pixel in software: trigger, wait and read the
+       detector and the motor for each one.
+
+       'fly' lets the area detector free-run (it must be a continuous
+       acquisition detector such as pe1c, already acquiring) while the fly
+       motor moves at constant velocity. Capture is armed when the motor
+       readback crosses *fly_start*, the pixel edges are interpolated from
+       the monitored motor readback at the frame timestamps and each row is
+       emitted as a single EventPage (see `XRDMapRowFlyer`). The shutter
+       stays open between rows unless a dark is taken. Any other detectors
+       in *dets* are read once per row into the 'row' stream.
     """
+    if mode not in ("step", "fly"):
+        raise ValueError(f"mode must be 'step' or 'fly', not {mode!r}")
     # TODO input validation
     # rename here to use better internal names (!!)
     req_dwell_time = dwell_time
@@ -118,6 +134,8 @@ def xrd_map(
     }
 
     (ad,) = (d for d in dets if hasattr(d, "cam"))
+    if mode == "fly" and not (hasattr(ad, "proc") and hasattr(ad, "tiff")):
+        raise ValueError(f"mode='fly' needs a free-running area detector, not {ad.name}")
     (num_frame, acq_time, computed_dwell_time) = yield from configure_area_det(
         ad, req_dwell_time,acq_time
     )
@@ -161,7 +179,6 @@ def xrd_map(
     # or get the gating working below.
     #current_fly_motor_speed=fly_motor.velocity.get()
     speed = abs(fly_stop - fly_start) / (fly_pixels * computed_dwell_time)
-    print(speed)
     shell = SnapshotShell()
 
     @bpp.reset_positions_decorator([fly_motor.velocity])
@@ -185,10 +202,16 @@ def xrd_map(
 
             # take the dark while we might be waiting for motor movement
             if dark_plan:
-                #yield from bps.mv(shutter, "Close")
-                yield from bps.mv(shutter, 20)
-                yield from bps.sleep(0.5)
-                yield from dark_plan(ad, shell)
+                # no need to close the shutter if a cached dark is still valid;
+                # look it up once, it may expire before dark_plan runs
+                cached = _cached_dark(dark_plan, ad)
+                if cached is None:
+                    #yield from bps.mv(shutter, "Close")
+                    yield from bps.mv(shutter, 20)
+                    yield from bps.sleep(0.5)
+                    yield from dark_plan(ad, shell)
+                else:
+                    yield from dark_plan(ad, shell, snapshot=cached)
             # wait for the pre-fly motion to stop
             yield from bps.wait(group=pre_fly_group)
             #yield from bps.mv(shutter, "Open")
@@ -199,7 +222,6 @@ def xrd_map(
             yield from bps.abs_set(fly_motor, _fly_stop + _backoff, group=fly_group)
             # TODO gate starting to take data on motor position
             for j in range(fly_pixels):
-                print(time.time())
                 fly_pixel_group = short_uid("fly_pixel")
                 for d in dets:
                     yield from bps.trigger(d, group=fly_pixel_group)
@@ -218,7 +240,6 @@ def xrd_map(
                 for obj in dets + [px_start, px_stop, step_motor]:
                     yield from bps.read(obj)
                 yield from bps.save()
-                print(time.time)
             yield from bps.checkpoint()
             #yield from bps.mv(shutter, "Close")
             yield from bps.mv(shutter, 20)
@@ -229,10 +250,94 @@ def xrd_map(
                 _fly_start, _fly_stop = _fly_stop, _fly_start
                 _backoff = -_backoff
 
+    @bpp.reset_positions_decorator([fly_motor.velocity])
+    @bpp.set_run_key_decorator(f"xrd_map_{uuid.uuid4()}")
+    @bpp.stage_decorator(dets)
+    @bpp.run_decorator(md=_md)
+    def inner_fly():
+        flyer = XRDMapRowFlyer(ad, fly_motor, step_motor)
+        row_dets = [d for d in dets if d is not ad]
+        _fly_start, _fly_stop = fly_start, fly_stop
+        _backoff = backoff
+
+        yield from bps.mv(shutter, -20)
+        for step in np.linspace(step_start, step_stop, step_pixels):
+            yield from bps.checkpoint()
+            yield from bps.mv(fly_motor.velocity, 10)
+            pre_fly_group = short_uid("pre_fly")
+            yield from bps.abs_set(step_motor, step, group=pre_fly_group)
+            yield from bps.abs_set(
+                fly_motor, _fly_start - _backoff, group=pre_fly_group
+            )
+            if dark_plan:
+                cached = _cached_dark(dark_plan, ad)
+                if cached is None:
+                    yield from bps.mv(shutter, 20)
+                    yield from bps.sleep(0.5)
+                    yield from dark_plan(ad, shell)
+                    yield from bps.mv(shutter, -20)
+                else:
+                    yield from dark_plan(ad, shell, snapshot=cached)
+            yield from bps.wait(group=pre_fly_group)
+            if row_dets:
+                yield from bps.trigger_and_read(row_dets + [step_motor], name="row")
+
+            yield from bps.mv(fly_motor.velocity, speed)
+            flyer.configure_row(
+                _fly_start, _fly_stop, fly_pixels, computed_dwell_time,
+                backoff=_backoff,
+            )
+            yield from bps.kickoff(flyer, wait=True)
+            yield from bps.complete(flyer, wait=True)
+            yield from bps.collect(flyer, return_payload=False)
+            if snake:
+                _fly_start, _fly_stop = _fly_stop, _fly_start
+                _backoff = -_backoff
+        yield from bps.mv(shutter, 20)
+
+    if mode == "fly":
+        return (yield from inner_fly())
     yield from inner()
 
 
-def dark_plan(detector, shell, *, stream_name="dark"):
+def dark_plan(detector, shell, *, stream_name="dark", cache=dark_frame_cache, snapshot=None):
+    """
+    Emit a dark frame for *detector* into *stream_name*.
+
+    A dark from *cache* (see DarkFrameCache) taken with the same acquisition
+    settings is reused as long as it is valid; only otherwise is a new one
+    acquired and cached. The caller is responsible for closing the shutter.
+    It can skip that when ``_cached_dark(dark_plan, detector)`` returns a
+    snapshot, and should then pass that *snapshot* in, so the dark emitted
+    is the one it checked rather than a second lookup that may have expired.
+    """
+    if snapshot is None and cache is not None:
+        snapshot = cache.get(detector)
+    if snapshot is None:
+        snapshot = yield from _acquire_dark(detector)
+        if cache is not None:
+            cache.put(detector, snapshot)
+    shell.set_snaphsot(snapshot)
+
+    # emit the event to the dark stream
+    yield from bps.stage(shell)
+    yield from bps.trigger_and_read(
+        [shell], name=stream_name,
+    )
+    yield from bps.unstage(shell)
+
+
+dark_plan.uses_dark_frame_cache = True
+
+
+def _cached_dark(dark_plan, det):
+    "The cached dark *dark_plan* can reuse for *det* (the shutter can stay open), or None."
+    if not getattr(dark_plan, "uses_dark_frame_cache", False) or dark_frame_cache is None:
+        return None
+    return dark_frame_cache.get(det)
+
+
+def _acquire_dark(detector):
     # Restage to ensure that dark frames goes into a separate file.
     yield from bps.unstage(detector)
     yield from bps.stage(detector)
@@ -244,28 +349,263 @@ def dark_plan(detector, shell, *, stream_name="dark"):
     yield from bps.wait(grp)
     yield from bps.read(detector)
     snapshot = bluesky_darkframes.SnapshotDevice(detector)
-    shell.set_snaphsot(snapshot)
-
-    # emit the event to the dark stream
-    yield from bps.stage(shell)
-    yield from bps.trigger_and_read(
-        [shell], name=stream_name,
-    )
-    yield from bps.unstage(shell)
 
     # Restage.
     yield from bps.unstage(detector)
     yield from bps.stage(detector)
+    return snapshot
+
+
+class SignalRecorder:
+    """
+    Record every monitor update of a signal as (timestamp, value).
+
+    The callback runs on ophyd's dispatcher thread, so recording costs the
+    plan nothing; the arrays are read back once the motion is over.
+    """
+
+    def __init__(self, signal):
+        self.signal = signal
+        self._lock = threading.Lock()
+        self._timestamps = []
+        self._values = []
+        self._cid = None
+
+    def start(self):
+        with self._lock:
+            # Anchor with "now" rather than the (possibly old) timestamp of
+            # the last update, or interpolation would ramp from that time.
+            self._timestamps = [ttime.time()]
+            self._values = [self.signal.get()]
+        self._cid = self.signal.subscribe(self._record, run=False)
+
+    def stop(self):
+        if self._cid is not None:
+            self.signal.unsubscribe(self._cid)
+            self._cid = None
+
+    def _record(self, *, value, timestamp=None, **kwargs):
+        with self._lock:
+            self._timestamps.append(ttime.time() if timestamp is None else timestamp)
+            self._values.append(value)
+
+    def arrays(self):
+        with self._lock:
+            return np.asarray(self._timestamps), np.asarray(self._values)
+
+
+class XRDMapRowFlyer:
+    """
+    Fly one row of a map with a free-running area detector.
+
+    The detector (a ContinuousAcquisitionTrigger detector like pe1c, already
+    acquiring) captures *num_pixels* sets into its TIFF plugin while the fly
+    motor moves at constant velocity. Capture is armed from the motor
+    readback monitor once it crosses the row start. The motor readback and
+    the plugin's ``num_captured`` are recorded on their monitor threads and
+    the pixel edges are interpolated from them afterwards, so nothing runs
+    per pixel on the RunEngine thread. Each row is collected as one
+    EventPage with one datum per frame.
+
+    Example::
+
+        flyer = XRDMapRowFlyer(pe1c, sample_x, sample_y)
+        flyer.configure_row(8, 80, 100, 0.2)
+        yield from bps.kickoff(flyer, wait=True)
+        yield from bps.complete(flyer, wait=True)
+        yield from bps.collect(flyer)
+    """
+
+    def __init__(self, det, fly_motor, step_motor, *, name="xrd_map_row"):
+        self.name = name
+        self.parent = None
+        self.det = det
+        self.fly_motor = fly_motor
+        self.step_motor = step_motor
+        self._readback = getattr(fly_motor, "user_readback", None) or fly_motor.readback
+        self._positions = SignalRecorder(self._readback)
+        self._frames = SignalRecorder(det.tiff.num_captured)
+        self._asset_docs_cache = deque()
+        self._datum_factory = None
+        self._row = None
+
+    def configure_row(self, start, stop, num_pixels, frame_time, *, backoff=0):
+        "Set up the next row; *frame_time* is the exposure of one pixel."
+        self._row = dict(start=start, stop=stop, num_pixels=int(num_pixels),
+                         frame_time=frame_time, backoff=backoff)
+
+    def _compose_resource(self):
+        # Same layout as XPDFlyer, but one frame per datum so every pixel
+        # can point at its own file.
+        tiff = self.det.tiff
+        root = str(tiff.reg_root)
+        resource_path = str(Path(tiff.read_path_template).relative_to(root))
+        resource, self._datum_factory, self._datum_page_factory = compose_resource(
+            start={"uid": "needed for compose_resource() but will be discarded"},
+            spec=tiff.filestore_spec,
+            root=root,
+            resource_path=datetime.datetime.now().strftime(resource_path),
+            resource_kwargs=dict(
+                template=tiff.file_template.get(),
+                filename=tiff.file_name.get(),
+                frame_per_point=1,
+            ),
+        )
+        resource.pop("run_start")
+        self._asset_docs_cache.append(("resource", resource))
+        self._resource_filename = tiff.file_name.get()
+
+    def kickoff(self):
+        if self._row is None:
+            raise RuntimeError("call configure_row() before kickoff()")
+        row = self._row
+        # A restage (e.g. for a dark) gives the plugin a new file name.
+        if self._datum_factory is None or self._resource_filename != self.det.tiff.file_name.get():
+            self._compose_resource()
+        self._direction = np.sign(row["stop"] - row["start"]) or 1
+        self._first_point = self.det.tiff.file_number.get()
+        self._step_position = self.step_motor.position
+        self._armed = False
+        self._saving = False
+        self._datum_ids = None
+        travel = abs(row["stop"] - row["start"]) + 2 * abs(row["backoff"])
+        velocity = self.fly_motor.velocity.get() or 1
+        self._capture_status = DeviceStatus(
+            self.det, timeout=2 * row["num_pixels"] * row["frame_time"] + travel / velocity + 30)
+
+        self._positions.start()
+        self._frames.start()
+        self._captured_cid = self.det.tiff.num_captured.subscribe(self._captured, run=False)
+        self._gate_cid = self._readback.subscribe(self._gate, run=True)
+        self._motor_status = self.fly_motor.set(row["stop"] + self._direction * abs(row["backoff"]))
+
+        st = Status()
+        st.set_finished()
+        return st
+
+    def _gate(self, *, value, **kwargs):
+        if self._armed or (value - self._row["start"]) * self._direction < 0:
+            return
+        self._armed = True
+        self._arm_time = ttime.time()
+        tiff = self.det.tiff
+        tiff.num_capture.put(self._row["num_pixels"])
+        self.det.proc.reset_filter.put(1)
+        tiff.capture.put(1)
+
+    def _captured(self, *, value, **kwargs):
+        if not self._armed or self._capture_status.done:
+            return
+        if value == self._row["num_pixels"] and not self._saving:
+            self._saving = True
+            self.det.tiff.write_file.put(1)
+        elif value == 0 and self._saving:
+            self._capture_status.set_finished()
+
+    def complete(self):
+        st = self._capture_status & self._motor_status
+        st.add_callback(self._stop_monitors)
+        return st
+
+    def _stop_monitors(self, status=None):
+        self._readback.clear_sub(self._gate)
+        self.det.tiff.num_captured.clear_sub(self._captured)
+        self._positions.stop()
+        self._frames.stop()
+
+    def _pixel_times(self):
+        "Times at which each frame finished, from the num_captured monitor."
+        n, frame_time = self._row["num_pixels"], self._row["frame_time"]
+        t, count = self._frames.arrays()
+        # Keep the first update reaching each count during this capture.
+        keep = (t >= self._arm_time) & (count >= 1) & (count <= n)
+        t, count = t[keep], count[keep]
+        count, first = np.unique(count, return_index=True)
+        if len(count) < 2:
+            return self._arm_time + frame_time * np.arange(1, n + 1)
+        # Fill in frames whose monitor updates were coalesced.
+        return np.interp(np.arange(1, n + 1), count, t[first])
+
+    def _row_datums(self):
+        # The RunEngine collects asset docs before pages, so the datums are
+        # made on whichever comes first.
+        if self._datum_ids is None:
+            self._datum_ids, datums = _datums_in_bulk(
+                self._datum_page_factory, self._first_point, self._row["num_pixels"])
+            self._asset_docs_cache.extend(("datum", d) for d in datums)
+        return self._datum_ids
+
+    def describe_collect(self):
+        det_key = f"{self.det.name}_image"
+        desc = {det_key: self.det.describe()[det_key]}
+        desc[det_key]["shape"] = list(self.det.describe()[det_key]["shape"])[-2:]
+        motor_key = self.fly_motor.name
+        motor_desc = self.fly_motor.describe()[motor_key]
+        for key in (f"start_{motor_key}", f"stop_{motor_key}", motor_key):
+            desc[key] = dict(motor_desc, source="interpolated")
+        desc[self.step_motor.name] = self.step_motor.describe()[self.step_motor.name]
+        return {"primary": desc}
+
+    def collect_pages(self):
+        n, frame_time = self._row["num_pixels"], self._row["frame_time"]
+        stop_t = self._pixel_times()
+        start_t = stop_t - frame_time
+        pos_t, pos = self._positions.arrays()
+        order = np.argsort(pos_t)
+        pos_t, pos = pos_t[order], pos[order]
+        start_pos = np.interp(start_t, pos_t, pos)
+        stop_pos = np.interp(stop_t, pos_t, pos)
+
+        motor = self.fly_motor.name
+        data = {
+            f"{self.det.name}_image": list(self._row_datums()),
+            f"start_{motor}": start_pos.tolist(),
+            f"stop_{motor}": stop_pos.tolist(),
+            motor: ((start_pos + stop_pos) / 2).tolist(),
+            self.step_motor.name: [self._step_position] * n,
+        }
+        timestamps = {key: stop_t.tolist() for key in data}
+        yield {"time": stop_t.tolist(), "data": data, "timestamps": timestamps}
+
+    def collect_asset_docs(self):
+        if self._row is not None and self._datum_factory is not None:
+            self._row_datums()
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
 
 
+import functools
 import itertools
 from collections import deque
 from pathlib import Path
-from event_model import compose_resource
+from event_model import compose_resource, unpack_datum_page
+
+
+def _datums_in_bulk(compose_datum_page, first_point, num_points):
+    """
+    Datum documents for *num_points* consecutive frames, made as one datum
+    page. The RunEngine only takes single datums from a flyer, so the page
+    is unpacked; that is a plain loop over lists, not a schema validation
+    per frame.
+    """
+    page = compose_datum_page(
+        datum_kwargs={"point_number": list(range(first_point, first_point + num_points))})
+    return page["datum_id"], list(unpack_datum_page(page))
 
 
 class XPDFlyer:
-    def __init__(self, det, motor, motor_start, motor_stop, name="XPDFlyer", stats_key="stats1", **kwargs):
+    """
+    Fly *motor* from motor_start to motor_stop, triggering *det* back to back.
+
+    Frame times, motor positions and stats totals go into preallocated numpy
+    buffers (doubled if the motor turns out slower than expected); the datums
+    are made in one go from the resource's datum page factory and the row is
+    collected as one EventPage.
+    """
+
+    def __init__(self, det, motor, motor_start, motor_stop, name="XPDFlyer", stats_key="stats1",
+                 capacity=None, stage_detector=True, **kwargs):
         self.name = name
 
         self.det = det
@@ -273,29 +613,63 @@ class XPDFlyer:
         self.motor_start = motor_start
         self.motor_stop = motor_stop
         self.stats_key = stats_key
+        self.capacity = capacity
+        # False when the plan stages the detector once for many rows
+        self.stage_detector = stage_detector
 
         # Objects needed for the bluesky documents generation:
         self._asset_docs_cache = None
         self._resource_document = None
         self._datum_factory = None
+        self._datum_page_factory = None
+        self._datum_ids = None
 
     def get_images_counter(self):
         return self.det.cam.num_images_counter.get()
 
+    def configure_row(self, motor_start, motor_stop):
+        "Reuse this flyer for the next row of a map."
+        self.motor_start = motor_start
+        self.motor_stop = motor_stop
+
+    def _expected_frames(self):
+        "Frames the row should take, from the travel, motor velocity and exposure."
+        if self.capacity:
+            return int(self.capacity)
+        try:
+            travel_time = abs(self.motor_stop - self.motor_start) / self.motor.velocity.get()
+            frame_time = self.det.cam.acquire_time.get() * self._frame_per_point
+            return int(1.5 * travel_time / frame_time) + 16
+        except (AttributeError, TypeError, ZeroDivisionError):
+            return 256
+
+    def _allocate(self, size):
+        self._timestamps = np.full(size, np.nan)
+        self._motor_positions = np.full(size, np.nan)
+        self._det_stats = np.full(size, np.nan)
+
+    def _grow(self):
+        size = 2 * len(self._timestamps)
+        old = (self._timestamps, self._motor_positions, self._det_stats)
+        self._allocate(size)
+        for new, values in zip((self._timestamps, self._motor_positions, self._det_stats), old):
+            new[:len(values)] = values
+
     def kickoff(self):
-        print("Kickoff method")
         self._asset_docs_cache = deque()
-        self._counter = itertools.count()
-
-        # Used for events generation:
-        self._datum_docs = deque()
-        self._det_stats = deque()
-        self._motor_positions = deque()
-        self._timestamps = deque()
+        self._lock = threading.Lock()
+        self._num_frames = 0
+        # the last stats total (value, arrival time) not yet given to a frame,
+        # and the frames whose trigger is done but whose total has not come
+        self._latest_total = None
+        self._awaiting_total = deque()
+        self._on_total = None
+        self._datum_ids = None
 
         # Unstage the detector first from previous potential failure, then stage the detector:
-        self.det.unstage()
-        self.det.stage()
+        if self.stage_detector:
+            self.det.unstage()
+            self.det.stage()
 
         # We need the following information as in the document stream produced by bp.count([det]):
 
@@ -341,7 +715,7 @@ class XPDFlyer:
 
         date = datetime.datetime.now()
         resource_path = date.strftime(self._resource_path)
-        self._resource_document, self._datum_factory, _ = compose_resource(
+        self._resource_document, self._datum_factory, self._datum_page_factory = compose_resource(
             start={"uid": "needed for compose_resource() but will be discarded"},
             spec=self._filestore_spec,
             root=self._root_dir,
@@ -356,6 +730,11 @@ class XPDFlyer:
         self._resource_document.pop("run_start")
         self._asset_docs_cache.append(("resource", self._resource_document))
 
+        self._allocate(self._expected_frames())
+        # The stats total comes from its monitor rather than a get() per frame.
+        self._stats_total = getattr(self.det, self.stats_key).total
+        self._stats_cid = self._stats_total.subscribe(self._update_total, run=False)
+
         # Move the motor to the start position in a blocking fashion.
         # Then, start moving the motor to the stop position and subscribe the watch function.
         st = self.motor.move(self.motor_start)
@@ -366,74 +745,114 @@ class XPDFlyer:
 
         return st  # it should have the 'done' status already
 
-    def _watch(self, *args, **kwargs):
-        print(args)
-        print(kwargs)
-        if self._trigger_status.done:
-            self._timestamps.append(self._now())
-
-            self._trigger_status = self.det.trigger()
-            self._det_stats.append(getattr(self.det, self.stats_key).total.get())
-
-            datum_document = self._datum_factory(datum_kwargs={"point_number": next(self._counter)})
-            self._asset_docs_cache.append(("datum", datum_document))
-            self._datum_docs.append(datum_document)
-
-            print(f"\ndatum_document:\n{datum_document}")
-
-            if "current" in kwargs:
-                motor_pos = kwargs["current"]
+    def _update_total(self, *, value, **kwargs):
+        # The monitor can arrive after the trigger has completed: the total
+        # goes to the oldest frame still waiting for one, if it arrived after
+        # that frame was triggered, and is otherwise kept for the next. Both
+        # times are local: the IOC's clock need not agree with ours.
+        arrived = ttime.time()
+        with self._lock:
+            waiting = self._awaiting_total
+            if waiting and arrived > self._timestamps[waiting[0]]:
+                self._det_stats[waiting.popleft()] = value
+                self._latest_total = None
+            else:
+                self._latest_total = (value, arrived)
+            on_total = self._on_total if not waiting else None
+        if on_total is not None:
+            on_total()
+
+    def _watch(self, *args, current=None, **kwargs):
+        # Runs on the motor status thread: only bookkeeping and the trigger.
+        if not self._trigger_status.done:
+            return
+        with self._lock:
+            i = self._num_frames
+            if i == len(self._timestamps):
+                self._grow()
+            self._timestamps[i] = ttime.time()
+            # Final callback does not have the 'current' field, using the motor_stop value:
+            self._motor_positions[i] = self.motor_stop if current is None else current
+            self._num_frames += 1
+        self._trigger_status = self.det.trigger()
+        self._trigger_status.add_callback(functools.partial(self._frame_done, i))
+
+    def _frame_done(self, i, status):
+        with self._lock:
+            latest = self._latest_total
+            if (not self._awaiting_total and latest is not None
+                    and latest[1] > self._timestamps[i]):
+                self._det_stats[i] = latest[0]
+                self._latest_total = None
             else:
-               # Final callback does not have the 'current' field, using the motor_stop value:
-               motor_pos = self.motor_stop
-            self._motor_positions.append(motor_pos)
+                self._awaiting_total.append(i)
 
     def complete(self):
-        print("Complete method")
-
         self.motor_status.watch(self._watch)
-
-        return self.motor_status
-
-    def _now(self):
-        return ttime.time()
-
-    def collect(self):
-        print("Collect method")
-
-        self.det.unstage()
-
+        return self.motor_status & self._last_frame()
+
+    def _last_frame(self, total_timeout=2):
+        # The last frame is still being read out when the motor arrives, and
+        # its stats total may come later still (up to total_timeout s).
+        st = DeviceStatus(self.det)
+
+        def finish():
+            with self._lock:
+                self._on_total = None
+                if not st.done:
+                    st.set_finished()
+
+        def wait_for_total(status):
+            with self._lock:
+                if self._awaiting_total:
+                    self._on_total = finish
+                    threading.Timer(total_timeout, finish).start()
+                    return
+            finish()
+
+        def wait_for_trigger(status):
+            self._trigger_status.add_callback(wait_for_total)
+
+        self.motor_status.add_callback(wait_for_trigger)
+        return st
+
+    def _row_datums(self):
+        # Made once per row, on whichever of collect_asset_docs/collect_pages
+        # the RunEngine calls first.
+        if self._datum_ids is None:
+            # file_number is 0 right after staging; later rows of a map
+            # continue from where the previous row stopped.
+            self._datum_ids, datums = _datums_in_bulk(
+                self._datum_page_factory, self._file_number, self._num_frames)
+            self._asset_docs_cache.extend(("datum", d) for d in datums)
+        return self._datum_ids
+
+    def collect_pages(self):
+        self._stats_total.unsubscribe(self._stats_cid)
+        if self.stage_detector:
+            self.det.unstage()
+
+        n = self._num_frames
+        timestamps = self._timestamps[:n].tolist()
+        image_key = f"{self.det.name}_image"
+        data = {
+            image_key: list(self._row_datums()),
+            self._stats_total.name: self._det_stats[:n].tolist(),
+            self.motor.name: self._motor_positions[:n].tolist(),
+        }
         self._resource_document = None
         self._datum_factory = None
-
-        for i, (motor_pos, datum_doc, det_stat, timestamp) in enumerate(zip(self._motor_positions, self._datum_docs, self._det_stats, self._timestamps)):
-            print(f"{i:02d}  motor_pos={motor_pos}  datum_doc={datum_doc}  det_stat={det_stat}  timestamp={timestamp}")
-            data_dict = {
-                f"{self.det.name}_image": datum_doc["datum_id"],
-                f"{getattr(self.det, self.stats_key).total.name}": det_stat,
-                f"{self.motor.name}": motor_pos,
-            }
-
-            filled_dict = {}
-            for key in data_dict:
-                if key == f"{self.det.name}_image":
-                    # We need to fill the detector image data via RunRouter:
-                    filled = False
-                else:
-                    # We do not need to fill the other readings (i.e., motor positions, etc.):
-                    filled = True
-                filled_dict[key] = filled
-
-            yield {
-                "data": data_dict,
-                "timestamps": {key: timestamp for key in data_dict},
-                "time": timestamp,
-                "filled": filled_dict,
-            }
+        self._datum_page_factory = None
+        yield {
+            "data": data,
+            "timestamps": {key: timestamps for key in data},
+            "time": timestamps,
+            # We need to fill the detector image data via RunRouter;
+            # the other readings (i.e., motor positions, etc.) are filled already.
+            "filled": {image_key: [False] * n},
+        }
 
     def describe_collect(self):
-        print("Descrbe_collect method")
-        # TODO: implement
         return_dict = {"primary": {k: v for k, v in self.det.describe().items()
                                    if k in [f"{self.det.name}_image",
                                             f"{getattr(self.det, self.stats_key).total.name}",
@@ -444,6 +863,8 @@ class XPDFlyer:
         return return_dict
 
     def collect_asset_docs(self):
+        if self._datum_page_factory is not None and self._datum_ids is None:
+            self._row_datums()
         items = list(self._asset_docs_cache)
         self._asset_docs_cache.clear()
         for item in items:
@@ -485,39 +906,75 @@ def fly_stream(flyers, *, md=None, stream=False, return_payload=True):
     return uid
 
 
-def step_and_fly(step_motor, step_start, step_stop, step_num_steps, det, fly_motor, fly_start, fly_stop):
+def step_and_fly(step_motor, step_start, step_stop, step_num_steps, det, fly_motor, fly_start, fly_stop,
+                 *, snake=True, md=None):
     """Perform 2-D scan with a step scan in one dimension and fly scan in another one.
 
+    The whole map is one run: the detector is staged once, every row is
+    collected as an EventPage into the 'primary' stream and the step motor
+    position of each row goes to the 'row' stream (one event per row, in
+    order). The grid geometry is in the start document under 'grid'.
+
     Example of execution:
 
         RE(step_and_fly(sample_y, 17, 20, 3, pe2c, sample_x, 8, 80))
 
     Args:
-        step_motor (_type_): _description_
-        step_start (_type_): _description_
-        step_stop (_type_): _description_
-        step_num_steps (_type_): _description_
-        det (_type_): _description_
-        fly_motor (_type_): _description_
-        fly_start (_type_): _description_
-        fly_stop (_type_): _description_
+        step_motor: slow axis, stepped between rows
+        step_start, step_stop (float): first and last row position
+        step_num_steps (int): number of rows
+        det: area detector, triggered back to back during each row
+        fly_motor: fast axis, moved continuously during each row
+        fly_start, fly_stop (float): fly range of the first row
+        snake (bool): reverse the fly direction on every other row
+        md (dict, optional): metadata
 
     Yields:
-        _type_: _description_
+        Msg: the plan messages
     """
 
     # TODO: add dark frame collection here - will result in a separate run/uid.
 
-    for i, step_pos in enumerate(np.linspace(step_start, step_stop, step_num_steps)):
-        yield from bps.mv(step_motor, step_pos)
-        if i % 2 == 0:
-            start = fly_start
-            stop = fly_stop
-        else:
-            start = fly_stop
-            stop = fly_start
-        xpd_flyer = XPDFlyer(det, fly_motor, start, stop)
-        yield from fly_stream([xpd_flyer], stream=True, return_payload=True)
+    step_positions = np.linspace(step_start, step_stop, step_num_steps)
+    fly_extents = [(fly_stop, fly_start) if snake and i % 2 else (fly_start, fly_stop)
+                   for i in range(step_num_steps)]
+    _md = {
+        "detectors": [det.name],
+        "motors": [fly_motor.name, step_motor.name],
+        "plan_name": "step_and_fly",
+        "plan_args": dict(step_motor=repr(step_motor), step_start=step_start,
+                          step_stop=step_stop, step_num_steps=step_num_steps,
+                          det=repr(det), fly_motor=repr(fly_motor),
+                          fly_start=fly_start, fly_stop=fly_stop, snake=snake),
+        "grid": {
+            "shape": [step_num_steps, None],  # frames per row depend on the motor speed
+            "step_motor": step_motor.name,
+            "step_positions": step_positions.tolist(),
+            "fly_motor": fly_motor.name,
+            "fly_extents": [list(extent) for extent in fly_extents],
+            "snake": snake,
+            "row_stream": "row",
+        },
+        "extents": [(fly_start, fly_stop), (step_start, step_stop)],
+        "hints": {"dimensions": [((fly_motor.name,), "primary"), ((step_motor.name,), "row")]},
+    }
+    _md.update(md or {})
+
+    xpd_flyer = XPDFlyer(det, fly_motor, fly_start, fly_stop, stage_detector=False)
+
+    @bpp.stage_decorator([det])
+    @bpp.run_decorator(md=_md)
+    def inner():
+        for step_pos, (start, stop) in zip(step_positions, fly_extents):
+            yield from bps.checkpoint()
+            yield from bps.mv(step_motor, step_pos)
+            yield from bps.trigger_and_read([step_motor], name="row")
+            xpd_flyer.configure_row(start, stop)
+            yield from bps.kickoff(xpd_flyer, wait=True)
+            yield from bps.complete(xpd_flyer, wait=True)
+            yield from bps.collect(xpd_flyer, return_payload=False)
+
+    return (yield from inner())
 
 
 # from pdfstream.callbacks.analysis import AnalysisConfig, AnalysisStream
@@ -1,7 +1,8 @@
 import asyncio
+import threading
 from ophyd import Device, EpicsSignal, EpicsSignalRO
 from ophyd import Component as C
-from ophyd.utils import set_and_wait
+from ophyd.status import DeviceStatus, SubscriptionStatus
 from bluesky import Msg
 from bluesky.plans import count, list_scan
 from bluesky.plan_stubs import abs_set, open_run, close_run
@@ -9,6 +10,7 @@ from bluesky.utils import single_gen
 from bluesky.preprocessors import subs_wrapper, pchain
 from bluesky.callbacks import LiveTable
 from bluesky import Msg
+import bluesky.plan_stubs as bps
 
 
 SAMPLE_GEOMETRY_NULL = '~~NULL_GEO~~'
@@ -41,89 +43,188 @@ class Robot(Device):
         self._current_sample_geometry = SAMPLE_GEOMETRY_NULL
         super().__init__(*args, **kwargs)
 
-    def _poll_until_idle(self):
-        time.sleep(3)  # give it plenty of time to start
-        while self.status.get() != 'Idle':
-            time.sleep(.1)
+    # seconds the robot has to leave Idle after execute_cmd
+    start_timeout = 10
 
-    def _poll_until_sample_cleared(self):
-        while self.current_sample_number.get() != 0:
-            time.sleep(.1)
-
-    def load_sample(self, sample_number, sample_geometry=None):
+    def _in_sequence(self, steps, timeout=None):
+        """
+        Run steps one after the other without blocking. Each step is a
+        callable returning a status (or None when there is nothing to wait
+        for); the next one is called from the previous status' callback.
+        """
+        status = DeviceStatus(self, timeout=timeout)
+        steps = iter(steps)
+
+        def next_step(previous=None):
+            if status.done:
+                return
+            if previous is not None and not previous.success:
+                status.set_exception(previous.exception() or
+                                     RuntimeError(f"{self.name}: {previous} failed"))
+                return
+            for step in steps:
+                try:
+                    st = step()
+                except Exception as exc:
+                    status.set_exception(exc)
+                    return
+                if st is not None:
+                    st.add_callback(next_step)
+                    return
+            status.set_finished()
+
+        next_step()
+        return status
+
+    def _execute(self, cmd):
+        """
+        Fire cmd and execute_cmd. The status finishes when the status PV,
+        watched by monitor, has left Idle and come back to it.
+        """
+        status = DeviceStatus(self)
+        started = threading.Event()
+
+        def watch(value, **kwargs):
+            if value != 'Idle':
+                started.set()
+            elif started.is_set() and not status.done:
+                self.status.clear_sub(watch)
+                status.set_finished()
+
+        def check_started():
+            if not started.is_set() and not status.done:
+                self.status.clear_sub(watch)
+                status.set_exception(RuntimeError(
+                    f"{self.name} did not start within {self.start_timeout} s"))
+
+        def fire():
+            self.status.subscribe(watch, run=False)
+            self.execute_cmd.put(1)
+            timer = threading.Timer(self.start_timeout, check_started)
+            timer.daemon = True
+            timer.start()
+            return status
+
+        return self._in_sequence([lambda: cmd.set(1), fire])
+
+    def _move_theta(self, position, relative=False):
+        if position is None:
+            return None
+        if relative:
+            position += self.theta.position
+        return self.theta.set(position)
+
+    def load(self, sample_number, sample_geometry=None):
+        """
+        Start loading a sample and return a status; does not block.
+        """
         # If no sample is loaded, current_sample_number=0
         # is reported by the robot.
-        if self.current_sample_number.get() != 0:
-            raise RuntimeError(
-                "Sample %d is already loaded." % self.current_sample_number.get())
+        def check_empty():
+            if self.current_sample_number.get() != 0:
+                raise RuntimeError(
+                    "Sample %d is already loaded." % self.current_sample_number.get())
 
-        # Rotate theta into loading position if necessary (e.g. flat plate mode).
+        relative = sample_geometry in self.REL_MOVES
         load_pos = self.TH_POS[sample_geometry]['load']
-        if load_pos is not None:
-            if sample_geometry not in self.REL_MOVES:
-                print('Moving theta to load position')
-                self.theta.move(load_pos, wait=True)
-
-        # Loading the sample is a three-step procedure:
-        # Set sample_number; issue load_cmd; issue execute_cmd.
-        set_and_wait(self.sample_number, sample_number)
-        set_and_wait(self.load_cmd, 1)
-        self.execute_cmd.put(1)
-        print('Loading...')
-        self._poll_until_idle()
-
-        # Rotate theta into measurement position if necessary (e.g. flat plate mode).
         measure_pos = self.TH_POS[sample_geometry]['measure']
-        if measure_pos is not None:
-            print('Moving theta to measure position')
-            if sample_geometry not in self.REL_MOVES:
-                self.theta.move(measure_pos, wait=True)
-            else:
-                pos = self.theta.get().user_readback
-                self.theta.move(pos + measure_pos, wait=True)
-
-        # Stash the current sample geometry for reference when we unload.
-        self._current_sample_geometry = sample_geometry
 
-    def unload_sample(self):
+        def remember_geometry():
+            # Stash the current sample geometry for reference when we unload.
+            self._current_sample_geometry = sample_geometry
+
+        return self._in_sequence([
+            check_empty,
+            # Rotate theta into loading position if necessary (e.g. flat plate mode).
+            lambda: None if relative else self._move_theta(load_pos),
+            # Loading the sample is a three-step procedure:
+            # Set sample_number; issue load_cmd; issue execute_cmd.
+            lambda: self.sample_number.set(sample_number),
+            lambda: print('Loading...'),
+            lambda: self._execute(self.load_cmd),
+            # Rotate theta into measurement position if necessary (e.g. flat plate mode).
+            lambda: self._move_theta(measure_pos, relative=relative),
+            remember_geometry,
+        ])
+
+    def unload(self):
+        """
+        Start unloading the current sample and return a status; does not block.
+        """
         if self.current_sample_number.get() == 0:
             # there is nothing to do
-            return
+            status = DeviceStatus(self)
+            status.set_finished()
+            return status
 
         # Rotate theta into loading position if necessary (e.g. flat plate mode)
         if self._current_sample_geometry == SAMPLE_GEOMETRY_NULL:
             raise RuntimeError("Unknown current sample geometry, can not unload")
-        load_pos = self.TH_POS[self._current_sample_geometry]['load']
-        measure_pos = self.TH_POS[self._current_sample_geometry]['measure']
-        print(load_pos, measure_pos)
-        if load_pos is not None:
-            print('Moving theta to unload position')
-            if self._current_sample_geometry not in self.REL_MOVES:
-                self.theta.move(load_pos, wait=True)
-            else:
-                pos = self.theta.get().user_readback
-                self.theta.move(pos - measure_pos, wait=True)
-
-        set_and_wait(self.unload_cmd, 1)
-        self.execute_cmd.put(1)
-        print('Unloading...')
-        self._poll_until_idle()
-        self._poll_until_sample_cleared()
-        self._current_sample_geometry = SAMPLE_GEOMETRY_NULL
+        geometry = self._current_sample_geometry
+        relative = geometry in self.REL_MOVES
+        load_pos = self.TH_POS[geometry]['load']
+        measure_pos = self.TH_POS[geometry]['measure']
+        if relative:
+            theta_move = lambda: self._move_theta(-measure_pos, relative=True)
+        else:
+            theta_move = lambda: self._move_theta(load_pos)
+
+        def sample_cleared():
+            return SubscriptionStatus(self.current_sample_number,
+                                      lambda value, **kwargs: value == 0)
+
+        def forget_geometry():
+            self._current_sample_geometry = SAMPLE_GEOMETRY_NULL
+
+        return self._in_sequence([
+            theta_move,
+            lambda: print('Unloading...'),
+            lambda: self._execute(self.unload_cmd),
+            sample_cleared,
+            forget_geometry,
+        ])
+
+    def set(self, sample):
+        """
+        Exchange samples: unload whatever is loaded, then load ``sample``
+        (a dict with 'position' and optionally 'geometry'); None only unloads.
+        Makes the robot usable with bps.abs_set / bps.wait.
+        """
+        steps = [self.unload]
+        if sample is not None:
+            steps.append(lambda: self.load(sample['position'], sample.get('geometry', None)))
+        return self._in_sequence(steps)
+
+    def load_sample(self, sample_number, sample_geometry=None):
+        self.load(sample_number, sample_geometry).wait()
 
-    def stop(self):
-        self.theta.stop()
-        super().stop()
+    def unload_sample(self):
+        self.unload().wait()
+
+    def stop(self, *, success=False):
+        self.theta.stop(success=success)
+        super().stop(success=success)
 
 
 # Define custom commands for sample loading/unloading.
 
+async def _status_done(status):
+    # Let the event loop run while the robot works; the status callback
+    # comes from a PV monitor thread.
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    status.add_callback(lambda st: loop.call_soon_threadsafe(done.set))
+    await done.wait()
+    if not status.success:
+        raise status.exception()
+
+
 async def _load_sample(msg):
-    msg.obj.load_sample(*msg.args, **msg.kwargs)
+    await _status_done(msg.obj.load(*msg.args, **msg.kwargs))
 
 
 async def _unload_sample(msg):
-    msg.obj.unload_sample(*msg.args, **msg.kwargs)
+    await _status_done(msg.obj.unload(*msg.args, **msg.kwargs))
 
 
 # Register these custom command with the RunEngine.
@@ -167,6 +268,74 @@ def robot_wrapper(plan, sample):
     yield from unload_sample()
 
 
+def _ingested(inserter):
+    # awaitable factory for bps.wait_for: the Tiled writer has drained its queue
+    def wait():
+        return asyncio.get_running_loop().run_in_executor(None, inserter.flush)
+    return wait
+
+
+def sample_queue(samples, plan, *, wait_for_ingest=True):
+    """Measure samples back to back, exchanging each while the previous
+    one's documents are still being written out.
+
+    The robot exchange (unload + load) is started with abs_set and runs from
+    PV monitors, so the RunEngine is free while it happens. Meanwhile the
+    background Tiled writer keeps ingesting the previous sample.
+
+    Parameters
+    ----------
+    samples : list of dict
+        each must contain 'position'; optionally also 'geometry'
+    plan : callable
+        plan(sample) returns the plan to run on the loaded sample
+    wait_for_ingest : bool, optional
+        wait (alongside the exchange) for the Tiled writer to catch up before
+        measuring the next sample, so a slow server never falls more than
+        one sample behind
+
+    Returns
+    -------
+    dict with the number of samples, total seconds, samples per hour and
+    the time spent on each exchange
+
+    Examples
+    --------
+
+    >>> RE(sample_queue(samples, lambda s: bp.count([pe1c], md=s)))
+    """
+    try:
+        inserter = tiled_inserter if wait_for_ingest else None
+    except NameError:
+        inserter = None
+
+    def exchange(sample):
+        # unload the previous sample and load this one ...
+        yield from bps.abs_set(robot, sample, group='robot_exchange')
+        # ... while the previous sample is ingested
+        if inserter is not None:
+            yield from bps.wait_for([_ingested(inserter)])
+        yield from bps.wait(group='robot_exchange')
+
+    t_start = time.monotonic()
+    exchange_s = []
+    for sample in samples:
+        t0 = time.monotonic()
+        yield from exchange(sample)
+        exchange_s.append(time.monotonic() - t0)
+        yield from plan(sample)
+    yield from exchange(None)
+
+    elapsed = time.monotonic() - t_start
+    summary = {'samples': len(samples), 'seconds': elapsed,
+               'samples_per_hour': 3600 * len(samples) / elapsed if elapsed else 0.,
+               'exchange_s': exchange_s}
+    print(f"{summary['samples']} samples in {elapsed:.0f} s "
+          f"({summary['samples_per_hour']:.1f} samples/hour, "
+          f"mean exchange {np.mean(exchange_s) if exchange_s else 0:.1f} s)")
+    return summary
+
+
 def ct(sample, exposure):
     """
     Capture how many exposures are needed to get a total exposure
@@ -74,14 +74,13 @@ def guess(xdata, ydata, sigma=None):
     x0 = xdata[np.argmax(np.abs(ydata-g_average))]
 
 
-    init_guess = {
-                  'amplitude': Parameter('amplitude', value=g_amp, vary=True),
-                  'sigma': Parameter('sigma', min=0, value=g_sigma, vary=True),
-                  'x0' : Parameter('x0', value=x0, vary=True),
-                  'intercept': Parameter('intercept', value=g_average,vary=True),
-                  'slope': Parameter('slope', value=0, vary=True),
-                 }
-    params = Parameters(init_guess)
+    # Parameters(dict) does not add the entries (lmfit >= 1.2), add them one by one
+    params = Parameters()
+    params.add('amplitude', value=g_amp, vary=True)
+    params.add('sigma', min=0, value=g_sigma, vary=True)
+    params.add('x0', value=x0, vary=True)
+    params.add('intercept', value=g_average, vary=True)
+    params.add('slope', value=0, vary=True)
     return params
 
 
@@ -132,8 +131,247 @@ def wavelength_from_theta(theta, d):
     '''
     return 2*d*np.sin(np.radians(theta))
 
-# New calibration scan plan
+def _measure_at(detectors, motor, position, detector_name, backlash=0):
+    '''
+        Move to position and take one reading. Returns (motor position, detector value).
+
+        With backlash > 0 every position is approached from above, the
+        direction th_cal and tth_cal move without backlash.
+    '''
+    if backlash and position > motor.position:
+        yield from bps.mv(motor, position + backlash)
+    yield from bps.mv(motor, position)
+    reading = yield from bps.trigger_and_read(list(detectors) + [motor])
+    return reading[motor.name]['value'], reading[detector_name]['value']
+
+
+def _baseline_and_noise(ydata):
+    '''
+        Robust baseline (median) and noise (MAD, never below counting noise).
+    '''
+    ydata = np.asarray(ydata, dtype=float)
+    base = np.median(ydata)
+    noise = 1.4826 * np.median(np.abs(ydata - base))
+    return base, max(noise, np.sqrt(np.abs(base)), 1e-12)
+
+
+def _center_stderr(res):
+    stderr = res.params['x0'].stderr
+    return np.inf if stderr is None else stderr
+
+
+def seek_peak(detectors, motor, theta_guess, detector_name, *, step=.0024, max_steps=60,
+              sdev=5, sigma_guess=None, target_uncertainty=1e-4, max_points=150, backlash=0):
+    '''
+        Locate one peak (or dip) near theta_guess, measuring only where it helps.
+
+        1. search: step out from theta_guess, alternating sides, until a
+           point stands out from the baseline by more than sdev * noise
+        2. bracket: step out from that point at step/2 until the signal is
+           back at the baseline on both sides, then fit with guess_and_fit
+        3. refine: measure around the fitted center at +/- 1.5 fitted sigma
+           and refit, until the center's standard error is below
+           target_uncertainty
+
+        Must run inside an open run. Returns (fit result, xdata, ydata); the
+        fit result is None if nothing was found within max_steps.
+    '''
+    xdata, ydata = [], []
+
+    def measure(position):
+        x, y = yield from _measure_at(detectors, motor, position, detector_name, backlash=backlash)
+        xdata.append(x)
+        ydata.append(y)
+
+    def stands_out(y, base, noise):
+        return np.abs(y - base) > sdev * noise
+
+    # 1. search
+    found = None
+    for k in range(max_steps + 1):
+        for offset in ([0] if k == 0 else [k * step, -k * step]):
+            yield from measure(theta_guess + offset)
+        if len(ydata) < 5:
+            continue
+        base, noise = _baseline_and_noise(ydata)
+        i = np.argmax(np.abs(np.asarray(ydata) - base))
+        if stands_out(ydata[i], base, noise):
+            found = xdata[i]
+            break
+    if found is None:
+        print("No peak within {} +/- {}".format(theta_guess, max_steps * step))
+        return None, xdata, ydata
+    print("Found something at {}, bracketing it".format(found))
+
+    # 2. bracket
+    for direction in (1, -1):
+        quiet = 0
+        position = found
+        while quiet < 2 and len(xdata) < max_points:
+            position += direction * step / 2
+            yield from measure(position)
+            quiet = quiet + 1 if not stands_out(ydata[-1], base, noise) else 0
+
+    sigma = step / 4 if sigma_guess is None else sigma_guess
+    res = guess_and_fit(np.asarray(xdata), np.asarray(ydata), sigma=sigma)
+
+    # 3. refine
+    lo, hi = min(xdata), max(xdata)
+    while _center_stderr(res) > target_uncertainty and len(xdata) < max_points:
+        center = res.best_values['x0']
+        if not lo <= center <= hi:
+            print("Fitted center {} left the measured range, giving up refining".format(center))
+            break
+        width = np.abs(res.best_values['sigma'])
+        for offset in (1.5, .75, 0, -.75, -1.5):
+            yield from measure(center + offset * width)
+        res = guess_and_fit(np.asarray(xdata), np.asarray(ydata), sigma=width)
+
+    print("Center {} +/- {} from {} points".format(res.best_values['x0'], _center_stderr(res), len(xdata)))
+    return res, xdata, ydata
+
+
+# Adaptive calibration scan plan
 def Ecal(wguess, detectors=None, motor=None, coarse_step=.0012, coarse_nsteps=120, D='Si', detector_name='sc_chan1',
+         theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5, output_file="result.csv",
+         motor_type='th', target_uncertainty=1e-4, max_points=150, sdev=5, sigma_guess=None,
+         backlash=0, plot=True, md=None):
+    '''
+        Energy calibration that seeks the two symmetric peaks (dips) of the
+        first reflection instead of scanning a fixed grid.
+
+        Each peak is located with seek_peak: a search stepping out from the
+        expected position, a bracket around what it finds, then measurements
+        around the fitted center until its uncertainty is below
+        target_uncertainty. Both peaks are taken in one run.
+
+        Parameters
+        ----------
+        wguess : the guessed wavelength
+        detectors : list, optional
+            list of detectors. Defaults to [sc] detector
+        motor : motor, optional
+            the motor to scan on (th_cal). Defaults to th_cal
+        coarse_step : float, optional
+            step of the search for each peak; keep it below the peak FWHM
+        coarse_nsteps : int, optional
+            the maximum number of search steps on each side of the guess
+        D : string, optional
+            the reference sample to use for the calculation of the d spacings
+            Defaults to "Si"
+        detector_name : str, optional
+            the name of the detector
+        theta_offset : float, optional
+            the offset of theta zero estimated from the sample
+        nsigma_fine, nsigma_range, output_file : optional
+            the fine grid of Ecal_grid; accepted so that calls written for
+            it still work, but not used by the adaptive search
+        motor_type : str, optional
+            the type of motor used, ether "th" (theta) or "tth"(two-theta)
+        target_uncertainty : float, optional
+            stop refining a peak once the standard error of its center is
+            below this (in motor units)
+        max_points : int, optional
+            the most points to take per peak
+        sdev : float, optional
+            how many noise widths a point must be off the baseline to count
+            as found
+        sigma_guess : float, optional
+            initial peak sigma for the fit. Defaults to coarse_step/4
+        backlash : float, optional
+            if > 0, approach every point from above by this much
+        plot : bool, optional
+            plot the data and fit of each peak at the end
+        md : dict, optional
+            extra metadata for the run
+
+        Returns
+        -------
+        wavelength : float
+            the fitted wavelength in angstroms, also kept in myresult.wavelength
+
+        Example
+        -------
+        >>> RE(Ecal(0.1867))
+        >>> myresult.wavelength
+
+        or, inside another plan,
+
+        >>> wavelength = yield from Ecal(0.1867)
+    '''
+    if detectors is None:
+        detectors = [sc]
+    if motor is None:
+        motor = th_cal
+
+    factors = dict(th=1, tth=2)
+    factor = factors[motor_type]
+
+    cen_guesses = guess_theta_from_reference(wguess, D=D)
+    peak_guesses = theta_offset + cen_guesses[0], theta_offset - cen_guesses[0]
+    print("Trying {} +/- {} = {} and {}".format(theta_offset, cen_guesses[0],
+                                                peak_guesses[0], peak_guesses[1]))
+
+    _md = {'plan_name': 'Ecal', 'wguess': wguess, 'D': D,
+           'detectors': [det.name for det in detectors], 'motors': [motor.name],
+           'theta_offset': theta_offset, 'target_uncertainty': target_uncertainty}
+    _md.update(md or {})
+
+    seeks = []
+
+    @bpp.run_decorator(md=_md)
+    def inner():
+        for theta_guess in peak_guesses:
+            found = yield from seek_peak(detectors, motor, theta_guess, detector_name,
+                                         step=coarse_step, max_steps=coarse_nsteps, sdev=sdev,
+                                         sigma_guess=sigma_guess, target_uncertainty=target_uncertainty,
+                                         max_points=max_points, backlash=backlash)
+            seeks.append(found)
+            if found[0] is None:
+                break
+
+    yield from inner()
+
+    if len(seeks) < 2 or any(res is None for res, _, _ in seeks):
+        print("Ecal failed: did not find both peaks. Check wguess and theta_offset.")
+        return None
+
+    results_list = [res for res, _, _ in seeks]
+    if plot:
+        for cnt, (res, xdata, ydata) in enumerate(seeks, start=1):
+            order = np.argsort(xdata)
+            plt.figure('Ecal peak {}'.format(cnt)); plt.clf()
+            plt.plot(np.asarray(xdata)[order], np.asarray(ydata)[order], linewidth=0, marker='o', color='b', label="data")
+            plt.plot(np.asarray(xdata)[order], res.eval(x=np.asarray(xdata)[order]), color='r', label="fit")
+            plt.legend()
+
+    # left right doesnt mean anything by the symmetric peak pairs
+    peak_left_cen = results_list[0].best_values['x0']
+    peak_right_cen = results_list[1].best_values['x0']
+
+    new_theta_offset = (peak_left_cen+peak_right_cen)*.5
+    average_peak_theta = (np.abs(peak_left_cen-new_theta_offset) +
+                          np.abs(peak_right_cen-new_theta_offset))*.5
+    theta_stderr = .5 * np.hypot(*[_center_stderr(res) for res in results_list])
+
+    # if th, factor =1 , if tth factor=2 since th = tth/2
+    d = D_SPACINGS[D][0]
+    fitted_wavelength = wavelength_from_theta(average_peak_theta/factor, d)
+    wavelength_stderr = 2*d*np.cos(np.radians(average_peak_theta/factor)) * np.radians(theta_stderr/factor)
+    print("new theta offset : {} deg".format(new_theta_offset))
+    print("average peak theta: {} +/- {} deg".format(average_peak_theta, theta_stderr))
+    print("Fitted wavelength is {} +/- {} angs".format(fitted_wavelength, wavelength_stderr))
+
+    # in case we want access to the results list
+    myresult.results_list = results_list
+    myresult.wavelength = fitted_wavelength
+    myresult.wavelength_stderr = wavelength_stderr
+    myresult.theta_offset = new_theta_offset
+    return fitted_wavelength
+
+
+# Previous calibration scan plan: fixed coarse grid, then a fine grid around each peak
+def Ecal_grid(wguess, detectors=None, motor=None, coarse_step=.0012, coarse_nsteps=120, D='Si', detector_name='sc_chan1',
               theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5,
               output_file="result.csv", motor_type='th'):
     '''
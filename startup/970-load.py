@@ -112,7 +112,7 @@ md['group'] = glbl['group']
 md['facility'] = glbl['facility']
 
 xrun = CustomizedRunEngine(None)
-xrun.md = RE.md
+xrun.md = RE.md  # the cached Redis dict from 00-startup.py (until RE is replaced below)
 xrun.md.update(md)
 
 print("loading beamline config")
@@ -168,13 +168,23 @@ class MoreCustomizedRunEngine(CustomizedRunEngine):
 
 #from nslsii import configure_kafka_publisher
 from bluesky.utils import ts_msg_hook
-from redis_json_dict import RedisJSONDict
+from cached_redis_dict import CachedRedisJSONDict
 import redis
 
+# The RE.md of 00-startup.py (also xrun.md) is replaced below; stop its
+# invalidation listener.
+if isinstance(getattr(RE, "md", None), CachedRedisJSONDict):
+    RE.md.close()
 RE = MoreCustomizedRunEngine(None)  # This object is like 'xrun', but with the RE API.
-# Manually set re.md to redis.
-RE.md = RedisJSONDict(redis.Redis("info.xpd.nsls2.bnl.gov", 6379), prefix="")
+# Manually set re.md to redis, with the local cache (scripts/cached_redis_dict.py).
+RE.md = CachedRedisJSONDict(redis.Redis("info.xpd.nsls2.bnl.gov", 6379), prefix="")
+xrun.md = RE.md
 # RE.msg_hook = ts_msg_hook
+# Per-Msg / status / callback timing of a slow plan (scripts/re_tracer.py):
+# re_tracer.install(RE); RE(plan); re_tracer.print_summary('device');
+# re_tracer.save('plan.trace.json'); re_tracer.uninstall()
+from re_tracer import RETracer
+re_tracer = RETracer()
 
 #configure_kafka_publisher(RE, beamline_name='xpd')
 RE.md.update(md)
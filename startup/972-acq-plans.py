@@ -14,6 +14,13 @@ from bluesky.preprocessors import subs_wrapper, reset_positions_wrapper
 from bluesky.callbacks import LiveTable, LivePlot
 from bluesky.plan_tools import print_summary
 
+# 1-D patterns as the images come in, instead of integrate_and_save_last()
+# re-reading them afterwards (scripts/sparse_azint.py), e.g.
+#   live_azint = LiveIntegrator('config_base/xrd.poni', npt=3000)
+#   token = RE.subscribe(live_azint)
+#   live_azint.join(); q, iq = live_azint.last
+from sparse_azint import LiveIntegrator, SparseIntegrator
+
 ####  Plan to run Gas/RGA2 over xpdacq protocols of samples ########
 
 gas.gas_list = ['He', 'N2', 'CO2', 'Air']